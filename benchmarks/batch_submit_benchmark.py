@@ -0,0 +1,118 @@
+# benchmarks/batch_submit_benchmark.py
+#
+# Compares how long it takes to hand 10,000 files to AWS Batch one job per file, one job per
+# manifest, and as a single array job over sharded manifests. moto stands in for S3 and Batch
+# locally, so the numbers reflect request counts rather than AWS latency or throttling.
+#
+# Usage: pip install boto3 "moto[batch,s3,iam,ec2]" && python benchmarks/batch_submit_benchmark.py
+
+import os
+import sys
+import time
+import uuid
+from moto import mock_aws
+
+FILE_COUNT = int(os.environ.get('BENCHMARK_FILE_COUNT', '10000'))
+
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'MANIFEST_BUCKET_NAME': 'splinter-benchmark-manifests',
+})
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'ingest_utils_layer', 'python'))
+
+
+def create_batch_resources(batch_client, iam_client, ec2_client):
+    role_arn = iam_client.create_role(
+        RoleName='BenchmarkBatchRole',
+        AssumeRolePolicyDocument='{}',
+    )['Role']['Arn']
+    subnet = ec2_client.describe_subnets()['Subnets'][0]
+    security_group_id = ec2_client.describe_security_groups(
+        Filters=[{'Name': 'vpc-id', 'Values': [subnet['VpcId']]}]
+    )['SecurityGroups'][0]['GroupId']
+
+    compute_environment_arn = batch_client.create_compute_environment(
+        computeEnvironmentName='BenchmarkComputeEnv',
+        state='ENABLED',
+        type='MANAGED',
+        computeResources={
+            'type': 'FARGATE',
+            'maxvCpus': 16,
+            'subnets': [subnet['SubnetId']],
+            'securityGroupIds': [security_group_id],
+        },
+        serviceRole=role_arn,
+    )['computeEnvironmentArn']
+
+    job_queue_arn = batch_client.create_job_queue(
+        jobQueueName='BenchmarkJobQueue',
+        state='ENABLED',
+        priority=1,
+        computeEnvironmentOrder=[{'order': 1, 'computeEnvironment': compute_environment_arn}],
+    )['jobQueueArn']
+
+    job_definition_arn = batch_client.register_job_definition(
+        jobDefinitionName='BenchmarkJobDef',
+        type='container',
+        containerProperties={'image': 'busybox', 'vcpus': 1, 'memory': 512, 'command': ['true']},
+    )['jobDefinitionArn']
+
+    return job_queue_arn, job_definition_arn
+
+def time_call(label, func):
+    start = time.perf_counter()
+    requests_made = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<38} {elapsed:8.2f} s  {requests_made:6d} request(s)")
+
+def main():
+    # Keep moto from trying to run the submitted jobs in Docker
+    with mock_aws(config={'batch': {'use_docker': False}}):
+        import boto3
+        import manifest_utils
+
+        boto3.client('s3').create_bucket(Bucket=os.environ['MANIFEST_BUCKET_NAME'])
+        job_queue_arn, job_definition_arn = create_batch_resources(
+            boto3.client('batch'), boto3.client('iam'), boto3.client('ec2')
+        )
+        os.environ['JOB_QUEUE'] = job_queue_arn
+        os.environ['JOB_DEFINITION'] = job_definition_arn
+
+        files = [(f"s3://benchmark-bucket/docs/{i:05d}.pdf", 250 * 1024) for i in range(FILE_COUNT)]
+        manifests = manifest_utils.bundle_manifests(files)
+        environment = [{'name': 'EMBEDDING_PROVIDER', 'value': 'huggingface'}]
+        batch_client = manifest_utils.batch_client
+
+        def submit_one(name_suffix, env):
+            batch_client.submit_job(
+                jobName=f"BatchJob_{name_suffix}",
+                jobQueue=job_queue_arn,
+                jobDefinition=job_definition_arn,
+                containerOverrides={'environment': env},
+            )
+
+        def one_job_per_file():
+            for url, _ in files:
+                submit_one(uuid.uuid4(), environment + [{'name': 'AWS_S3_URLS', 'value': f'["{url}"]'}])
+            return len(files)
+
+        def one_job_per_manifest():
+            for manifest in manifests:
+                submit_one(uuid.uuid4(), environment + [{'name': 'AWS_S3_URLS', 'value': str(manifest)}])
+            return len(manifests)
+
+        def one_array_job():
+            manifest_utils.submit_manifests(manifests, environment)
+            # One PUT per shard plus the single submit_job call
+            return len(manifests) + 1
+
+        print(f"Submitting {FILE_COUNT} files ({len(manifests)} manifests of up to {manifest_utils.BUNDLE_MAX_FILES} files)")
+        time_call("one job per file", one_job_per_file)
+        time_call("one job per manifest", one_job_per_manifest)
+        time_call("one array job over sharded manifests", one_array_job)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# benchmarks/destination_client_benchmark.py
+#
+# Compares per-file delete latency when every delete opens its own destination connection (a cold
+# Lambda, or the per-call clients the Lambdas used to create) with deletes over the module-scope
+# client the Lambdas now keep between warm invocations. It runs against local containers, so the
+# gap is the connection setup alone; against a managed database over TLS it is several times wider.
+#
+# Usage:
+#   docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres:16
+#   docker run -d -p 27017:27017 mongo:7
+#   pip install psycopg2-binary pymongo python-dotenv && python benchmarks/destination_client_benchmark.py
+#
+# A backend that can't be reached is skipped.
+
+import os
+import statistics
+import sys
+import time
+
+DELETE_COUNT = int(os.environ.get('BENCHMARK_DELETE_COUNT', '200'))
+ROWS_PER_FILE = int(os.environ.get('BENCHMARK_ROWS_PER_FILE', '20'))
+
+os.environ.setdefault('POSTGRES_DB_NAME', 'postgres')
+os.environ.setdefault('POSTGRES_USER', 'postgres')
+os.environ.setdefault('POSTGRES_PASSWORD', 'postgres')
+os.environ.setdefault('POSTGRES_HOST', 'localhost')
+os.environ.setdefault('POSTGRES_PORT', '5432')
+os.environ.setdefault('POSTGRES_TABLE_NAME', 'splinter_benchmark')
+os.environ.setdefault('POSTGRES_CONNECT_TIMEOUT', '3')
+os.environ.setdefault('MONGODB_URI', 'mongodb://localhost:27017')
+os.environ.setdefault('MONGODB_DATABASE', 'splinter_benchmark')
+os.environ.setdefault('MONGODB_COLLECTION', 'documents')
+os.environ.setdefault('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '3000')
+
+lambda_dir = os.path.join(os.path.dirname(__file__), '..', 'lambda')
+sys.path.insert(0, os.path.join(lambda_dir, 's3_postgres_lambda'))
+sys.path.insert(0, os.path.join(lambda_dir, 's3_mongodb_lambda'))
+
+
+def filenames_for(label):
+    return [f"{label}-{i:05d}.pdf" for i in range(DELETE_COUNT)]
+
+def time_deletes(label, delete, filenames, reset=None):
+    # reset runs before each delete, outside the timing, to drop the cached client
+    latencies = []
+    for filename in filenames:
+        if reset:
+            reset()
+        start = time.perf_counter()
+        delete([filename])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<28} median {statistics.median(latencies):8.2f} ms  p95 {p95:8.2f} ms")
+
+def quietly(delete):
+    # The delete helpers print per call; keep the output to the summary lines
+    def run(filenames):
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            delete(filenames)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return run
+
+def benchmark_postgres():
+    import psycopg2
+    import postgres_utils
+
+    table_name = os.environ['POSTGRES_TABLE_NAME']
+    try:
+        postgres_utils.run_statement(f"DROP TABLE IF EXISTS {table_name}", None)
+    except psycopg2.OperationalError as e:
+        print(f"Skipping Postgres: {str(e).strip()}")
+        return
+    postgres_utils.run_statement(f"CREATE TABLE {table_name} (id serial PRIMARY KEY, filename text, text text)", None)
+    postgres_utils.run_statement(f"CREATE INDEX ON {table_name} (filename)", None)
+
+    cold, warm = filenames_for('cold'), filenames_for('warm')
+    postgres_utils.run_statement(
+        f"INSERT INTO {table_name} (filename, text) SELECT f, 'chunk' FROM unnest(%s) f, generate_series(1, %s)",
+        (cold + warm, ROWS_PER_FILE),
+    )
+
+    print(f"Postgres: {DELETE_COUNT} deletes of {ROWS_PER_FILE} rows each")
+    delete = quietly(lambda filenames: postgres_utils.delete_from_postgres(table_name, filenames))
+    time_deletes("connection per delete", delete, cold, reset=postgres_utils.close_connection)
+    postgres_utils.get_connection()
+    time_deletes("module-scope connection", delete, warm)
+
+    postgres_utils.run_statement(f"DROP TABLE {table_name}", None)
+    postgres_utils.close_connection()
+
+def benchmark_mongodb():
+    from pymongo.errors import ServerSelectionTimeoutError
+    import mongodb_utils
+
+    try:
+        mongodb_utils.run_operation(lambda collection: collection.drop())
+    except ServerSelectionTimeoutError as e:
+        print(f"Skipping MongoDB: {str(e).split(',')[0]}")
+        return
+    collection = mongodb_utils.get_collection()
+    collection.create_index("metadata.filename")
+
+    cold, warm = filenames_for('cold'), filenames_for('warm')
+    collection.insert_many([
+        {"text": "chunk", "metadata": {"filename": filename}}
+        for filename in cold + warm
+        for _ in range(ROWS_PER_FILE)
+    ])
+
+    print(f"MongoDB: {DELETE_COUNT} deletes of {ROWS_PER_FILE} documents each")
+    delete = quietly(mongodb_utils.delete_from_mongodb)
+    time_deletes("client per delete", delete, cold, reset=mongodb_utils.close_client)
+    mongodb_utils.get_client().admin.command('ping')
+    time_deletes("module-scope client", delete, warm)
+
+    mongodb_utils.run_operation(lambda collection: collection.drop())
+    mongodb_utils.close_client()
+
+def main():
+    benchmark_postgres()
+    benchmark_mongodb()
+
+if __name__ == "__main__":
+    main()
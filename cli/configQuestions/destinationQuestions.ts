@@ -57,6 +57,9 @@ CREATE TABLE ${postgresTableName} (
     regex_metadata TEXT[],
     detection_class_prob FLOAT
 );
+
+-- The filename and embeddings indexes are built by the migration job that runs on deploy, as set by
+-- POSTGRES_VECTOR_INDEX and POSTGRES_VECTOR_OPS (HNSW by default, which needs pgvector 0.5+)
   `;
 
   console.log(
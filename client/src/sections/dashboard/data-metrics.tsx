@@ -12,15 +12,16 @@ import { varAlpha } from 'src/theme/styles';
 type Props = CardProps & {
   title?: string;
   subheader?: string;
-  list: { label: string; total: number }[];
+  list: { label: string; total: number | string }[];
+  columns?: number;
 };
 
-export function DataMetrics({ title, subheader, list, sx, ...other }: Props) {
+export function DataMetrics({ title, subheader, list, columns = 2, sx, ...other }: Props) {
   return (
     <Card sx={sx} {...other}>
       <CardHeader title={title} subheader={subheader} />
 
-      <Box display="grid" gap={2} gridTemplateColumns="repeat(2, 1fr)" sx={{ p: 3 }}>
+      <Box display="grid" gap={2} gridTemplateColumns={`repeat(${columns}, 1fr)`} sx={{ p: 3 }}>
         {list.map((metric) => (
           <Box
             key={metric.label}
@@ -1,7 +1,9 @@
 import type { CardProps } from '@mui/material/Card';
 import type { TimelineItemProps } from '@mui/lab/TimelineItem';
 
+import Box from '@mui/material/Box';
 import Card from '@mui/material/Card';
+import Button from '@mui/material/Button';
 import Timeline from '@mui/lab/Timeline';
 import TimelineDot from '@mui/lab/TimelineDot';
 import Typography from '@mui/material/Typography';
@@ -24,9 +26,20 @@ type Props = CardProps & {
     title: string;
     time: string | number | null;
   }[];
+  hasMore?: boolean;
+  loadingMore?: boolean;
+  onLoadMore?: () => void;
 };
 
-export function EventLogs({ title, subheader, list, ...other }: Props) {
+export function EventLogs({
+  title,
+  subheader,
+  list,
+  hasMore,
+  loadingMore,
+  onLoadMore,
+  ...other
+}: Props) {
   return (
     <Card {...other}>
       <CardHeader title={title} subheader={subheader} />
@@ -45,6 +58,14 @@ export function EventLogs({ title, subheader, list, ...other }: Props) {
           <Item key={item.id} item={item} lastItem={index === list.length - 1} />
         ))}
       </Timeline>
+
+      {hasMore && onLoadMore && (
+        <Box sx={{ px: 3, pb: 3 }}>
+          <Button fullWidth color="inherit" disabled={loadingMore} onClick={onLoadMore}>
+            {loadingMore ? 'Loading...' : 'Load older'}
+          </Button>
+        </Box>
+      )}
     </Card>
   );
 }
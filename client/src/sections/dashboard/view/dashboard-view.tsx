@@ -12,9 +12,12 @@ import { useWebSocket } from './useWebSocket';
 // ----------------------------------------------------------------------
 
 export function DashboardView() {
-  const { data, loading } = useWebSocket();
+  const { data, loading, loadOlderLogs, hasOlderLogs, loadingOlderLogs } = useWebSocket();
 
-  const getLogType = (message: string): string => {
+  const getLogType = ({ message, summary }: { message: string; summary?: { errors: number } }): string => {
+    if (summary) {
+      return summary.errors ? 'type6' : 'type3'; // Hourly summary
+    }
     if (message.includes('ingest process finished in') || message.includes('writing a total')) {
       return 'type1'; // Success
     }
@@ -28,7 +31,12 @@ export function DashboardView() {
     ) {
       return 'type2'; // Partitioning
     }
-    if (message.includes('error') || message.includes('failed')) {
+    if (
+      message.includes('error') ||
+      message.includes('failed') ||
+      message.includes('ERROR') ||
+      message.includes('Exception raised')
+    ) {
       return 'type6'; // Error
     }
     return 'type8'; // Default
@@ -42,7 +50,7 @@ export function DashboardView() {
   const mappedLogs =
     data?.logs?.map((log, index) => ({
       id: `log-${index}`,
-      type: getLogType(log.message),
+      type: getLogType(log),
       title: cleanLogMessage(log.message),
       time: log.timestamp,
     })) ?? [];
@@ -52,6 +60,16 @@ export function DashboardView() {
   const vectorsWritten = data?.vectorsWritten || 0;
   const documentsIngested = data?.documentsIngested || 0;
 
+  const stagePercentiles = data?.stagePercentiles || {};
+  const formatDuration = (ms?: number): string => {
+    if (ms === undefined) {
+      return '-';
+    }
+    return ms < 1000 ? `${ms} ms` : `${(ms / 1000).toFixed(1)} s`;
+  };
+  const stageLatency = (stage: string): string =>
+    `${formatDuration(stagePercentiles[stage]?.p50)} / ${formatDuration(stagePercentiles[stage]?.p95)}`;
+
   const sourceDestinationEmbedding = data?.sourceDestinationEmbedding || '||';
   const [source, destination, embedding] = sourceDestinationEmbedding.split('|');
   const sourceConnector = source || 'Unknown Source';
@@ -142,6 +160,11 @@ export function DashboardView() {
         <Grid xs={12} sm={6} md={6} lg={6}>
           <DataMetrics
             title="Ingestion Progress"
+            subheader={
+              data?.jobStatusCountsReconciled === false
+                ? 'Jobs are counted at the next scheduled reconcile'
+                : undefined
+            }
             list={[
               { label: 'Starting', total: jobStatusCounts.STARTING },
               { label: 'Running', total: jobStatusCounts.RUNNING },
@@ -152,7 +175,27 @@ export function DashboardView() {
         </Grid>
 
         <Grid xs={12} md={12} lg={12}>
-          <EventLogs title="Event Logs" list={mappedLogs} />
+          <DataMetrics
+            title="Stage Latency"
+            subheader="p50 / p95 per document over the last 24 hours"
+            columns={4}
+            list={[
+              { label: 'Partitioning', total: stageLatency('partition') },
+              { label: 'Chunking', total: stageLatency('chunk') },
+              { label: 'Embedding', total: stageLatency('embed') },
+              { label: 'Upload', total: stageLatency('upload') },
+            ]}
+          />
+        </Grid>
+
+        <Grid xs={12} md={12} lg={12}>
+          <EventLogs
+            title="Event Logs"
+            list={mappedLogs}
+            hasMore={hasOlderLogs}
+            loadingMore={loadingOlderLogs}
+            onLoadMore={loadOlderLogs}
+          />
         </Grid>
       </Grid>
     </DashboardContent>
@@ -1,8 +1,20 @@
-import { useState, useEffect } from 'react';
+import { useRef, useState, useEffect, useCallback } from 'react';
+
+interface LogSummary {
+  lines: number;
+  errors: number;
+  ingested: number;
+  deleted: number;
+  partitioned: number;
+  chunked: number;
+  embedded: number;
+  uploaded: number;
+}
 
 interface Log {
   timestamp: number;
   message: string;
+  summary?: LogSummary; // Set on the hourly summaries older lines are compacted into
 }
 
 interface JobStatusCounts {
@@ -14,28 +26,149 @@ interface JobStatusCounts {
   FAILED: number;
 }
 
+interface StagePercentiles {
+  [stage: string]: {
+    p50?: number;
+    p95?: number;
+  };
+}
+
 interface WebSocketData {
   logs: Log[];
   jobStatusCounts: JobStatusCounts;
+  // False until the scheduled reconcile has counted the jobs for the first time
+  jobStatusCountsReconciled: boolean;
   totalVectors: number;
   totalDocuments: number;
   vectorsWritten: number;
   documentsIngested: number;
+  stagePercentiles: StagePercentiles;
   sourceDestinationEmbedding: string;
+  // Cursor for the next older page of logs; null once there is nothing older
+  logsCursor: number | null;
+}
+
+// Live log lines are capped at this many, or at however many the viewer has paged in if that is
+// more. A page that was asked for is never trimmed when it arrives.
+const MAX_LOGS = 500;
+
+const EMPTY_JOB_STATUS_COUNTS: JobStatusCounts = {
+  SUBMITTED: 0,
+  PENDING: 0,
+  STARTING: 0,
+  RUNNING: 0,
+  SUCCEEDED: 0,
+  FAILED: 0,
+};
+
+// Fields a broadcast replaces outright when it carries them. The stage percentiles only come with
+// a snapshot.
+const DELTA_FIELDS = [
+  'totalVectors',
+  'totalDocuments',
+  'vectorsWritten',
+  'documentsIngested',
+  'jobStatusCounts',
+  'jobStatusCountsReconciled',
+  'sourceDestinationEmbedding',
+] as const;
+
+// Broadcasts from concurrent senders can arrive out of order. Frames that arrive ahead of a missing
+// one are held for up to REORDER_WINDOW_MS for it to turn up; only a gap that outlasts the window,
+// or more than REORDER_MAX_HELD frames waiting behind it, triggers a resync.
+const REORDER_WINDOW_MS = 2000;
+const REORDER_MAX_HELD = 50;
+
+// Every message arrives as a frame: {seq?, encoding?, body}. Broadcasts are numbered, and the
+// initial check response carries the number it is current to. Large bodies come gzipped and base64
+// encoded.
+interface Frame {
+  seq?: number;
+  encoding?: 'gzip';
+  body: any;
 }
 
+const decodeFrameBody = async (frame: Frame) => {
+  if (frame.encoding !== 'gzip') {
+    return frame.body;
+  }
+  const bytes = Uint8Array.from(atob(frame.body), (char) => char.charCodeAt(0));
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+  return JSON.parse(await new Response(stream).text());
+};
+
+const updateLogs = (prevLogs: Log[], newLogs: Log[]): Log[] => {
+  const uniqueLogs = [
+    ...prevLogs.filter(
+      (log) =>
+        !newLogs.some(
+          (newLog) => newLog.timestamp === log.timestamp && newLog.message === log.message
+        )
+    ),
+    ...newLogs,
+  ];
+
+  uniqueLogs.sort((a, b) => b.timestamp - a.timestamp);
+  return uniqueLogs;
+};
+
+// The log store keys each line by timestamp * 1000 plus a hash below 1000, so this cursor lists
+// everything older than the line along with its own millisecond (updateLogs drops the repeats)
+const getCursorBefore = (log: Log) => (log.timestamp + 1) * 1000;
+
+// Merges live lines in without letting the list grow past its cap. The oldest lines that drop off
+// are still in the store, so the cursor moves up to them and Load older fetches them again.
+type LogState = Pick<WebSocketData, 'logs' | 'logsCursor'>;
+
+const mergeLiveLogs = <T extends LogState>(prevData: T, newLogs: Log[]): T => {
+  const logs = updateLogs(prevData.logs, newLogs);
+  const limit = Math.max(MAX_LOGS, prevData.logs.length);
+  if (logs.length <= limit) {
+    return { ...prevData, logs };
+  }
+  const keptLogs = logs.slice(0, limit);
+  return { ...prevData, logs: keptLogs, logsCursor: getCursorBefore(keptLogs[limit - 1]) };
+};
+
+// Broadcasts carry only what changed: new log lines and the current value of any counter that moved
+const applyDelta = (prevData: WebSocketData, delta: any): WebSocketData => {
+  let nextData = { ...prevData };
+  if (Array.isArray(delta.logs)) {
+    nextData = mergeLiveLogs(prevData, delta.logs);
+  }
+  DELTA_FIELDS.forEach((field) => {
+    if (delta[field] !== undefined) {
+      (nextData as any)[field] = delta[field];
+    }
+  });
+  return nextData;
+};
+
 export const useWebSocket = () => {
   const [data, setData] = useState<WebSocketData | null>(null);
   const [loading, setLoading] = useState(true);
   const [isConnected, setIsConnected] = useState(false);
+  const [loadingOlderLogs, setLoadingOlderLogs] = useState(false);
+  const websocketRef = useRef<WebSocket | null>(null);
 
   useEffect(() => {
     const websocketUrl = import.meta.env.VITE_WEBHOOK_URL;
     const websocket = new WebSocket(websocketUrl);
+    websocketRef.current = websocket;
 
-    websocket.onopen = () => {
-      setIsConnected(true);
+    // Number of the last broadcast applied; null until a frame sets it
+    let lastSeq: number | null = null;
+    // Broadcasts are held back until a snapshot arrives, both at first and after a gap
+    let awaitingSnapshot = true;
+    let heldFrames: { seq: number; body: any }[] = [];
+    // Broadcasts that arrived ahead of a missing one, by number
+    let pendingFrames = new Map<number, any>();
+    let gapTimer: ReturnType<typeof setTimeout> | null = null;
+    // Decompression is async, so frames are handled one after another to keep them in order
+    let frameQueue = Promise.resolve();
 
+    const requestSnapshot = () => {
+      awaitingSnapshot = true;
       const initialMessage = {
         action: 'initialCheck',
         data: 'Please fetch the current job status and logs.',
@@ -43,83 +176,120 @@ export const useWebSocket = () => {
       websocket.send(JSON.stringify(initialMessage));
     };
 
-    websocket.onmessage = (event) => {
-      try {
-        const parsedData = JSON.parse(event.data);
-        if (parsedData.type === 'initialCheckResponse') {
-          setData({
-            logs: parsedData.logs || [],
-            jobStatusCounts: parsedData.jobStatusCounts || {
-              SUBMITTED: 0,
-              PENDING: 0,
-              STARTING: 0,
-              RUNNING: 0,
-              SUCCEEDED: 0,
-              FAILED: 0,
-            },
-            totalVectors: parsedData.totalVectors || 0,
-            totalDocuments: parsedData.totalDocuments || 0,
-            vectorsWritten: parsedData.vectorsWritten || 0,
-            documentsIngested: parsedData.documentsIngested || 0,
-            sourceDestinationEmbedding: parsedData.sourceArn || '||',
-          });
-
-          setLoading(false);
-        }
-
-        if (Array.isArray(parsedData.logs)) {
-          setData((prevData) => ({
-            ...prevData!,
-            logs: updateLogs(prevData?.logs || [], parsedData.logs),
-          }));
-        }
-
-        if (parsedData.totalVectors !== undefined) {
-          setData((prevData) => ({
-            ...prevData!,
-            totalVectors: parsedData.totalVectors,
-          }));
-        }
-
-        if (parsedData.totalDocuments !== undefined) {
-          setData((prevData) => ({
-            ...prevData!,
-            totalDocuments: parsedData.totalDocuments,
-          }));
-        }
-
-        if (parsedData.vectorsWritten !== undefined) {
-          setData((prevData) => ({
-            ...prevData!,
-            vectorsWritten: parsedData.vectorsWritten,
-          }));
-        }
-
-        if (parsedData.documentsIngested !== undefined) {
-          setData((prevData) => ({
-            ...prevData!,
-            documentsIngested: parsedData.documentsIngested,
-          }));
-        }
-
-        if (parsedData.jobStatusCounts) {
-          setData((prevData) => ({
-            ...prevData!,
-            jobStatusCounts: parsedData.jobStatusCounts,
-          }));
-        }
-
-        if (parsedData.sourceDestinationEmbedding !== undefined) {
-          setData((prevData) => ({
-            ...prevData!,
-            sourceDestinationEmbedding: parsedData.sourceDestinationEmbedding,
-          }));
-        }
-      } catch (error) {
-        console.error('Error parsing WebSocket message:', error);
+    const clearGapTimer = () => {
+      if (gapTimer !== null) {
+        clearTimeout(gapTimer);
+        gapTimer = null;
       }
     };
 
+    const resync = () => {
+      clearGapTimer();
+      console.warn(`Missed broadcast ${(lastSeq ?? 0) + 1}, resyncing`);
+      // The frames already received are replayed on top of the snapshot
+      pendingFrames.forEach((body, seq) => heldFrames.push({ seq, body }));
+      pendingFrames = new Map();
+      requestSnapshot();
+    };
+
+    const handleBroadcast = (seq: number, body: any) => {
+      if (awaitingSnapshot) {
+        heldFrames.push({ seq, body });
+        return;
+      }
+      if (lastSeq === null) {
+        lastSeq = seq;
+        setData((prevData) => prevData && applyDelta(prevData, body));
+        return;
+      }
+      if (seq <= lastSeq) {
+        return; // Already reflected
+      }
+
+      // Apply every frame that now follows on from the last one applied
+      pendingFrames.set(seq, body);
+      while (pendingFrames.has(lastSeq + 1)) {
+        const nextSeq: number = lastSeq + 1;
+        const nextBody = pendingFrames.get(nextSeq);
+        pendingFrames.delete(nextSeq);
+        lastSeq = nextSeq;
+        setData((prevData) => prevData && applyDelta(prevData, nextBody));
+      }
+
+      if (pendingFrames.size === 0) {
+        clearGapTimer();
+      } else if (pendingFrames.size > REORDER_MAX_HELD) {
+        resync();
+      } else if (gapTimer === null) {
+        gapTimer = setTimeout(() => {
+          gapTimer = null;
+          if (!awaitingSnapshot && pendingFrames.size > 0) {
+            resync();
+          }
+        }, REORDER_WINDOW_MS);
+      }
+    };
+
+    const handleSnapshot = (seq: number | undefined, snapshot: any) => {
+      setData((prevData) => ({
+        // After a resync the logs already loaded are kept alongside the fresh page, and so is the
+        // cursor below them
+        ...mergeLiveLogs<LogState>(
+          prevData ?? { logs: [], logsCursor: snapshot.logsCursor ?? null },
+          snapshot.logs || []
+        ),
+        jobStatusCounts: snapshot.jobStatusCounts || EMPTY_JOB_STATUS_COUNTS,
+        jobStatusCountsReconciled: snapshot.jobStatusCountsReconciled ?? true,
+        totalVectors: snapshot.totalVectors || 0,
+        totalDocuments: snapshot.totalDocuments || 0,
+        vectorsWritten: snapshot.vectorsWritten || 0,
+        documentsIngested: snapshot.documentsIngested || 0,
+        stagePercentiles: snapshot.stagePercentiles || {},
+        sourceDestinationEmbedding: snapshot.sourceDestinationEmbedding ?? (snapshot.sourceArn || '||'),
+      }));
+      setLoading(false);
+
+      lastSeq = seq ?? null;
+      awaitingSnapshot = false;
+      const held = heldFrames.sort((a, b) => a.seq - b.seq);
+      heldFrames = [];
+      held.forEach((frame) => handleBroadcast(frame.seq, frame.body));
+    };
+
+    const handleFrame = async (frame: Frame) => {
+      const body = await decodeFrameBody(frame);
+
+      if (body.type === 'initialCheckResponse') {
+        handleSnapshot(frame.seq, body);
+      } else if (body.type === 'logsPage') {
+        // The page is older than everything held, so it is added whole and its cursor taken
+        setData(
+          (prevData) =>
+            prevData && {
+              ...prevData,
+              logs: updateLogs(prevData.logs, body.logs || []),
+              logsCursor: body.logsCursor ?? null,
+            }
+        );
+        setLoadingOlderLogs(false);
+      } else if (frame.seq !== undefined) {
+        handleBroadcast(frame.seq, body);
+      }
+    };
+
+    websocket.onopen = () => {
+      setIsConnected(true);
+      requestSnapshot();
+    };
+
+    websocket.onmessage = (event) => {
+      frameQueue = frameQueue
+        .then(() => handleFrame(JSON.parse(event.data)))
+        .catch((error) => {
+          console.error('Error parsing WebSocket message:', error);
+        });
+    };
+
     websocket.onclose = () => {
       setIsConnected(false);
     };
@@ -129,26 +299,32 @@ export const useWebSocket = () => {
     };
 
     return () => {
+      clearGapTimer();
+      websocketRef.current = null;
       if (websocket.readyState === WebSocket.OPEN) {
         websocket.close();
       }
     };
   }, []);
 
-  const updateLogs = (prevLogs: Log[], newLogs: Log[]): Log[] => {
-    const uniqueLogs = [
-      ...prevLogs.filter(
-        (log) =>
-          !newLogs.some(
-            (newLog) => newLog.timestamp === log.timestamp && newLog.message === log.message
-          )
-      ),
-      ...newLogs,
-    ];
-
-    uniqueLogs.sort((a, b) => b.timestamp - a.timestamp);
-    return uniqueLogs.slice(0, 10);
-  };
+  const logsCursor = data?.logsCursor ?? null;
 
-  return { data, loading, isConnected };
+  const loadOlderLogs = useCallback(() => {
+    const websocket = websocketRef.current;
+    if (logsCursor === null || loadingOlderLogs || websocket?.readyState !== WebSocket.OPEN) {
+      return;
+    }
+
+    setLoadingOlderLogs(true);
+    websocket.send(JSON.stringify({ action: 'fetchLogs', before: logsCursor }));
+  }, [logsCursor, loadingOlderLogs]);
+
+  return {
+    data,
+    loading,
+    isConnected,
+    loadOlderLogs,
+    hasOlderLogs: logsCursor !== null,
+    loadingOlderLogs,
+  };
 };
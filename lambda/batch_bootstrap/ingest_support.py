@@ -0,0 +1,480 @@
+# lambda/batch_bootstrap/ingest_support.py
+#
+# Stage telemetry, the embedding cache, manifest loading, the incremental chunk diff, the manifest
+# driver and the warm worker loop with its reuse of pipeline processes and queue messages, shared by
+# every ingest script; the scripts keep only their destination's pieces and pass them in as callbacks.
+# The stacks publish it under its SHA-256 next to the script, and the Batch bootstrap fetches it into
+# a directory of its own and puts that on sys.path, so the scripts import it like any other module.
+
+import hashlib
+import json
+import os
+import resource
+import sqlite3
+import threading
+import time
+import uuid
+import boto3
+from contextlib import contextmanager
+from pathlib import Path
+from unstructured_ingest.v2.pipeline.pipeline import Pipeline
+from unstructured_ingest.v2.processes.partitioner import Partitioner
+from unstructured_ingest.v2.processes.chunker import Chunker
+from unstructured_ingest.v2.processes.embedder import Embedder, EmbedderConfig
+
+# Stage measurements still open in this process. Every stage resets the kernel's peak RSS mark when
+# it starts, so the peak reached so far is first folded into the stages that enclose it.
+open_stages = []
+
+def read_cpu_seconds():
+    # Reaped children count too, so a pipeline that ran its steps in a process pool is included
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+def read_peak_rss_mb():
+    # VmHWM is the peak since the last reset; without /proc it is the peak since the process started
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def start_stage():
+    peak_rss_mb = read_peak_rss_mb()
+    for stage in open_stages:
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"], peak_rss_mb)
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+    started = {"time": time.time(), "cpu": read_cpu_seconds(), "peak_rss_mb": 0}
+    open_stages.append(started)
+    return started
+
+def emit_telemetry(stage, document, started, elements=None, size=None, **fields):
+    # One compact JSON line per stage result. The dashboard's telemetry consumer subscribes to these
+    # lines alone, aggregates them in a single pass and republishes them as CloudWatch metrics, so
+    # keep the keys stable.
+    for index, open_stage in enumerate(open_stages):
+        if open_stage is started:
+            # Stages opened inside this one that raised before reporting are closed along with it
+            del open_stages[index:]
+            break
+    record = {
+        "telemetry": 1,
+        "stage": stage,
+        "document": document,
+        "duration_ms": int((time.time() - started["time"]) * 1000),
+        "cpu_ms": int((read_cpu_seconds() - started["cpu"]) * 1000),
+        "peak_rss_mb": round(max(started["peak_rss_mb"], read_peak_rss_mb()), 1),
+        "elements": elements,
+        "bytes": size,
+        **fields,
+    }
+    print(json.dumps({key: value for key, value in record.items() if value is not None}, separators=(",", ":")), flush=True)
+
+def instrument_stage(process_class, stage):
+    # Wraps the process's run on the class, so the pipeline's steps report the stage wherever they
+    # call it, worker processes included
+    run = process_class.run
+
+    def measured_run(self, *args, **kwargs):
+        started = start_stage()
+        result = run(self, *args, **kwargs)
+        document, size = describe_stage_input(kwargs, result)
+        emit_telemetry(stage, document, started, elements=count_stage_elements(kwargs, result), size=size)
+        return result
+
+    process_class.run = measured_run
+
+def describe_stage_input(kwargs, result):
+    # Partitioning is handed the downloaded file itself. Chunking and embedding only see an
+    # intermediate JSON file, so their document comes from the elements; uploads carry file data.
+    if kwargs.get("filename"):
+        return Path(kwargs["filename"]).name, os.path.getsize(kwargs["filename"])
+    if isinstance(result, list) and result:
+        first = result[0]
+        return (first["metadata"].get("filename") if isinstance(first, dict) else first.metadata.filename), None
+    file_data = kwargs.get("file_data") or next((content.file_data for content in kwargs.get("contents") or []), None)
+    if file_data is not None and file_data.source_identifiers:
+        return file_data.source_identifiers.filename, None
+    return None, None
+
+def count_stage_elements(kwargs, result):
+    # Partitioning and chunking return their elements. An upload returns nothing, so it counts the
+    # staged elements it was handed; it only reports once they are written, which is what the
+    # dashboard's vector counts go by.
+    if isinstance(result, list):
+        return len(result)
+    paths = [kwargs["path"]] if kwargs.get("path") else [content.path for content in kwargs.get("contents") or []]
+    if not paths:
+        return None
+    return sum(count_staged_elements(path) for path in paths)
+
+def count_staged_elements(path):
+    path = Path(path)
+    with path.open() as staged_file:
+        if path.suffix == ".ndjson":
+            return sum(1 for line in staged_file if line.strip())
+        return len(json.load(staged_file))
+
+def instrument_pipeline(uploader_class):
+    # Every pipeline partitions and chunks with the same steps; only the uploader is its own
+    instrument_stage(Partitioner, "partition")
+    instrument_stage(Chunker, "chunk")
+    instrument_stage(uploader_class, "upload")
+
+# Embedding cache keyed by (provider, model, chunk text hash). Boilerplate, repeated headers and
+# duplicated files embed once: the local SQLite store lives for the container, the DynamoDB store
+# is shared by every job. Set EMBEDDING_CACHE=false to embed everything.
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/tmp/embedding-cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+EMBEDDING_CACHE_TTL_DAYS = int(os.getenv("EMBEDDING_CACHE_TTL_DAYS", "30"))
+# DynamoDB caps BatchGetItem at 100 keys per request
+DYNAMODB_BATCH_GET_SIZE = 100
+
+class SqliteEmbeddingStore:
+    # Bounded to max_entries; the least recently read or written entries are evicted first
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding TEXT, last_used REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def connect(self):
+        # A connection per call keeps the store usable from the pipeline's worker processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, keys):
+        found = {}
+        with self.connect() as connection:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((key, json.loads(embedding)) for key, embedding in rows)
+            connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found]
+            )
+        return found
+
+    def put_many(self, embeddings):
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(embedding), time.time()) for key, embedding in embeddings.items()],
+            )
+            connection.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+class DynamoDBEmbeddingStore:
+    # Bounded by the table's TTL; an entry expires EMBEDDING_CACHE_TTL_DAYS after it was last written
+    def __init__(self, table_name, ttl_days):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.dynamodb = boto3.resource("dynamodb")
+
+    def get_many(self, keys):
+        found = {}
+        for start in range(0, len(keys), DYNAMODB_BATCH_GET_SIZE):
+            request = {self.table_name: {
+                "Keys": [{"CacheKey": key} for key in keys[start:start + DYNAMODB_BATCH_GET_SIZE]],
+                "ProjectionExpression": "CacheKey, Embedding",
+            }}
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self.table_name, []):
+                    found[item["CacheKey"]] = json.loads(item["Embedding"])
+                request = response.get("UnprocessedKeys")
+        return found
+
+    def put_many(self, embeddings):
+        expires_at = int(time.time()) + self.ttl_seconds
+        with self.dynamodb.Table(self.table_name).batch_writer() as batch:
+            for key, embedding in embeddings.items():
+                batch.put_item(Item={"CacheKey": key, "Embedding": json.dumps(embedding), "ExpiresAt": expires_at})
+
+def get_embedding_cache_stores():
+    # Stores are consulted in order; a hit in a later store is copied into the earlier ones
+    if os.getenv("EMBEDDING_CACHE", "true") == "false":
+        return []
+    stores = [SqliteEmbeddingStore(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)]
+    if os.getenv("EMBEDDING_CACHE_TABLE_NAME"):
+        stores.append(DynamoDBEmbeddingStore(os.getenv("EMBEDDING_CACHE_TABLE_NAME"), EMBEDDING_CACHE_TTL_DAYS))
+    return stores
+
+class CachingEmbedder:
+    def __init__(self, embedder, provider, model_name, stores):
+        self.embedder = embedder
+        self.key_prefix = f"{provider}/{model_name}/"
+        self.stores = stores
+
+    def __getattr__(self, name):
+        return getattr(self.embedder, name)
+
+    def embed_documents(self, elements):
+        started = start_stage()
+        # Elements are Element objects or dicts depending on the unstructured_ingest release
+        texts = [element["text"] if isinstance(element, dict) else element.text for element in elements]
+        keys = [self.key_prefix + hashlib.sha256((text or "").encode("utf-8")).hexdigest() for text in texts]
+
+        cached = {}
+        hits_per_store = []
+        for index, store in enumerate(self.stores):
+            missing = [key for key in dict.fromkeys(keys) if key not in cached]
+            if not missing:
+                hits_per_store.append(0)
+                continue
+            try:
+                found = store.get_many(missing)
+            except Exception as e:
+                print(f"Embedding cache read from {type(store).__name__} failed: {e}")
+                found = {}
+            hits_per_store.append(len(found))
+            if found:
+                for earlier_store in self.stores[:index]:
+                    self.put(earlier_store, found)
+            cached.update(found)
+
+        # Repeats of the same text within the batch are embedded once
+        miss_indexes = {}
+        for index, key in enumerate(keys):
+            if key not in cached and key not in miss_indexes:
+                miss_indexes[key] = index
+        if miss_indexes:
+            embedded = self.embedder.embed_documents(elements=[elements[index] for index in miss_indexes.values()])
+            computed = {}
+            for index, element in zip(miss_indexes.values(), embedded):
+                computed[keys[index]] = element["embeddings"] if isinstance(element, dict) else element.embeddings
+            for store in self.stores:
+                self.put(store, computed)
+            cached.update(computed)
+
+        for element, key in zip(elements, keys):
+            if isinstance(element, dict):
+                element["embeddings"] = cached[key]
+            else:
+                element.embeddings = cached[key]
+
+        if self.stores:
+            store_hits = ", ".join(f"{type(store).__name__} {hits}" for store, hits in zip(self.stores, hits_per_store))
+            print(f"Embedding cache: {len(elements) - len(miss_indexes)} hit(s), {len(miss_indexes)} miss(es) ({store_hits})")
+        if elements:
+            first = elements[0]
+            document = first["metadata"].get("filename") if isinstance(first, dict) else first.metadata.filename
+            emit_telemetry("embed", document, started, elements=len(elements), cache_hits=len(elements) - len(miss_indexes))
+        return elements
+
+    def put(self, store, embeddings):
+        try:
+            store.put_many(embeddings)
+        except Exception as e:
+            print(f"Embedding cache write to {type(store).__name__} failed: {e}")
+
+# Encoders already built in this process, so a long-lived worker loads each model once
+loaded_embedders = {}
+
+class CachingEmbedderConfig(EmbedderConfig):
+    def get_embedder(self):
+        embedder_key = (self.embedding_provider, self.embedding_model_name)
+        if embedder_key not in loaded_embedders:
+            # Wrapped even with no cache stores so every batch still reports its telemetry
+            loaded_embedders[embedder_key] = CachingEmbedder(
+                super().get_embedder(), self.embedding_provider, self.embedding_model_name, get_embedding_cache_stores()
+            )
+        return loaded_embedders[embedder_key]
+
+# Partitioners and chunkers already built in this process, keyed by their settings, so a long-lived
+# worker builds each once instead of once per object
+loaded_processes = {}
+
+def get_process(process_class, config):
+    process_key = (process_class, repr(config))
+    if process_key not in loaded_processes:
+        loaded_processes[process_key] = process_class(config=config)
+    return loaded_processes[process_key]
+
+def build_pipeline(pipeline_configs):
+    # Pipeline.from_configs builds a new partitioner and chunker on every call. The warm workers run
+    # the steps in this process (INGEST_DISABLE_PARALLELISM), so the steps can share this
+    # process's own instead.
+    pipeline = Pipeline.from_configs(**pipeline_configs)
+    pipeline.partitioner_step.process = get_process(Partitioner, pipeline_configs["partitioner_config"])
+    if pipeline.chunker_step:
+        pipeline.chunker_step.process = get_process(Chunker, pipeline_configs["chunker_config"])
+    return pipeline
+
+# A worker keeps the message it is processing hidden from the other workers by pushing its
+# visibility timeout out every heartbeat, however long the manifest takes to ingest
+VISIBILITY_HEARTBEAT_SECONDS = int(os.getenv("INGEST_WORKER_HEARTBEAT_SECONDS", "300"))
+VISIBILITY_EXTENSION_SECONDS = int(os.getenv("INGEST_WORKER_VISIBILITY_SECONDS", "900"))
+
+@contextmanager
+def visibility_heartbeat(sqs, queue_url, receipt_handle):
+    stopped = threading.Event()
+
+    def extend_visibility():
+        while not stopped.wait(VISIBILITY_HEARTBEAT_SECONDS):
+            try:
+                sqs.change_message_visibility(
+                    QueueUrl=queue_url, ReceiptHandle=receipt_handle, VisibilityTimeout=VISIBILITY_EXTENSION_SECONDS
+                )
+            except Exception as e:
+                print(f"Failed to extend the message's visibility: {e}")
+
+    thread = threading.Thread(target=extend_visibility, name="visibility-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+def load_manifest(fallback):
+    # Array jobs fetch their own shard of the manifest from S3; otherwise the job's manifest is
+    # whatever fallback returns
+    manifest_prefix = os.getenv("MANIFEST_S3_PREFIX")
+    if manifest_prefix:
+        bucket_name, key_prefix = manifest_prefix[len("s3://"):].split("/", 1)
+        array_index = os.getenv("AWS_BATCH_JOB_ARRAY_INDEX", "0")
+        response = boto3.client("s3").get_object(Bucket=bucket_name, Key=f"{key_prefix}{array_index}.json")
+        return json.loads(response["Body"].read())
+
+    return fallback()
+
+def download_object(s3_url):
+    bucket_name, key = s3_url[len("s3://"):].split("/", 1)
+    download_path = os.path.join(os.getenv("LOCAL_FILE_DOWNLOAD_DIR") or "/tmp/", os.path.basename(key))
+    boto3.client("s3").download_file(bucket_name, key, download_path)
+    return download_path
+
+def as_dicts(elements):
+    # Depending on the unstructured_ingest release, stages return Element objects or dicts
+    return [element if isinstance(element, dict) else element.to_dict() for element in elements]
+
+def write_elements(elements, path):
+    with open(path, "w") as elements_file:
+        json.dump(elements, elements_file)
+    return Path(path)
+
+def get_chunk_ids(filename, elements, id_prefix=""):
+    # IDs are derived from the chunk text, so a chunk that survives an edit keeps its ID.
+    # Repeated identical chunks are told apart by how often the text has appeared before.
+    occurrences = {}
+    chunk_ids = []
+    for element in elements:
+        digest = hashlib.sha256(element["text"].encode("utf-8")).hexdigest()
+        occurrence = occurrences.get(digest, 0)
+        occurrences[digest] = occurrence + 1
+        chunk_ids.append(id_prefix + str(uuid.uuid5(uuid.NAMESPACE_URL, f"{filename}/{digest}/{occurrence}")))
+    return chunk_ids
+
+def ingest_incrementally(s3_url, pipeline_configs, list_chunk_ids, upload_chunks, delete_chunks, id_prefix=""):
+    # Partition and chunk the object with the pipeline's own stages, then embed and upload only the
+    # chunks the destination doesn't already hold for this file and delete the ones that vanished.
+    # The destination is reached through list_chunk_ids(s3_url), upload_chunks(s3_url, chunks) with
+    # (chunk ID, element) pairs and delete_chunks(s3_url, chunk_ids); every chunk ID starts with
+    # id_prefix. Returns whether the file is new to the destination.
+    filename = s3_url.split("/")[-1]
+    download_path = download_object(s3_url)
+
+    elements = as_dicts(get_process(Partitioner, pipeline_configs["partitioner_config"]).run(filename=Path(download_path)))
+    if "chunker_config" in pipeline_configs:
+        elements = as_dicts(get_process(Chunker, pipeline_configs["chunker_config"]).run(
+            elements_filepath=write_elements(elements, f"{download_path}.elements.json")
+        ))
+
+    chunks = dict(zip(get_chunk_ids(filename, elements, id_prefix), elements))
+    existing_ids = list_chunk_ids(s3_url)
+    new_ids = [chunk_id for chunk_id in chunks if chunk_id not in existing_ids]
+    vanished_ids = [chunk_id for chunk_id in existing_ids if chunk_id not in chunks]
+
+    if new_ids:
+        embedded_chunks = as_dicts(Embedder(config=pipeline_configs["embedder_config"]).run(
+            elements_filepath=write_elements([chunks[chunk_id] for chunk_id in new_ids], f"{download_path}.chunks.json")
+        ))
+        started = start_stage()
+        upload_chunks(s3_url, list(zip(new_ids, embedded_chunks)))
+        emit_telemetry("upload", filename, started, elements=len(new_ids))
+    # Deleting after the upload means the file is never missing from the destination
+    if vanished_ids:
+        started = start_stage()
+        delete_chunks(s3_url, vanished_ids)
+        # whole_document marks a file that no longer has any chunks
+        emit_telemetry("delete", filename, started, elements=len(vanished_ids), whole_document=not chunks)
+
+    print(f"{filename}: embedded {len(new_ids)} new chunk(s), kept {len(chunks) - len(new_ids)}, deleted {len(vanished_ids)}.")
+    return bool(chunks) and not existing_ids
+
+def ingest_manifest(urls, ingest_object, stage="ingest"):
+    # Run a pipeline per object in this one container so the image pull, imports and model loads
+    # are paid once per manifest instead of per file. ingest_object(url) ingests one object into
+    # the script's destination and returns whether the file is new to it; with stage="delete" it
+    # drops the object's records instead and what it returns isn't reported. Returns the URLs that
+    # failed.
+    failed_urls = []
+
+    for url in urls:
+        started = start_stage()
+        try:
+            result = ingest_object(url)
+            new_document = result if stage == "ingest" else None
+            emit_telemetry(stage, url.split("/")[-1], started, status="succeeded", new_document=new_document)
+        except Exception as e:
+            print(f"Exception raised in the {stage} stage for {url}: {e}")
+            failed_urls.append(url)
+            emit_telemetry(stage, url.split("/")[-1], started, status="failed")
+
+    print(f"{stage.capitalize()} succeeded for {len(urls) - len(failed_urls)} of {len(urls)} object(s) from manifest.")
+    return failed_urls
+
+def forget_ingests(s3_urls):
+    # Drop the ingest records of objects that never made it so the next upload or backfill retries them
+    table_name = os.getenv("INGEST_RECORD_TABLE_NAME")
+    if not table_name:
+        return
+    with boto3.resource("dynamodb").Table(table_name).batch_writer() as batch:
+        for s3_url in s3_urls:
+            batch.delete_item(Key={"SourcePath": s3_url})
+
+def run_worker(queue_url, ingest_object):
+    # Long-lived mode: keep taking manifests off the queue so the imports, the partitioner and chunker
+    # and the embedder's model are set up once for the life of the container
+    sqs = boto3.client("sqs")
+    max_attempts = int(os.getenv("INGEST_WORKER_MAX_ATTEMPTS", "3"))
+    print(f"Ingest worker polling {queue_url}")
+
+    while True:
+        response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=20)
+        for message in response.get("Messages", []):
+            body = json.loads(message["Body"])
+            attempt = body.get("attempt", 1)
+            print(f"Processing {len(body['s3_urls'])} object(s) for {body['job_id']} (attempt {attempt})")
+            # A 25-file manifest can take longer to ingest than the queue's visibility timeout
+            with visibility_heartbeat(sqs, queue_url, message["ReceiptHandle"]):
+                failed_urls = ingest_manifest(body["s3_urls"], ingest_object)
+
+            # Retry only the objects that failed, so the ones that made it aren't ingested twice
+            if failed_urls and attempt < max_attempts:
+                sqs.send_message(
+                    QueueUrl=queue_url,
+                    MessageBody=json.dumps({**body, "s3_urls": failed_urls, "attempt": attempt + 1}),
+                    DelaySeconds=60,
+                )
+            elif failed_urls:
+                print(f"Giving up on {len(failed_urls)} object(s) for {body['job_id']}")
+                forget_ingests(failed_urls)
+            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
@@ -0,0 +1,57 @@
+# lambda/batch_bootstrap/script_bootstrap.py
+#
+# Set as APP_SCRIPT on the Batch job definitions. Fetches the content-addressed ingest script
+# named by INGEST_SCRIPT_S3_URI, checks it against INGEST_SCRIPT_SHA256 and runs it. The shared
+# ingest_support module named by INGEST_SUPPORT_S3_URI and INGEST_SUPPORT_SHA256 is fetched the
+# same way into a directory of its own, which goes on sys.path so the script can import it, and so
+# is the destination helper module the Lambdas use too (DESTINATION_UTILS_MODULE, with
+# DESTINATION_UTILS_S3_URI and DESTINATION_UTILS_SHA256) on stacks that publish one. Files already
+# in the cache under the same digest are used without downloading them again.
+
+import hashlib
+import os
+import runpy
+import sys
+import boto3
+
+cache_dir = os.environ.get('INGEST_SCRIPT_CACHE_DIR', '/tmp/ingest-scripts')
+
+
+def fetch_artifact(uri, digest, path):
+    if os.path.exists(path):
+        print(f"Using cached {path}")
+        return
+
+    bucket_name, key = uri[len('s3://'):].split('/', 1)
+    body = boto3.client('s3').get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
+    actual_digest = hashlib.sha256(body).hexdigest()
+    if actual_digest != digest:
+        raise Exception(f"Digest mismatch for {uri}: expected {digest}, got {actual_digest}")
+
+    # Write to a temporary name first so a partially written file is never run
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as artifact_file:
+        artifact_file.write(body)
+    os.replace(temp_path, path)
+    print(f"Fetched {uri}")
+
+
+support_digest = os.environ['INGEST_SUPPORT_SHA256']
+support_dir = os.path.join(cache_dir, support_digest)
+fetch_artifact(os.environ['INGEST_SUPPORT_S3_URI'], support_digest, os.path.join(support_dir, 'ingest_support.py'))
+sys.path.insert(0, support_dir)
+
+utils_digest = os.environ.get('DESTINATION_UTILS_SHA256')
+if utils_digest:
+    utils_dir = os.path.join(cache_dir, utils_digest)
+    utils_path = os.path.join(utils_dir, f"{os.environ['DESTINATION_UTILS_MODULE']}.py")
+    fetch_artifact(os.environ['DESTINATION_UTILS_S3_URI'], utils_digest, utils_path)
+    sys.path.insert(0, utils_dir)
+
+script_digest = os.environ['INGEST_SCRIPT_SHA256']
+script_path = os.path.join(cache_dir, f"{script_digest}.py")
+fetch_artifact(os.environ['INGEST_SCRIPT_S3_URI'], script_digest, script_path)
+
+runpy.run_path(script_path, run_name='__main__')
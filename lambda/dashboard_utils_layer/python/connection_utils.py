@@ -0,0 +1,103 @@
+# lambda/dashboard_utils_layer/python/connection_utils.py
+
+import base64
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+
+# Every dashboard connection is made as this client; the counters and logs are kept under it too
+DASHBOARD_CLIENT_ID = 'user'
+# Connections are found by client through this index rather than by scanning the table
+CLIENT_CONNECTIONS_INDEX = 'ClientConnectionsIndex'
+
+# Posts go out from a thread pool, so a broadcast takes about as long as the slowest post rather
+# than the sum of them. The management API client needs a connection per thread to match.
+BROADCAST_MAX_WORKERS = int(os.environ.get('BROADCAST_MAX_WORKERS', '64'))
+MANAGEMENT_API_CONFIG = Config(max_pool_connections=BROADCAST_MAX_WORKERS)
+
+# Every broadcast is framed as {"seq": n, "body": <delta>}, numbered per client from a counter item
+# kept in the connection table (it has no clientId, so it stays out of the index). Concurrent
+# broadcasters take their numbers before posting, so frames can reach a viewer out of order; it
+# holds the early ones briefly and only asks for a fresh snapshot, which carries the number it is
+# current to, if the missing frame doesn't turn up. Bodies of at least FRAME_COMPRESS_MIN_BYTES are sent gzipped and base64
+# encoded as {"encoding": "gzip", "body": "..."} when that comes out smaller.
+FRAME_COMPRESS_MIN_BYTES = int(os.environ.get('FRAME_COMPRESS_MIN_BYTES', '8192'))
+
+
+def get_sequence_key(client_id):
+    return {'connectionId': f'sequence#{client_id}', 'timestamp': 0}
+
+def get_sequence(connection_table, client_id=DASHBOARD_CLIENT_ID):
+    response = connection_table.get_item(Key=get_sequence_key(client_id), ConsistentRead=True)
+    return int(response.get('Item', {}).get('seq', 0))
+
+def next_sequence(connection_table, client_id=DASHBOARD_CLIENT_ID):
+    response = connection_table.update_item(
+        Key=get_sequence_key(client_id),
+        UpdateExpression='ADD seq :one',
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='UPDATED_NEW',
+    )
+    return int(response['Attributes']['seq'])
+
+def encode_frame(body, seq=None):
+    frame = {} if seq is None else {'seq': seq}
+    data = json.dumps(body, separators=(',', ':'))
+    if len(data) >= FRAME_COMPRESS_MIN_BYTES:
+        compressed = base64.b64encode(gzip.compress(data.encode('utf-8'))).decode('ascii')
+        if len(compressed) < len(data):
+            return json.dumps({**frame, 'encoding': 'gzip', 'body': compressed}, separators=(',', ':'))
+    return json.dumps({**frame, 'body': body}, separators=(',', ':'))
+
+
+def get_connections(connection_table, client_id=DASHBOARD_CLIENT_ID):
+    connections = []
+    query = {
+        'IndexName': CLIENT_CONNECTIONS_INDEX,
+        'KeyConditionExpression': Key('clientId').eq(client_id),
+        'ProjectionExpression': 'connectionId, #timestamp',
+        'ExpressionAttributeNames': {'#timestamp': 'timestamp'},
+    }
+    while True:
+        response = connection_table.query(**query)
+        connections.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return connections
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def broadcast(connection_table, apigateway_management_api, message, client_id=DASHBOARD_CLIENT_ID):
+    # Posts the message, the fields that changed, as the client's next frame to every live
+    # connection of it and drops the ones that are gone. Returns how many connections received it.
+    connections = get_connections(connection_table, client_id)
+    if not connections:
+        print("No connections to broadcast to.")
+        return 0
+
+    data = encode_frame(message, next_sequence(connection_table, client_id))
+
+    def post(connection):
+        try:
+            apigateway_management_api.post_to_connection(ConnectionId=connection['connectionId'], Data=data)
+            return 'posted'
+        except apigateway_management_api.exceptions.GoneException:
+            return 'gone'
+        except Exception as e:
+            # One failing viewer shouldn't keep the message from the rest
+            print(f"Error posting to connection {connection['connectionId']}: {str(e)}")
+            return 'failed'
+
+    with ThreadPoolExecutor(max_workers=min(BROADCAST_MAX_WORKERS, len(connections))) as executor:
+        results = list(executor.map(post, connections))
+
+    gone = [connection for connection, result in zip(connections, results) if result == 'gone']
+    if gone:
+        # Connections whose disconnect was never handled
+        with connection_table.batch_writer() as batch:
+            for connection in gone:
+                batch.delete_item(Key={'connectionId': connection['connectionId'], 'timestamp': connection['timestamp']})
+        print(f"Pruned {len(gone)} stale connection(s).")
+
+    return results.count('posted')
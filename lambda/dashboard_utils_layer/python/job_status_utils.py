@@ -0,0 +1,135 @@
+# lambda/dashboard_utils_layer/python/job_status_utils.py
+
+import os
+import time
+from decimal import Decimal
+import boto3
+
+batch_client = boto3.client('batch')
+dynamodb_client = boto3.client('dynamodb')
+dynamodb = boto3.resource('dynamodb')
+
+job_status_table = dynamodb.Table(os.environ['JOB_STATUS_TABLE_NAME'])
+client_data_table = dynamodb.Table(os.environ['CLIENT_DATA_TABLE_NAME'])
+
+JOB_QUEUE_ARN = os.environ['JOB_QUEUE']
+
+# The per-status counts live in one item of the client data table. Each Batch state change moves
+# one job between two counters in a transaction with the job's own item, which remembers the
+# status it was counted under; a scheduled reconcile resets everything from list_jobs.
+JOB_STATUS_COUNTS_KEY = {'clientId': 'job_status_counts', 'timestamp': 0}
+JOB_STATUSES = ['SUBMITTED', 'STARTING', 'PENDING', 'RUNNING', 'SUCCEEDED', 'FAILED']
+# Events are applied in (event time, rank) order, so a duplicate or late event can't move a job
+# backwards. RUNNABLE isn't delivered by the event rule, so it is counted as PENDING.
+JOB_STATUS_RANKS = {'SUBMITTED': 0, 'PENDING': 1, 'RUNNABLE': 1, 'STARTING': 2, 'RUNNING': 3, 'SUCCEEDED': 4, 'FAILED': 4}
+JOB_RECORD_TTL_SECONDS = 7 * 24 * 60 * 60
+MAX_TRANSITION_ATTEMPTS = 3
+
+
+def to_int(value):
+    return int(value) if isinstance(value, Decimal) else (value or 0)
+
+def get_event_key(event_time, status):
+    return f"{event_time}|{JOB_STATUS_RANKS[status]}"
+
+def is_counted_event(detail):
+    # Only this pipeline's queue, and array children are counted through their parent job
+    return detail.get('jobQueue') == JOB_QUEUE_ARN and ':' not in detail.get('jobId', '')
+
+def record_job_transition(job_id, status, event_time):
+    # Returns whether the counts changed
+    status = 'PENDING' if status == 'RUNNABLE' else status
+    event_key = get_event_key(event_time, status)
+
+    for _ in range(MAX_TRANSITION_ATTEMPTS):
+        job = job_status_table.get_item(Key={'jobId': job_id}, ConsistentRead=True).get('Item')
+        if job and job['lastEventKey'] >= event_key:
+            print(f"Ignoring stale {status} event for job {job_id}")
+            return False
+        previous_status = job['jobStatus'] if job else None
+
+        job_update = {
+            'TableName': job_status_table.name,
+            'Key': {'jobId': {'S': job_id}},
+            'UpdateExpression': 'SET jobStatus = :status, lastEventKey = :event_key, ExpiresAt = :expires_at',
+            'ExpressionAttributeValues': {
+                ':status': {'S': status},
+                ':event_key': {'S': event_key},
+                ':expires_at': {'N': str(int(time.time()) + JOB_RECORD_TTL_SECONDS)},
+            },
+        }
+        # The transaction only goes through if nothing moved the job since it was read
+        if job:
+            job_update['ConditionExpression'] = 'lastEventKey = :seen_event_key'
+            job_update['ExpressionAttributeValues'][':seen_event_key'] = {'S': job['lastEventKey']}
+        else:
+            job_update['ConditionExpression'] = 'attribute_not_exists(jobId)'
+        transaction = [{'Update': job_update}]
+
+        if previous_status != status:
+            counts_update = {
+                'TableName': client_data_table.name,
+                'Key': {'clientId': {'S': JOB_STATUS_COUNTS_KEY['clientId']}, 'timestamp': {'N': '0'}},
+                'UpdateExpression': 'ADD #status :one',
+                'ExpressionAttributeNames': {'#status': status},
+                'ExpressionAttributeValues': {':one': {'N': '1'}},
+            }
+            if previous_status:
+                counts_update['UpdateExpression'] += ', #previous_status :minus_one'
+                counts_update['ExpressionAttributeNames']['#previous_status'] = previous_status
+                counts_update['ExpressionAttributeValues'][':minus_one'] = {'N': '-1'}
+            transaction.append({'Update': counts_update})
+
+        try:
+            dynamodb_client.transact_write_items(TransactItems=transaction)
+            return previous_status != status
+        except dynamodb_client.exceptions.TransactionCanceledException:
+            # Another event for the same job got in first; read it again and retry
+            continue
+
+    print(f"Gave up applying {status} event for job {job_id}; the next reconcile will correct the counts")
+    return False
+
+def get_job_status_counts():
+    # Returns None until the counts have been reconciled once, as until then they don't include the
+    # jobs from before counting began. The reconcile pages through list_jobs for every status, which
+    # is too slow for a request, so the stack runs the first one on deploy and the rest on a
+    # schedule; each broadcasts the counts when done.
+    item = client_data_table.get_item(Key=JOB_STATUS_COUNTS_KEY, ConsistentRead=True).get('Item')
+    if not item or 'ReconciledAt' not in item:
+        return None
+    return {status: max(to_int(item.get(status)), 0) for status in JOB_STATUSES}
+
+def reconcile_job_status_counts():
+    counts = {status: 0 for status in JOB_STATUSES}
+    event_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    expires_at = int(time.time()) + JOB_RECORD_TTL_SECONDS
+
+    with job_status_table.batch_writer() as batch:
+        for listed_status in JOB_STATUSES + ['RUNNABLE']:
+            status = 'PENDING' if listed_status == 'RUNNABLE' else listed_status
+            params = {'jobQueue': JOB_QUEUE_ARN, 'jobStatus': listed_status, 'maxResults': 100}
+            while True:
+                response = batch_client.list_jobs(**params)
+                jobs = response.get('jobSummaryList', [])
+                counts[status] += len(jobs)
+                # Jobs that can still change are remembered, so their next event moves the right counter
+                if JOB_STATUS_RANKS[status] < JOB_STATUS_RANKS['SUCCEEDED']:
+                    for job in jobs:
+                        batch.put_item(Item={
+                            'jobId': job['jobId'],
+                            'jobStatus': status,
+                            'lastEventKey': get_event_key(event_time, status),
+                            'ExpiresAt': expires_at,
+                        })
+                if not response.get('nextToken'):
+                    break
+                params['nextToken'] = response['nextToken']
+
+    client_data_table.put_item(Item={
+        **JOB_STATUS_COUNTS_KEY,
+        **counts,
+        'ReconciledAt': int(time.time() * 1000),
+    })
+    print(f"Reconciled job status counts: {counts}")
+    return counts
@@ -1,24 +1,27 @@
 from dotenv import load_dotenv
 import os
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
+import sys
 from unstructured_ingest.v2.interfaces import ProcessorConfig
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 from unstructured_ingest.v2.processes.connectors.fsspec.dropbox import (
     DropboxIndexerConfig, DropboxDownloaderConfig, DropboxAccessConfig, DropboxConnectionConfig
 )
 from unstructured_ingest.v2.processes.connectors.mongodb import (
-    MongoDBAccessConfig, MongoDBConnectionConfig, MongoDBUploadStagerConfig, MongoDBUploaderConfig
+    MongoDBAccessConfig, MongoDBConnectionConfig, MongoDBUploadStagerConfig, MongoDBUploaderConfig, MongoDBUploader
 )
 from unstructured_ingest.v2.processes.chunker import ChunkerConfig
-from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+from ingest_support import CachingEmbedderConfig, build_pipeline, ingest_manifest, instrument_pipeline, load_manifest
+from mongodb_utils import delete_from_mongodb, ensure_indexes
 
 load_dotenv()
 
-if __name__ == "__main__":
+instrument_pipeline(MongoDBUploader)
+
+def build_pipeline_configs(remote_url):
     # Prepare the configuration dictionary
     pipeline_configs = {
         "context": ProcessorConfig(),
-        "indexer_config": DropboxIndexerConfig(remote_url=os.getenv("DROPBOX_REMOTE_URL")),
+        "indexer_config": DropboxIndexerConfig(remote_url=remote_url),
         "downloader_config": DropboxDownloaderConfig(download_dir=os.getenv("LOCAL_FILE_DOWNLOAD_DIR")),
         "source_connection_config": DropboxConnectionConfig(
             access_config=DropboxAccessConfig(
@@ -28,7 +31,7 @@ if __name__ == "__main__":
         "partitioner_config": PartitionerConfig(
             partition_by_api=False,
         ),
-        "embedder_config": EmbedderConfig(
+        "embedder_config": CachingEmbedderConfig(
             embedding_provider=os.getenv("EMBEDDING_PROVIDER"),
             embedding_model_name=os.getenv("EMBEDDING_MODEL_NAME"),
             embedding_api_key=os.getenv("EMBEDDING_PROVIDER_API_KEY"),
@@ -52,5 +55,35 @@ if __name__ == "__main__":
             chunk_overlap=20
         )
 
+    return pipeline_configs
+
+def delete_document(remote_url):
+    # Returns how many records were deleted
+    return delete_from_mongodb([remote_url.split("/")[-1]])
+
+def ingest_object(remote_url):
+    # Returns whether the file is new to the destination
+    if remote_url == os.getenv("DROPBOX_REMOTE_URL"):
+        # The whole-folder fallback has no single file to clear or count
+        build_pipeline(build_pipeline_configs(remote_url)).run()
+        return None
+    # A modified file is re-ingested whole, so clear the records of its previous version first
+    deleted = delete_document(remote_url)
+    build_pipeline(build_pipeline_configs(remote_url)).run()
+    return not deleted
+
+if __name__ == "__main__":
+    # Run a pipeline per Dropbox path in this shard, all inside this one container.
+    # INGEST_MODE=delete drops the records for each path instead of ingesting it.
+    # INGEST_MODE=migrate only builds the destination indexes.
+    if os.getenv("INGEST_MODE") == "migrate":
+        ensure_indexes()
+        sys.exit(0)
 
-    Pipeline.from_configs(**pipeline_configs).run()
+    remote_urls = load_manifest(lambda: [os.getenv("DROPBOX_REMOTE_URL")])
+    if os.getenv("INGEST_MODE") == "delete":
+        failed_urls = ingest_manifest(remote_urls, delete_document, stage="delete")
+    else:
+        failed_urls = ingest_manifest(remote_urls, ingest_object)
+    if failed_urls:
+        sys.exit(1)
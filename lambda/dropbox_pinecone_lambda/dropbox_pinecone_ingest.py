@@ -1,24 +1,30 @@
 from dotenv import load_dotenv
 import os
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
+import sys
+from pinecone import Pinecone
 from unstructured_ingest.v2.interfaces import ProcessorConfig
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 from unstructured_ingest.v2.processes.connectors.fsspec.dropbox import (
     DropboxIndexerConfig, DropboxDownloaderConfig, DropboxAccessConfig, DropboxConnectionConfig
 )
 from unstructured_ingest.v2.processes.connectors.pinecone import (
-    PineconeConnectionConfig, PineconeAccessConfig, PineconeUploaderConfig, PineconeUploadStagerConfig
+    PineconeConnectionConfig, PineconeAccessConfig, PineconeUploaderConfig, PineconeUploadStagerConfig, PineconeUploader
 )
 from unstructured_ingest.v2.processes.chunker import ChunkerConfig
-from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+from ingest_support import CachingEmbedderConfig, build_pipeline, ingest_manifest, instrument_pipeline, load_manifest
 
 load_dotenv()
 
-if __name__ == "__main__":
+instrument_pipeline(PineconeUploader)
+
+def build_pipeline_configs(remote_url):
+    # One namespace per file, as in the S3 pipeline, so a file's vectors can be replaced or dropped together
+    namespace = remote_url.split("/")[-1]
+
     # Prepare the configuration dictionary
     pipeline_configs = {
         "context": ProcessorConfig(),
-        "indexer_config": DropboxIndexerConfig(remote_url=os.getenv("DROPBOX_REMOTE_URL")),
+        "indexer_config": DropboxIndexerConfig(remote_url=remote_url),
         "downloader_config": DropboxDownloaderConfig(download_dir=os.getenv("LOCAL_FILE_DOWNLOAD_DIR")),
         "source_connection_config": DropboxConnectionConfig(
             access_config=DropboxAccessConfig(
@@ -28,7 +34,7 @@ if __name__ == "__main__":
         "partitioner_config": PartitionerConfig(
             partition_by_api=False,
         ),
-        "embedder_config": EmbedderConfig(
+        "embedder_config": CachingEmbedderConfig(
             embedding_provider=os.getenv("EMBEDDING_PROVIDER"),
             embedding_model_name=os.getenv("EMBEDDING_MODEL_NAME"),
             embedding_api_key=os.getenv("EMBEDDING_PROVIDER_API_KEY"),
@@ -40,7 +46,9 @@ if __name__ == "__main__":
             index_name=os.getenv("PINECONE_INDEX_NAME")
         ),
         "stager_config": PineconeUploadStagerConfig(),
-        "uploader_config": PineconeUploaderConfig()
+        "uploader_config": PineconeUploaderConfig(
+            namespace=namespace
+        )
     }
 
     # Conditionally add chunker_config
@@ -51,5 +59,48 @@ if __name__ == "__main__":
             chunk_overlap=20
         )
 
-    # Run the pipeline with the configured arguments
-    Pipeline.from_configs(**pipeline_configs).run()
+    return pipeline_configs
+
+def clear_namespace(namespace):
+    # Returns whether the namespace held any vectors
+    index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(os.getenv("PINECONE_INDEX_NAME"))
+
+    if namespace not in index.describe_index_stats().namespaces:
+        print(f"No vectors found in the namespace '{namespace}'.")
+        return False
+
+    index.delete(delete_all=True, namespace=namespace)
+    print(f"Deleted all vectors in the namespace '{namespace}'.")
+    return True
+
+def delete_document(remote_url):
+    # Each file's vectors live in a namespace named after the file, so dropping it removes them all
+    return clear_namespace(remote_url.split("/")[-1])
+
+def ingest_object(remote_url):
+    # Returns whether the file is new to the destination
+    if remote_url == os.getenv("DROPBOX_REMOTE_URL"):
+        # The whole-folder fallback has no single file to clear or count
+        build_pipeline(build_pipeline_configs(remote_url)).run()
+        return None
+    # A modified file is re-ingested whole, so clear the records of its previous version first
+    deleted = delete_document(remote_url)
+    build_pipeline(build_pipeline_configs(remote_url)).run()
+    return not deleted
+
+if __name__ == "__main__":
+    # Run a pipeline per Dropbox path in this shard, all inside this one container.
+    # INGEST_MODE=delete drops the records for each path instead of ingesting it.
+    # INGEST_MODE=clear-default-namespace drops the vectors pre-namespace deployments kept in the
+    # default namespace; the webhook submits it once a full listing's jobs have all succeeded.
+    if os.getenv("INGEST_MODE") == "clear-default-namespace":
+        clear_namespace("")
+        sys.exit(0)
+
+    remote_urls = load_manifest(lambda: [os.getenv("DROPBOX_REMOTE_URL")])
+    if os.getenv("INGEST_MODE") == "delete":
+        failed_urls = ingest_manifest(remote_urls, delete_document, stage="delete")
+    else:
+        failed_urls = ingest_manifest(remote_urls, ingest_object)
+    if failed_urls:
+        sys.exit(1)
@@ -1,20 +1,24 @@
+import hashlib
 import json
 import logging
 import requests
 import time
-import boto3
 import uuid
+import boto3
 import os
+from manifest_utils import batch_client, bundle_manifests, submit_manifests
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# initialize the Batch client and DynamoDb clients
+# initialize the DynamoDb and SQS clients; the Batch client is shared with manifest_utils
 dynamodb = boto3.client('dynamodb')
-batch_client = boto3.client('batch')
+sqs = boto3.client('sqs')
 
-with open('dropbox_pinecone_ingest.py', 'r') as script_file:
-    app_script = script_file.read()
+# Notifications arriving within this many seconds of each other are collapsed into one sync
+SYNC_COALESCE_SECONDS = int(os.environ.get('SYNC_COALESCE_SECONDS', '30'))
+# A sync lease left behind by a crashed run is released after this long
+SYNC_LEASE_SECONDS = int(os.environ.get('SYNC_LEASE_SECONDS', '360'))
 
 def get_token_data():
     table_name = os.environ['DYNAMODB_TABLE_NAME']
@@ -41,21 +45,76 @@ def save_token_data(access_token, expiry_time):
         }
     )
 
-def list_folder_contents(access_token):
-    # List contents of the Dropbox app folder.
-    url = "https://api.dropboxapi.com/2/files/list_folder"
+def get_cursor():
+    # The cursor is only valid for the folder it was issued for, so a changed
+    # DROPBOX_REMOTE_URL starts again from a full listing
+    table_name = os.environ['DYNAMODB_TABLE_NAME']
+    response = dynamodb.get_item(
+        TableName=table_name,
+        Key={'TokenID': {'S': 'dropbox_cursor'}}
+    )
+    if 'Item' in response and response['Item']['FolderPath']['S'] == get_remote_folder_path():
+        return response['Item']['Cursor']['S']
+    else:
+        return None
+
+def save_cursor(cursor):
+    table_name = os.environ['DYNAMODB_TABLE_NAME']
+    dynamodb.put_item(
+        TableName=table_name,
+        Item={
+            'TokenID': {'S': 'dropbox_cursor'},
+            'Cursor': {'S': cursor},
+            'FolderPath': {'S': get_remote_folder_path()}
+        }
+    )
+
+def get_remote_folder_path():
+    # Map DROPBOX_REMOTE_URL (dropbox://path/to/folder) onto a Dropbox API path; "" is the app folder
+    folder = os.environ['DROPBOX_REMOTE_URL'][len('dropbox://'):].strip('/')
+    return f"/{folder}" if folder else ""
+
+def list_folder_changes(access_token, cursor=None):
+    # Without a cursor, list the whole configured folder; with one, list only the entries that
+    # changed since it was issued. Follows has_more across pages and returns (entries, cursor),
+    # or (None, None) if the listing failed.
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
     }
-    data = json.dumps({"path": ""})  # Use empty string for the app folder
-
-    response = requests.post(url, headers=headers, data=data)
-    if response.status_code == 200:
-        return response.json().get('entries', [])
+    if cursor:
+        url = "https://api.dropboxapi.com/2/files/list_folder/continue"
+        data = json.dumps({"cursor": cursor})
     else:
-        logger.error("Error listing folder contents: %s", response.text)
-        return []
+        url = "https://api.dropboxapi.com/2/files/list_folder"
+        data = json.dumps({"path": get_remote_folder_path()})
+    entries = []
+
+    while True:
+        response = requests.post(url, headers=headers, data=data)
+        if response.status_code == 409 and cursor and response.json().get('error', {}).get('.tag') == 'reset':
+            # Dropbox expired the stored cursor; fall back to a full listing
+            logger.info("Dropbox cursor was reset, listing the whole folder again.")
+            return list_folder_changes(access_token)
+        if response.status_code != 200:
+            logger.error("Error listing folder contents: %s", response.text)
+            return None, None
+
+        result = response.json()
+        entries.extend(result.get('entries', []))
+        if not result.get('has_more'):
+            return entries, result['cursor']
+
+        url = "https://api.dropboxapi.com/2/files/list_folder/continue"
+        data = json.dumps({"cursor": result['cursor']})
+
+def collapse_changes(entries):
+    # A path can show up more than once in a batch of changes (e.g. deleted, then re-added);
+    # entries are in order, so the last one per path is its current state
+    latest_entries = {}
+    for entry in entries:
+        latest_entries[entry['path_lower']] = entry
+    return list(latest_entries.values())
 
 def refresh_access_token():
     response = requests.post(
@@ -80,8 +139,8 @@ def is_token_valid(expiry_time):
     return time.time() < expiry_time - 300
 
 
-def add_files(access_token):  
-    # Environment variables 
+def get_job_environment(access_token):
+    # Environment variables
     dropbox_access_token = access_token
     dropbox_remote_url = os.environ['DROPBOX_REMOTE_URL']
     pinecone_api_key = os.environ['PINECONE_API_KEY']
@@ -93,51 +152,151 @@ def add_files(access_token):
     chunking_max_characters = os.environ['CHUNKING_MAX_CHARACTERS']
     local_file_download_dir = '/tmp/'  # Temporary directory for Lambda file storage
 
-    # Generate a valid job name
-    job_name = f"BatchJob_{uuid.uuid4()}"
+    return [
+        {'name': 'DROPBOX_ACCESS_TOKEN', 'value': dropbox_access_token},
+        {'name': 'DROPBOX_REMOTE_URL', 'value': dropbox_remote_url},
+        {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
+        {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
+        {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
+        {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
+        {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
+        {'name': 'PINECONE_INDEX_NAME', 'value': pinecone_index_name},
+        {'name': 'PINECONE_API_KEY', 'value': pinecone_api_key},
+        {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
+    ]
+
+def add_files(access_token, entries, full_listing=False):
+    # Bundle the changed files into manifests and fan them out as a single array job
+    files = [
+        (f"dropbox:/{entry['path_display']}", entry.get('size', 0))
+        for entry in entries
+        if entry.get('.tag') == 'file'
+    ]
+    job_ids = submit_manifests(bundle_manifests(files), get_job_environment(access_token))
+    logger.info("Started Batch Jobs: %s for %d file(s)", job_ids, len(files))
+    if full_listing and job_ids:
+        job_ids.append(clear_default_namespace(access_token, job_ids))
+    return job_ids
 
-    # Start Batch job
+def clear_default_namespace(access_token, job_ids):
+    # Deployments from before the per-file namespaces kept every file's vectors in the default
+    # namespace, which nothing writes to any more. Once every child of the full listing's jobs has
+    # succeeded, one more job drops those old copies; Batch fails it instead of running it if any
+    # of them fails, so the old copies stay until a listing has re-ingested every file.
     response = batch_client.submit_job(
-        jobName=job_name,
-        jobQueue=os.environ['JOB_QUEUE'],  # Job queue from environment variables
-        jobDefinition=os.environ['JOB_DEFINITION'],  # Job definition from environment variables
+        jobName=f"ClearDefaultNamespace_{uuid.uuid4()}",
+        jobQueue=os.environ['JOB_QUEUE'],
+        jobDefinition=os.environ['JOB_DEFINITION'],
+        dependsOn=[{'jobId': job_id} for job_id in job_ids],
         containerOverrides={
-            'environment': [
-                {'name': 'DROPBOX_ACCESS_TOKEN', 'value': dropbox_access_token},
-                {'name': 'DROPBOX_REMOTE_URL', 'value': dropbox_remote_url},
-                {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
-                {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
-                {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
-                {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
-                {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
-                {'name': 'PINECONE_INDEX_NAME', 'value': pinecone_index_name},
-                {'name': 'PINECONE_API_KEY', 'value': pinecone_api_key},
-                {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
-                {'name': 'APP_SCRIPT', 'value': app_script},
+            'environment': get_job_environment(access_token) + [
+                {'name': 'INGEST_MODE', 'value': 'clear-default-namespace'},
             ],
         },
     )
-    # Response with job information
-    return {
-        'statusCode': 200,
-        'body': json.dumps(f"Started Batch Job: {response['jobId']}")
-    }
+    logger.info("Started Batch Job: %s to clear the default namespace after %s", response['jobId'], job_ids)
+    return response['jobId']
 
-def handler(event, context):
-    logger.info("Received event: %s", json.dumps(event))
-    
-    # Completing Dropbox webhook challenge
-    query_params = event.get("queryStringParameters")
-    if query_params and 'challenge' in query_params:
-        logger.info("Challenge received: %s", query_params['challenge'])
-        return {
-            'statusCode': 200,
-            'body': query_params['challenge'],
-            'headers': {
-                'Content-Type': 'application/json'
-            }
-        }
+def delete_files(access_token, entries):
+    # Removed entries only need their records dropped, so they all go out as one delete-mode job
+    remote_urls = [f"dropbox:/{entry['path_display']}" for entry in entries]
+    environment = get_job_environment(access_token) + [{'name': 'INGEST_MODE', 'value': 'delete'}]
+    job_ids = submit_manifests([remote_urls], environment)
+    logger.info("Started Batch Jobs: %s to delete %d removed entries", job_ids, len(remote_urls))
+    return job_ids
+
+def get_folder_key():
+    # SQS group and deduplication IDs only allow a restricted character set, so key the folder by hash
+    return hashlib.sha256(get_remote_folder_path().encode('utf-8')).hexdigest()
 
+def enqueue_sync():
+    # Every notification within the same coalescing window shares a deduplication ID, so SQS keeps
+    # only the first; the queue's delivery delay holds it until the window has closed
+    window = int(time.time() // SYNC_COALESCE_SECONDS)
+    folder_key = get_folder_key()
+    sqs.send_message(
+        QueueUrl=os.environ['SYNC_QUEUE_URL'],
+        MessageBody=json.dumps({'folder': get_remote_folder_path(), 'window': window}),
+        MessageGroupId=folder_key,
+        MessageDeduplicationId=f"{folder_key}-{window}",
+    )
+
+def requeue_sync(request_id):
+    # Check back after another delivery delay. The deduplication ID is unique to this run, so the
+    # message isn't dropped as a repeat of the one that triggered it.
+    folder_key = get_folder_key()
+    sqs.send_message(
+        QueueUrl=os.environ['SYNC_QUEUE_URL'],
+        MessageBody=json.dumps({'folder': get_remote_folder_path(), 'requeuedBy': request_id}),
+        MessageGroupId=folder_key,
+        MessageDeduplicationId=f"{folder_key}-requeue-{request_id}",
+    )
+
+def acquire_sync_lease(owner):
+    # At most one sync per folder may hold the lease; an expired lease can be taken over.
+    # Returns the IDs of the jobs the previous holder submitted, or None if the lease is held.
+    now = int(time.time())
+    try:
+        response = dynamodb.update_item(
+            TableName=os.environ['DYNAMODB_TABLE_NAME'],
+            Key={'TokenID': {'S': f"sync_lease:{get_folder_key()}"}},
+            UpdateExpression='SET #owner = :owner, ExpiresAt = :expires_at',
+            ConditionExpression='attribute_not_exists(TokenID) OR ExpiresAt < :now',
+            ExpressionAttributeNames={'#owner': 'Owner'},
+            ExpressionAttributeValues={
+                ':owner': {'S': owner},
+                ':expires_at': {'N': str(now + SYNC_LEASE_SECONDS)},
+                ':now': {'N': str(now)}
+            },
+            ReturnValues='ALL_OLD'
+        )
+        return response.get('Attributes', {}).get('JobIds', {}).get('SS', [])
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
+
+def release_sync_lease(owner, job_ids):
+    # Jobs that are still running keep writing their paths after the sync returns, so their IDs
+    # stay on the lease for the next sync to wait on; only a lease without jobs is deleted
+    try:
+        if job_ids:
+            dynamodb.update_item(
+                TableName=os.environ['DYNAMODB_TABLE_NAME'],
+                Key={'TokenID': {'S': f"sync_lease:{get_folder_key()}"}},
+                UpdateExpression='SET ExpiresAt = :expired, JobIds = :job_ids',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'Owner'},
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner},
+                    ':expired': {'N': '0'},
+                    ':job_ids': {'SS': list(job_ids)}
+                }
+            )
+        else:
+            dynamodb.delete_item(
+                TableName=os.environ['DYNAMODB_TABLE_NAME'],
+                Key={'TokenID': {'S': f"sync_lease:{get_folder_key()}"}},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'Owner'},
+                ExpressionAttributeValues={':owner': {'S': owner}}
+            )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        logger.info("Sync lease was already taken over; nothing to release.")
+
+def get_active_jobs(job_ids):
+    # DescribeJobs takes at most 100 IDs per call; an array job stays active until all its children finish
+    active_job_ids = []
+    job_ids = list(job_ids)
+    for start in range(0, len(job_ids), 100):
+        response = batch_client.describe_jobs(jobs=job_ids[start:start + 100])
+        active_job_ids.extend(
+            job['jobId'] for job in response['jobs']
+            if job['status'] not in ('SUCCEEDED', 'FAILED')
+        )
+    return active_job_ids
+
+def run_sync(job_ids):
+    # Appends the IDs of the jobs it submits to job_ids as it goes, so they are recorded on the
+    # lease even if a later step fails
     # Check if token data exists in DynamoDB
     token_data = get_token_data()
     if not token_data:
@@ -153,24 +312,68 @@ def handler(event, context):
             access_token, access_token_expiry = refresh_access_token()
 
 
-    # Fetch current folder contents
-    current_files = list_folder_contents(access_token)
-    current_file_names = {file['name'] for file in current_files}
+    # Fetch only what changed since the last sync; the first run lists the whole folder
+    cursor = get_cursor()
+    entries, new_cursor = list_folder_changes(access_token, cursor)
+    if new_cursor is None:
+        logger.info("Could not list Dropbox changes; ingestion process not started.")
+        return
+
+    changes = collapse_changes(entries)
+    changed_files = [entry for entry in changes if entry.get('.tag') == 'file']
+    removed_entries = [entry for entry in changes if entry.get('.tag') == 'deleted']
+
+    # Log changed files for reference
+    logger.info("Added or modified files: %s", [entry['name'] for entry in changed_files])
+    logger.info("Removed entries: %s", [entry['name'] for entry in removed_entries])
+
+    # Only submit work for the entries that actually changed
+    if changed_files:
+        job_ids.extend(add_files(access_token, changed_files, full_listing=cursor is None))
+        logger.info("Ingestion process started.")
+    if removed_entries:
+        job_ids.extend(delete_files(access_token, removed_entries))
+        logger.info("Delete process started.")
+    if not changed_files and not removed_entries:
+        logger.info("No changes in Dropbox folder; ingestion process not started.")
+
+    # Advance the cursor only once the work for these changes has been submitted
+    save_cursor(new_cursor)
+
+def handler(event, context):
+    logger.info("Received event: %s", json.dumps(event))
+    
+    # Completing Dropbox webhook challenge
+    query_params = event.get("queryStringParameters")
+    if query_params and 'challenge' in query_params:
+        logger.info("Challenge received: %s", query_params['challenge'])
+        return {
+            'statusCode': 200,
+            'body': query_params['challenge'],
+            'headers': {
+                'Content-Type': 'application/json'
+            }
+        }
 
-    # Log current files for reference
-    logger.info("Current files in the folder: %s", current_file_names)
+    # Check if this is a delete event (ie. CDK delete of the initial ingestion resource)
+    if event.get('RequestType') == 'Delete':
+        logger.info("Stack is being deleted, no sync will be queued.")
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Success'),
+            'headers': {
+                'Content-Type': 'application/json'
+            }
+        }
 
     # Process delta changes
-    body = json.loads(event.get('body', '{}'))
+    body = json.loads(event.get('body') or '{}')
     if 'delta' in body:
         logger.info("Delta changes: %s", json.dumps(body['delta']))
-    
-    # Only start ingestion process if there are files in the folder
-    if current_file_names:
-        add_files(access_token)
-        logger.info("Ingestion process started.")
-    else:
-        logger.info("No files in Dropbox folder; ingestion process not started.")
+
+    # Hand the notification to the sync queue instead of syncing inline, so bursts collapse
+    enqueue_sync()
+    logger.info("Sync queued.")
 
     return {
         'statusCode': 200,
@@ -179,3 +382,27 @@ def handler(event, context):
             'Content-Type': 'application/json'
         }
     }
+
+def sync_handler(event, context):
+    # Invoked by the sync queue; all notifications in the batch are served by one sync run
+    logger.info("Coalesced %d queued notification(s) into one sync.", len(event.get('Records', [])))
+
+    previous_job_ids = acquire_sync_lease(context.aws_request_id)
+    if previous_job_ids is None:
+        # Failing the batch hands the messages back to SQS to retry once the lease is free
+        raise Exception("Another sync is already running for this folder")
+
+    # The previous sync's jobs may still be writing paths this sync would submit again; running
+    # both at once leaves duplicate or missing records, so wait until they have finished
+    active_job_ids = get_active_jobs(previous_job_ids)
+    if active_job_ids:
+        logger.info("Jobs %s from the previous sync are still running; checking again later.", active_job_ids)
+        release_sync_lease(context.aws_request_id, active_job_ids)
+        requeue_sync(context.aws_request_id)
+        return
+
+    job_ids = []
+    try:
+        run_sync(job_ids)
+    finally:
+        release_sync_lease(context.aws_request_id, job_ids)
@@ -0,0 +1,183 @@
+# lambda/ingest_utils_layer/python/backfill_utils.py
+
+import json
+import os
+import time
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from ingest_record_utils import find_changed, record_manifests
+from manifest_utils import bundle_manifests
+
+s3_client = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+dynamodb = boto3.resource('dynamodb')
+
+# Keys per list_objects_v2 page; kept small so a slice can stop close to its deadline
+PAGE_SIZE = 200
+# Stop listing early enough to submit the slice's manifests, write their ingest records and save
+# the checkpoint before the Lambda timeout: a fixed allowance plus a share for every file the slice
+# has queued so far. A slice also stops once it has queued BACKFILL_MAX_SLICE_FILES, so that work
+# stays bounded however fast the listing runs.
+DEADLINE_BUFFER_SECONDS = 10
+SUBMIT_SECONDS_PER_FILE = float(os.environ.get('BACKFILL_SUBMIT_SECONDS_PER_FILE', '0.005'))
+MAX_SLICE_FILES = int(os.environ.get('BACKFILL_MAX_SLICE_FILES', '2000'))
+MAX_LISTING_WORKERS = int(os.environ.get('BACKFILL_MAX_WORKERS', '8'))
+
+
+def get_checkpoint_table():
+    return dynamodb.Table(os.environ['BACKFILL_TABLE_NAME'])
+
+def list_shards(bucket_name, prefix):
+    # Split the backfill into one shard per common prefix so they can be listed concurrently.
+    # Objects sitting directly under the prefix get their own non-recursive shard.
+    shards = [{'Prefix': prefix, 'Recursive': False, 'StartAfter': ''}]
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            shards.append({'Prefix': common_prefix['Prefix'], 'Recursive': True, 'StartAfter': ''})
+
+    return shards
+
+def start_backfill(bucket_name, prefix):
+    backfill_id = f"{bucket_name}/{prefix}"
+    checkpoint = {
+        'BackfillID': backfill_id,
+        'Bucket': bucket_name,
+        'Shards': list_shards(bucket_name, prefix),
+        'Submitted': 0,
+        'Skipped': 0,
+        'Unchanged': 0,
+        'Status': 'IN_PROGRESS',
+    }
+    print(f"Starting backfill {backfill_id} across {len(checkpoint['Shards'])} shard(s).")
+    save_checkpoint(checkpoint)
+    return checkpoint
+
+def load_checkpoint(backfill_id):
+    response = get_checkpoint_table().get_item(Key={'BackfillID': backfill_id})
+    if 'Item' not in response:
+        raise Exception(f"No checkpoint found for backfill {backfill_id}")
+
+    checkpoint = response['Item']
+    checkpoint['Submitted'] = int(checkpoint['Submitted'])
+    checkpoint['Skipped'] = int(checkpoint['Skipped'])
+    checkpoint['Unchanged'] = int(checkpoint['Unchanged'])
+    return checkpoint
+
+def save_checkpoint(checkpoint):
+    get_checkpoint_table().put_item(Item=checkpoint)
+
+def backfill_shard(bucket_name, shard, manifests, etags, deadline, clear=None):
+    # Returns (submitted, skipped, unchanged, finished). The shard's queued objects are always
+    # bundled into manifests before returning, so shard['StartAfter'] only covers keys that this
+    # slice submits. etags collects the ETag of every submitted URL so the ingest records can be
+    # written; it also sizes the time held back from the deadline for submitting them and for
+    # clearing earlier versions. clear(s3_urls), when given, drops what the destination holds for
+    # queued objects that were ingested before, since a full-mode job only adds records.
+    submitted = 0
+    skipped = 0
+    unchanged = 0
+    queued = []
+    previously_ingested = []
+
+    def flush():
+        if clear and previously_ingested:
+            clear(previously_ingested)
+        manifests.extend(bundle_manifests(queued))
+
+    params = {'Bucket': bucket_name, 'Prefix': shard['Prefix'], 'MaxKeys': PAGE_SIZE}
+    if not shard['Recursive']:
+        params['Delimiter'] = '/'
+    if shard['StartAfter']:
+        params['StartAfter'] = shard['StartAfter']
+
+    while True:
+        response = s3_client.list_objects_v2(**params)
+        contents = response.get('Contents', [])
+
+        # Look up the whole page in the ingest records at once to drop objects ingested unchanged
+        changed, recorded_urls = find_changed(
+            (f"s3://{bucket_name}/{item['Key']}", item['ETag']) for item in contents if item['Size'] > 0
+        )
+        changed_urls = {url for url, _ in changed}
+
+        for item in contents:
+            # etags is shared by every shard in the slice, so this is the slice's queued file count
+            if len(etags) >= MAX_SLICE_FILES or time.time() >= deadline - len(etags) * SUBMIT_SECONDS_PER_FILE:
+                flush()
+                return submitted, skipped, unchanged, False
+
+            document_key = item['Key']
+            s3_url = f"s3://{bucket_name}/{document_key}"
+            # Skip the object if its size is 0 (indicating it's a folder)
+            if item['Size'] == 0:
+                print(f"Skipping folder: {document_key}")
+                skipped += 1
+            elif s3_url not in changed_urls:
+                unchanged += 1
+            else:
+                queued.append((s3_url, item['Size']))
+                if s3_url in recorded_urls:
+                    previously_ingested.append(s3_url)
+                etags[s3_url] = item['ETag']
+                submitted += 1
+
+            shard['StartAfter'] = document_key
+
+        if not response.get('IsTruncated'):
+            flush()
+            return submitted, skipped, unchanged, True
+
+        params.pop('StartAfter', None)
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+def run_backfill(checkpoint, submit, context, clear=None):
+    # Process as much of the backfill as fits in this invocation, submit every manifest it
+    # produced in one call, then either mark the backfill complete or save the checkpoint
+    # and hand the remainder to a fresh asynchronous invocation. clear is passed on to
+    # backfill_shard.
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_BUFFER_SECONDS
+    bucket_name = checkpoint['Bucket']
+    shards = checkpoint['Shards']
+
+    manifests = []
+    etags = {}
+
+    with ThreadPoolExecutor(max_workers=MAX_LISTING_WORKERS) as executor:
+        results = list(executor.map(lambda shard: backfill_shard(bucket_name, shard, manifests, etags, deadline, clear), shards))
+
+    if manifests:
+        started = time.time()
+        job_ids = submit(manifests)
+        record_manifests(manifests, job_ids, etags)
+        print(f"Submitted {len(etags)} file(s) in {time.time() - started:.2f} seconds.")
+
+    remaining_shards = []
+    for shard, (submitted, skipped, unchanged, finished) in zip(shards, results):
+        checkpoint['Submitted'] += submitted
+        checkpoint['Skipped'] += skipped
+        checkpoint['Unchanged'] += unchanged
+        if not finished:
+            remaining_shards.append(shard)
+
+    checkpoint['Shards'] = remaining_shards
+    if remaining_shards:
+        save_checkpoint(checkpoint)
+        lambda_client.invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({'BackfillResume': checkpoint['BackfillID']}),
+        )
+        print(f"Backfill {checkpoint['BackfillID']} paused with {len(remaining_shards)} shard(s) left; resuming in a new invocation.")
+    else:
+        checkpoint['Status'] = 'COMPLETE'
+        save_checkpoint(checkpoint)
+        print(f"Backfill {checkpoint['BackfillID']} complete.")
+
+    return {
+        'submitted': checkpoint['Submitted'],
+        'skipped': checkpoint['Skipped'],
+        'unchanged': checkpoint['Unchanged'],
+        'complete': not remaining_shards,
+    }
@@ -0,0 +1,103 @@
+# lambda/ingest_utils_layer/python/ingest_record_utils.py
+
+import hashlib
+import json
+import os
+import boto3
+from manifest_utils import MAX_ARRAY_SIZE, WORKER_JOB_ID_PREFIX
+
+dynamodb = boto3.resource('dynamodb')
+batch_client = boto3.client('batch')
+
+# Settings that change what ends up in the destination; if any differ, the object is re-ingested.
+# Each stack names its destination's settings in DESTINATION_CONFIG_KEYS, comma-separated.
+CONFIG_KEYS = [
+    'EMBEDDING_PROVIDER', 'EMBEDDING_MODEL_NAME', 'CHUNKING_STRATEGY', 'CHUNKING_MAX_CHARACTERS',
+] + [key for key in os.environ.get('DESTINATION_CONFIG_KEYS', '').split(',') if key]
+# BatchGetItem and DescribeJobs both accept at most 100 keys per request
+BATCH_READ_SIZE = 100
+
+
+def get_record_table():
+    return dynamodb.Table(os.environ['INGEST_RECORD_TABLE_NAME'])
+
+def get_config_hash():
+    config = {key: os.getenv(key, '') for key in CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+def normalize_etag(etag):
+    # Listings quote the ETag while S3 event notifications do not
+    return (etag or '').strip('"')
+
+def get_failed_job_ids(job_ids):
+    # Jobs that Batch no longer reports on are old enough to be treated as having succeeded.
+    # The ingest workers delete the records of objects they give up on, so their IDs aren't checked.
+    job_ids = [job_id for job_id in job_ids if not job_id.startswith(WORKER_JOB_ID_PREFIX)]
+    failed_job_ids = set()
+
+    for start in range(0, len(job_ids), BATCH_READ_SIZE):
+        response = batch_client.describe_jobs(jobs=job_ids[start:start + BATCH_READ_SIZE])
+        failed_job_ids.update(job['jobId'] for job in response['jobs'] if job['status'] == 'FAILED')
+
+    return failed_job_ids
+
+def load_records(source_urls):
+    table_name = get_record_table().name
+    records = {}
+
+    for start in range(0, len(source_urls), BATCH_READ_SIZE):
+        request = {table_name: {'Keys': [{'SourcePath': url} for url in source_urls[start:start + BATCH_READ_SIZE]]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for record in response['Responses'].get(table_name, []):
+                records[record['SourcePath']] = record
+            request = response.get('UnprocessedKeys')
+
+    return records
+
+def find_changed(items):
+    # items are (source_url, etag) pairs. Returns the pairs that still need ingesting: new objects,
+    # objects whose content or embedding config changed, and objects whose last ingest job failed;
+    # and the URLs among them that have an ingest record, whose earlier version may still be in the
+    # destination.
+    items = [(url, normalize_etag(etag)) for url, etag in items]
+    if not items:
+        return [], set()
+
+    config_hash = get_config_hash()
+    records = load_records([url for url, _ in items])
+    matches = {
+        url: records[url]['JobId']
+        for url, etag in items
+        if url in records and records[url]['ETag'] == etag and records[url]['ConfigHash'] == config_hash
+    }
+    failed_job_ids = get_failed_job_ids(set(matches.values()))
+
+    changed = [(url, etag) for url, etag in items if url not in matches or matches[url] in failed_job_ids]
+    return changed, {url for url, _ in changed if url in records}
+
+def filter_changed(items):
+    # Just the pairs that still need ingesting
+    return find_changed(items)[0]
+
+def record_ingests(items, job_id):
+    # items are the (source_url, etag) pairs that job_id was submitted to ingest
+    config_hash = get_config_hash()
+    with get_record_table().batch_writer(overwrite_by_pkeys=['SourcePath']) as batch:
+        for url, etag in items:
+            batch.put_item(Item={
+                'SourcePath': url,
+                'ETag': normalize_etag(etag),
+                'ConfigHash': config_hash,
+                'JobId': job_id,
+            })
+
+def record_manifests(manifests, job_ids, etags):
+    # submit_manifests returns one job per MAX_ARRAY_SIZE manifests, in order
+    for index, manifest in enumerate(manifests):
+        record_ingests([(url, etags[url]) for url in manifest], job_ids[index // MAX_ARRAY_SIZE])
+
+def forget_ingests(source_urls):
+    with get_record_table().batch_writer() as batch:
+        for source_url in source_urls:
+            batch.delete_item(Key={'SourcePath': source_url})
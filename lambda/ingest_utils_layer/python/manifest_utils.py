@@ -0,0 +1,128 @@
+# lambda/ingest_utils_layer/python/manifest_utils.py
+
+import json
+import os
+import uuid
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+s3_client = boto3.client('s3')
+batch_client = boto3.client('batch')
+sqs_client = boto3.client('sqs')
+
+# AWS Batch caps array jobs at 10,000 children
+MAX_ARRAY_SIZE = 10000
+MANIFEST_WRITE_WORKERS = 32
+# SendMessageBatch accepts at most 10 messages
+QUEUE_SEND_BATCH_SIZE = 10
+# Work handed to the warm ingest workers is tracked under IDs with this prefix instead of Batch job IDs
+WORKER_JOB_ID_PREFIX = 'worker-'
+BUNDLE_MAX_FILES = int(os.environ.get('BUNDLE_MAX_FILES', '25'))
+BUNDLE_MAX_BYTES = int(os.environ.get('BUNDLE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+
+def bundle_manifests(items):
+    # Group (url, size) pairs into manifests capped by file count and total bytes
+    manifests = []
+    manifest = []
+    manifest_bytes = 0
+
+    for url, size in items:
+        manifest.append(url)
+        manifest_bytes += size
+
+        if len(manifest) >= BUNDLE_MAX_FILES or manifest_bytes >= BUNDLE_MAX_BYTES:
+            manifests.append(manifest)
+            manifest = []
+            manifest_bytes = 0
+
+    if manifest:
+        manifests.append(manifest)
+
+    return manifests
+
+def write_manifest_shards(manifests):
+    # Each manifest becomes <prefix><index>.json so an array child can fetch its own shard
+    # using AWS_BATCH_JOB_ARRAY_INDEX
+    bucket_name = os.environ['MANIFEST_BUCKET_NAME']
+    key_prefix = f"manifests/{uuid.uuid4()}/"
+
+    def write_shard(indexed_manifest):
+        index, manifest = indexed_manifest
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=f"{key_prefix}{index}.json",
+            Body=json.dumps(manifest),
+            ContentType='application/json',
+        )
+
+    with ThreadPoolExecutor(max_workers=MANIFEST_WRITE_WORKERS) as executor:
+        list(executor.map(write_shard, enumerate(manifests)))
+
+    return f"s3://{bucket_name}/{key_prefix}"
+
+def is_worker_dispatch():
+    # INGEST_DISPATCH=worker hands manifests to the long-lived ingest workers instead of Batch
+    return os.environ.get('INGEST_DISPATCH') == 'worker'
+
+def enqueue_manifests(manifests):
+    # One queue message per manifest. Like submit_manifests, returns one ID per MAX_ARRAY_SIZE
+    # manifests so callers can record them the same way.
+    queue_url = os.environ['INGEST_WORKER_QUEUE_URL']
+    job_ids = []
+
+    for start in range(0, len(manifests), MAX_ARRAY_SIZE):
+        job_id = f"{WORKER_JOB_ID_PREFIX}{uuid.uuid4()}"
+        shard_manifests = manifests[start:start + MAX_ARRAY_SIZE]
+        entries = [
+            {'Id': str(index), 'MessageBody': json.dumps({'job_id': job_id, 's3_urls': manifest})}
+            for index, manifest in enumerate(shard_manifests)
+        ]
+
+        def send_batch(batch_start):
+            response = sqs_client.send_message_batch(
+                QueueUrl=queue_url, Entries=entries[batch_start:batch_start + QUEUE_SEND_BATCH_SIZE]
+            )
+            if response.get('Failed'):
+                raise Exception(f"Failed to enqueue {len(response['Failed'])} manifest(s): {response['Failed']}")
+
+        with ThreadPoolExecutor(max_workers=MANIFEST_WRITE_WORKERS) as executor:
+            list(executor.map(send_batch, range(0, len(entries), QUEUE_SEND_BATCH_SIZE)))
+
+        print(f"Queued {len(shard_manifests)} manifest(s) for the ingest workers as {job_id}")
+        job_ids.append(job_id)
+
+    return job_ids
+
+def submit_manifests(manifests, environment):
+    # Submit one array job per (up to) 10,000 manifests instead of one job per manifest.
+    # environment is the container environment shared by every child; the warm workers carry
+    # their own, so it is unused when they take the work.
+    if is_worker_dispatch():
+        return enqueue_manifests(manifests)
+
+    job_ids = []
+
+    for start in range(0, len(manifests), MAX_ARRAY_SIZE):
+        shard_manifests = manifests[start:start + MAX_ARRAY_SIZE]
+        manifest_prefix = write_manifest_shards(shard_manifests)
+
+        params = {
+            'jobName': f"BatchJob_{uuid.uuid4()}",
+            'jobQueue': os.environ['JOB_QUEUE'],
+            'jobDefinition': os.environ['JOB_DEFINITION'],
+            'containerOverrides': {
+                'environment': environment + [
+                    {'name': 'MANIFEST_S3_PREFIX', 'value': manifest_prefix},
+                ],
+            },
+        }
+        # Array jobs need at least two children; a single shard runs as a plain job at index 0
+        if len(shard_manifests) > 1:
+            params['arrayProperties'] = {'size': len(shard_manifests)}
+
+        response = batch_client.submit_job(**params)
+        print(f"Started Batch Job: {response['jobId']} for {len(shard_manifests)} manifest shard(s) at {manifest_prefix}")
+        job_ids.append(response['jobId'])
+
+    return job_ids
@@ -9,6 +9,12 @@ pinecone_client = pinecone.Pinecone(api_key=os.environ['PINECONE_API_KEY'])
 pinecone_index = pinecone_client.Index(os.environ['PINECONE_INDEX_NAME'])
 model_name = os.environ['EMBEDDING_MODEL_NAME']
 
+# Matches the ingest side: "namespace" has one namespace per file, "prefix" keeps every file in
+# PINECONE_NAMESPACE or PINECONE_NAMESPACE_SHARDS namespaces derived from it
+pinecone_layout = os.environ.get('PINECONE_LAYOUT', 'namespace')
+pinecone_namespace = os.environ.get('PINECONE_NAMESPACE', 'documents')
+pinecone_namespace_shards = int(os.environ.get('PINECONE_NAMESPACE_SHARDS', '1'))
+
 def lambda_handler(event, context):
     # Parse the incoming JSON request body
     body = json.loads(event['body'])
@@ -50,9 +56,8 @@ def pinecone_similarity_search(embedding: list) -> list:
     top_k = 5
     all_results = []
 
-    # Get all namespaces and search across them
-    namespaces = list(pinecone_index.describe_index_stats()['namespaces'].keys())
-    for namespace in namespaces:
+    # Search every namespace that holds documents: a fixed few in the prefix layout, otherwise all of them
+    for namespace in get_query_namespaces():
         query_response = pinecone_index.query(
             vector=embedding,
             top_k=top_k,
@@ -65,6 +70,13 @@ def pinecone_similarity_search(embedding: list) -> list:
     all_results = sorted(all_results, key=lambda x: x["score"], reverse=True)[:top_k]
     return [{'text': result['metadata']['text'], 'score': result['score']} for result in all_results]
 
+def get_query_namespaces() -> list:
+    if pinecone_layout != 'prefix':
+        return list(pinecone_index.describe_index_stats()['namespaces'].keys())
+    if pinecone_namespace_shards <= 1:
+        return [pinecone_namespace]
+    return [f"{pinecone_namespace}-{shard}" for shard in range(pinecone_namespace_shards)]
+
 def openai_query(prompt: str):
     response = openai_client.chat.completions.create(
         model="gpt-4o",
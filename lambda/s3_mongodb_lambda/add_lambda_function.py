@@ -4,9 +4,11 @@ import boto3
 import botocore
 import uuid
 import urllib.parse
-from pymongo import MongoClient
 from dotenv import load_dotenv
-import time
+from mongodb_utils import delete_from_mongodb
+from backfill_utils import start_backfill, load_checkpoint, run_backfill
+from manifest_utils import submit_manifests, is_worker_dispatch, enqueue_manifests
+from ingest_record_utils import filter_changed, record_ingests
 
 load_dotenv()
 
@@ -14,33 +16,7 @@ load_dotenv()
 batch_client = boto3.client('batch')
 s3_client = boto3.client('s3')
 
-# Read the app.py script from the Lambda's local file system
-with open('s3_mongodb_ingest.py', 'r') as script_file:
-    app_script = script_file.read()
 
-
-def delete_from_mongodb(filename, uri, database_name, collection_name):
-    try:
-        # Connect to MongoDB
-        client = MongoClient(uri)
-        db = client[database_name]
-        collection = db[collection_name]
-
-        start_time = time.time()
-
-        # Delete documents with the specified filename in their metadata
-        result = collection.delete_many({"metadata.filename": filename})
-
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-
-        # Output the result
-        print(f"Deleted {result.deleted_count} document(s) with filename '{filename}'.")
-        print(f"Time taken: {elapsed_time:.2f} seconds.")
-        
-    except Exception as e:
-        print(f"Error deleting from MongoDB: {e}")
-    
 def lambda_handler(event, context):
     # Check if this is a delete event (ie. CDK delete)
     if event.get('RequestType') == 'Delete':
@@ -60,41 +36,49 @@ def lambda_handler(event, context):
         decoded_document_key = urllib.parse.unquote(document_key)
         decoded_document_with_spaces = decoded_document_key.replace('+', ' ').replace('%20', ' ')
         s3_url = f"s3://{bucket_name}/{decoded_document_with_spaces}"
-
-        if does_object_exist(bucket_name, decoded_document_with_spaces):
+        etag = event['Records'][0]['s3']['object'].get('eTag', '')
+
+        # Re-uploads and copies of identical content were already ingested with this config
+        if not filter_changed([(s3_url, etag)]):
+            message = f"Object {decoded_document_with_spaces} is unchanged since it was last ingested. Skipping."
+            print(message)
+            return {
+                'statusCode': 200,
+                'body': json.dumps(message)
+            }
+
+        # Incremental jobs diff the object's chunks against the database themselves, so the
+        # existing vectors must survive until the job runs
+        if os.environ.get('INCREMENTAL_INGEST') != 'true' and does_object_exist(bucket_name, decoded_document_with_spaces):
             print(f"Object {decoded_document_with_spaces} already exists. Deleting vectors from database.")
-            uri = os.environ['MONGODB_URI']
-            database_name = os.environ['MONGODB_DATABASE']
-            collection_name = os.environ['MONGODB_COLLECTION']
             try:
-                delete_from_mongodb(os.path.basename(decoded_document_with_spaces), uri, database_name, collection_name)
+                delete_from_mongodb([os.path.basename(decoded_document_with_spaces)])
             except Exception as e:
                 print(f"Error deleting from MongoDB: {e}")
 
-        return add_files(s3_url)
+        return add_files([s3_url], [etag])
 
     else:
-        # Handle custom resource event (initial processing)
-        print("Custom resource event received. Listing objects in S3 bucket.")
+        # Handle custom resource event (initial processing) or a resumed backfill
         bucket_name = os.environ['S3_BUCKET_NAME']
         prefix = os.environ.get('S3_NOTIFICATION_PREFIX', '')
-        
-        # List existing objects in the bucket
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        
-        if 'Contents' in response:
-            for item in response['Contents']:
-                document_key = item['Key']
-                s3_url = f"s3://{bucket_name}/{document_key}"
-
-                # Skip the object if its size is 0 (indicating it's a folder)
-                if item['Size'] == 0:
-                    print(f"Skipping folder: {document_key}")
-                    continue
-                
-                add_files(s3_url)
+
+        if 'BackfillResume' in event:
+            print(f"Resuming backfill {event['BackfillResume']}.")
+            checkpoint = load_checkpoint(event['BackfillResume'])
         else:
+            print("Custom resource event received. Listing objects in S3 bucket.")
+            checkpoint = start_backfill(bucket_name, prefix)
+
+        # Incremental jobs diff each object's chunks themselves; full-mode jobs need the earlier
+        # version of every object ingested before cleared first
+        clear = None if os.environ.get('INCREMENTAL_INGEST') == 'true' else clear_previous_versions
+        summary = run_backfill(checkpoint, add_manifests, context, clear)
+
+        if summary['complete'] and summary['submitted'] == 0 and summary['unchanged'] == 0:
             print("No objects found in the bucket.")
+        else:
+            print(f"Backfill submitted {summary['submitted']} object(s) so far, skipping {summary['unchanged']} unchanged; complete: {summary['complete']}.")
 
         return {
             'statusCode': 200,
@@ -111,8 +95,8 @@ def does_object_exist(bucket_name, document_key):
         else:
             raise
 
-def add_files(s3_url):  
-    # Environment variables 
+def get_job_environment():
+    # Environment variables
     aws_access_key = os.environ['MY_AWS_ACCESS_KEY_ID']
     aws_secret_key = os.environ['MY_AWS_SECRET_ACCESS_KEY']
     embedding_provider = os.environ['EMBEDDING_PROVIDER']
@@ -124,6 +108,33 @@ def add_files(s3_url):
     mongodb_database = os.environ['MONGODB_DATABASE']
     mongodb_collection = os.environ['MONGODB_COLLECTION']
     local_file_download_dir = '/tmp/'  # Temporary directory for Lambda file storage
+    ingest_mode = 'incremental' if os.environ.get('INCREMENTAL_INGEST') == 'true' else 'full'
+
+    return [
+        {'name': 'AWS_ACCESS_KEY_ID', 'value': aws_access_key},
+        {'name': 'AWS_SECRET_ACCESS_KEY', 'value': aws_secret_key},
+        {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
+        {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
+        {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
+        {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
+        {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
+        {'name': 'MONGODB_URI', 'value': mongodb_uri},
+        {'name': 'MONGODB_DATABASE', 'value': mongodb_database},
+        {'name': 'MONGODB_COLLECTION', 'value': mongodb_collection},
+        {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
+        {'name': 'INGEST_MODE', 'value': ingest_mode},
+    ]
+
+def add_files(s3_urls, etags):
+    # s3_urls is a manifest of objects that a single Batch job ingests in one container;
+    # etags lines up with it and is recorded once the job has been submitted
+    if is_worker_dispatch():
+        job_id = enqueue_manifests([s3_urls])[0]
+        record_ingests(zip(s3_urls, etags), job_id)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f"Queued {len(s3_urls)} object(s) for the ingest workers as {job_id}")
+        }
 
     # Generate a valid job name
     job_name = f"BatchJob_{uuid.uuid4()}"
@@ -135,25 +146,23 @@ def add_files(s3_url):
         jobDefinition=os.environ['JOB_DEFINITION'],  # Job definition from environment variables
         containerOverrides={
             'environment': [
-                {'name': 'AWS_S3_URL', 'value': s3_url},
-                {'name': 'AWS_ACCESS_KEY_ID', 'value': aws_access_key},
-                {'name': 'AWS_SECRET_ACCESS_KEY', 'value': aws_secret_key},
-                {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
-                {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
-                {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
-                {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
-                {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
-                {'name': 'MONGODB_URI', 'value': mongodb_uri},
-                {'name': 'MONGODB_DATABASE', 'value': mongodb_database},
-                {'name': 'MONGODB_COLLECTION', 'value': mongodb_collection},
-                {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
-                {'name': 'APP_SCRIPT', 'value': app_script},
-            ],
+                {'name': 'AWS_S3_URLS', 'value': json.dumps(s3_urls)},
+            ] + get_job_environment(),
         },
     )
+    record_ingests(zip(s3_urls, etags), response['jobId'])
 
     # Response with job information
     return {
         'statusCode': 200,
-        'body': json.dumps(f"Started Batch Job: {response['jobId']}")
-    }
\ No newline at end of file
+        'body': json.dumps(f"Started Batch Job: {response['jobId']} for {len(s3_urls)} object(s)")
+    }
+
+def add_manifests(manifests):
+    # Backfill path: write the manifests as shards and fan them out as array jobs
+    return submit_manifests(manifests, get_job_environment())
+
+def clear_previous_versions(s3_urls):
+    # Backfill path: drop what the destination holds for re-submitted objects, as the S3 event
+    # path does for an object that already exists
+    delete_from_mongodb([s3_url.split('/')[-1] for s3_url in s3_urls])
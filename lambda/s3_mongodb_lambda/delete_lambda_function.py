@@ -2,55 +2,32 @@
 import json
 import os
 import urllib.parse
-from pymongo import MongoClient
-from dotenv import load_dotenv
-import os
-import time
-
-load_dotenv()
-
-def delete_from_mongodb(filename, uri, database_name, collection_name):
-    try:
-        # Connect to MongoDB
-        client = MongoClient(uri)
-        db = client[database_name]
-        collection = db[collection_name]
+from mongodb_utils import delete_from_mongodb
+from ingest_record_utils import forget_ingests
 
-        start_time = time.time()
-
-        # Delete documents with the specified filename in their metadata
-        result = collection.delete_many({"metadata.filename": filename})
-
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-
-        # Output the result
-        print(f"Deleted {result.deleted_count} document(s) with filename '{filename}'.")
-        print(f"Time taken: {elapsed_time:.2f} seconds.")
-        
-    except Exception as e:
-        print(f"Error deleting from MongoDB: {e}")
-
-def lambda_handler(event, context):
-    uri = os.environ['MONGODB_URI']
-    database_name = os.environ['MONGODB_DATABASE']
-    collection_name = os.environ['MONGODB_COLLECTION']
-    
+def get_deleted_files(event):
+    # The decoded filename of each deleted object, by its s3:// URL, once each
+    deleted_files = {}
     for record in event['Records']:
         s3_bucket = record['s3']['bucket']['name']
-        s3_key = record['s3']['object']['key']
+        decoded_key = urllib.parse.unquote(record['s3']['object']['key']).replace('+', ' ').replace('%20', ' ')
+        deleted_files[f"s3://{s3_bucket}/{decoded_key}"] = os.path.basename(decoded_key)
+    return deleted_files
 
-        filename = os.path.basename(s3_key)
+def lambda_handler(event, context):
+    deleted_files = get_deleted_files(event)
+    filenames = sorted(set(deleted_files.values()))
 
-        try:
-            decoded_filename = urllib.parse.unquote(filename)
-            decoded_filename_with_spaces = decoded_filename.replace('+', ' ').replace('%20', ' ')
-            delete_from_mongodb(decoded_filename_with_spaces, uri, database_name, collection_name)
-            print(f"Deleted File: {decoded_filename_with_spaces} from Bucket: {s3_bucket}")
-        except Exception as e:
-            print(f"Error deleting from MongoDB: {e}")
+    try:
+        delete_from_mongodb(filenames)
+        # Forget the ingest records so re-uploading the same content ingests it again
+        forget_ingests(list(deleted_files))
+        for url in deleted_files:
+            print(f"Deleted File: {url}")
+    except Exception as e:
+        print(f"Error deleting from MongoDB: {e}")
 
     return {
         'statusCode': 200,
         'body': json.dumps("Deleted files from MongoDB.")
-    }
\ No newline at end of file
+    }
@@ -1,30 +1,178 @@
 # lambda/s3_mongodb_lambda/mongodb_utils.py
+#
+# Shared by the Lambdas and, published next to ingest_support, by the MongoDB Batch ingest scripts
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, IndexModel, MongoClient
+from pymongo.errors import ConnectionFailure, OperationFailure
+from pymongo.operations import SearchIndexModel
 from dotenv import load_dotenv
+import argparse
+import json
 import os
 import time
 
 load_dotenv()
 
-def delete_from_mongodb(filename, uri, database_name, collection_name):
-    try:
-        # Connect to MongoDB
-        client = MongoClient(uri)
-        db = client[database_name]
-        collection = db[collection_name]
+# One client per container, created on first use and kept at module scope. MongoClient is itself a
+# connection pool, so warm invocations skip topology discovery, TLS and authentication, and it
+# replaces dropped pool sockets on its own. A client that can't reach the cluster at all after the
+# container was frozen is replaced and the operation run once more.
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '10000'))
 
-        start_time = time.time()
+# Fields the destination is queried by: per-file deletes and lookups go by filename, and the
+# record locator says where in the source a document came from. They are indexed by a one-off
+# INGEST_MODE=migrate job that the stack submits on deploy, never by an ingest run.
+MONGODB_INDEX_FIELDS = [
+    field for field in os.environ.get(
+        'MONGODB_INDEX_FIELDS', 'metadata.filename,metadata.data_source.record_locator.remote_file_path'
+    ).split(',') if field
+]
+# Atlas Vector Search index over the embeddings, filterable by filename
+MONGODB_VECTOR_SEARCH_INDEX = os.environ.get('MONGODB_VECTOR_SEARCH_INDEX', 'vector_index')
+MONGODB_VECTOR_SIMILARITY = os.environ.get('MONGODB_VECTOR_SIMILARITY', 'cosine')
 
-        # Delete documents with the specified filename in their metadata
-        result = collection.delete_many({"metadata.filename": filename})
+_client = None
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
 
-        # Output the result
-        print(f"Deleted {result.deleted_count} document(s) with filename '{filename}'.")
-        print(f"Time taken: {elapsed_time:.2f} seconds.")
-        
-    except Exception as e:
-        print(f"Error deleting from MongoDB: {e}")
\ No newline at end of file
+def get_client():
+    global _client
+    if _client is None:
+        _client = MongoClient(
+            os.environ['MONGODB_URI'],
+            serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        )
+    return _client
+
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = None
+
+def get_collection():
+    return get_client()[os.environ['MONGODB_DATABASE']][os.environ['MONGODB_COLLECTION']]
+
+def run_operation(operation):
+    # operation takes the collection; deletes and other idempotent writes only
+    for attempt in range(2):
+        try:
+            return operation(get_collection())
+        except ConnectionFailure:
+            close_client()
+            if attempt:
+                raise
+            print("MongoDB client lost the cluster; reconnecting.")
+
+def delete_from_mongodb(filenames):
+    # Deletes the documents of every file in one delete_many. Returns how many were deleted.
+    start_time = time.time()
+
+    # Delete documents with any of the filenames in their metadata
+    result = run_operation(lambda collection: collection.delete_many({"metadata.filename": {"$in": list(filenames)}}))
+
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+
+    # Output the result
+    print(f"Deleted {result.deleted_count} document(s) for {len(filenames)} filename(s).")
+    print(f"Time taken: {elapsed_time:.2f} seconds.")
+    return result.deleted_count
+
+def ensure_indexes():
+    # createIndexes is a no-op for indexes that already exist, and builds the rest without
+    # blocking writes. Default names, so an index made by hand on the same field counts as
+    # existing. Returns the index names.
+    indexes = [IndexModel([(field, ASCENDING)]) for field in MONGODB_INDEX_FIELDS]
+    return run_operation(lambda collection: collection.create_indexes(indexes))
+
+def get_vector_search_index_definition(num_dimensions, similarity=MONGODB_VECTOR_SIMILARITY):
+    return {
+        "fields": [
+            {"type": "vector", "path": "embeddings", "numDimensions": num_dimensions, "similarity": similarity},
+            {"type": "filter", "path": "metadata.filename"},
+        ],
+    }
+
+def get_embedding_dimensions():
+    document = get_collection().find_one({"embeddings": {"$exists": True}}, {"embeddings": 1})
+    return len(document["embeddings"]) if document else None
+
+def ensure_vector_search_index(num_dimensions=None):
+    # Atlas only; the number of dimensions is read off a stored embedding unless given
+    collection = get_collection()
+    if any(index["name"] == MONGODB_VECTOR_SEARCH_INDEX for index in collection.list_search_indexes()):
+        print(f"Vector search index {MONGODB_VECTOR_SEARCH_INDEX} already exists.")
+        return None
+    num_dimensions = num_dimensions or get_embedding_dimensions()
+    if not num_dimensions:
+        raise ValueError("No embeddings stored yet; pass the number of dimensions")
+    return collection.create_search_index(SearchIndexModel(
+        definition=get_vector_search_index_definition(num_dimensions),
+        name=MONGODB_VECTOR_SEARCH_INDEX,
+        type="vectorSearch",
+    ))
+
+def get_plan_stages(plan):
+    # Stage names from the root of a winning plan down. SBE plans (explainVersion "2") keep the
+    # stages under queryPlan and sharded plans under each shard's winningPlan; a plan whose shape
+    # isn't recognised reports "unknown" rather than failing the diagnostics.
+    if not isinstance(plan, dict):
+        return ["unknown"]
+    if isinstance(plan.get("queryPlan"), dict):
+        return get_plan_stages(plan["queryPlan"])
+    stages = [plan.get("stage", "unknown")]
+    for shard in plan.get("shards") or []:
+        stages += get_plan_stages(shard.get("winningPlan") if isinstance(shard, dict) else None)
+    child = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    if child is not None:
+        stages += get_plan_stages(child)
+    return stages
+
+def explain_filename_query(filenames):
+    # How the per-file delete filter is executed: the winning plan's stages and how many index
+    # keys and documents it examined for each one it returned
+    query = {"metadata.filename": {"$in": list(filenames)}}
+    explanation = get_collection().find(query).explain()
+    stats = explanation.get("executionStats") or {}
+
+    returned = stats.get("nReturned")
+    docs_examined = stats.get("totalDocsExamined")
+    return {
+        "query": query,
+        "stages": get_plan_stages((explanation.get("queryPlanner") or {}).get("winningPlan")),
+        "returned": returned,
+        "keysExamined": stats.get("totalKeysExamined"),
+        "docsExamined": docs_examined,
+        "docsExaminedPerReturned": round(docs_examined / returned, 2) if returned and docs_examined is not None else None,
+        "executionTimeMs": stats.get("executionTimeMillis"),
+    }
+
+def main():
+    # python mongodb_utils.py bootstrap [--vector-search [--dimensions N]]
+    # python mongodb_utils.py explain FILENAME [FILENAME ...]
+    parser = argparse.ArgumentParser(description="MongoDB destination indexes and query diagnostics")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bootstrap = commands.add_parser("bootstrap", help="create the destination's indexes")
+    bootstrap.add_argument("--vector-search", action="store_true", help="also create the Atlas Vector Search index")
+    bootstrap.add_argument("--dimensions", type=int, help="embedding dimensions, if none are stored yet")
+    explain = commands.add_parser("explain", help="report how the per-file delete filter is executed")
+    explain.add_argument("filenames", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "bootstrap":
+        print(f"Indexes: {', '.join(ensure_indexes())}")
+        if args.vector_search:
+            try:
+                # None when the index already exists, which it reports itself
+                if ensure_vector_search_index(args.dimensions) is not None:
+                    print(f"Vector search index {MONGODB_VECTOR_SEARCH_INDEX} is building.")
+            except OperationFailure as e:
+                print(f"Could not create the vector search index (Atlas only): {e}")
+    else:
+        report = explain_filename_query(args.filenames)
+        print(json.dumps(report, indent=2))
+        if "COLLSCAN" in report["stages"]:
+            print("The filter scans the whole collection; run the bootstrap command to index it.")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
+import json
 import os
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
+import sys
 from unstructured_ingest.v2.interfaces import ProcessorConfig
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
@@ -12,16 +13,23 @@ from unstructured_ingest.v2.processes.connectors.mongodb import (
     MongoDBAccessConfig,
     MongoDBConnectionConfig,
     MongoDBUploadStagerConfig,
-    MongoDBUploaderConfig
+    MongoDBUploaderConfig,
+    MongoDBUploader
 )
 from unstructured_ingest.v2.processes.chunker import ChunkerConfig
-from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+from ingest_support import (
+    CachingEmbedderConfig, build_pipeline, ingest_incrementally, ingest_manifest, instrument_pipeline, load_manifest,
+    run_worker,
+)
+from mongodb_utils import ensure_indexes, get_collection
 
-if __name__ == "__main__":
+instrument_pipeline(MongoDBUploader)
+
+def build_pipeline_configs(s3_url):
     # Prepare the configuration dictionary
     pipeline_configs = {
         "context": ProcessorConfig(),
-        "indexer_config": S3IndexerConfig(remote_url=os.getenv("AWS_S3_URL")),
+        "indexer_config": S3IndexerConfig(remote_url=s3_url),
         "downloader_config": S3DownloaderConfig(download_dir=os.getenv("LOCAL_FILE_DOWNLOAD_DIR")),
         "source_connection_config": S3ConnectionConfig(
             access_config=S3AccessConfig(
@@ -33,7 +41,7 @@ if __name__ == "__main__":
             partition_by_api=False,
             strategy="auto",
         ),
-        "embedder_config": EmbedderConfig(
+        "embedder_config": CachingEmbedderConfig(
             embedding_provider=os.getenv("EMBEDDING_PROVIDER"),
             embedding_model_name=os.getenv("EMBEDDING_MODEL_NAME"),
             embedding_api_key=os.getenv("EMBEDDING_PROVIDER_API_KEY"),
@@ -55,4 +63,40 @@ if __name__ == "__main__":
             chunking_strategy=os.getenv("CHUNKING_STRATEGY"),
             chunk_max_characters=int(os.getenv("CHUNKING_MAX_CHARACTERS"))
         )
-    Pipeline.from_configs(**pipeline_configs).run()
+
+    return pipeline_configs
+
+def list_chunk_ids(s3_url):
+    filename = s3_url.split("/")[-1]
+    # Documents written by the regular pipeline have ObjectId keys; they never match a chunk ID,
+    # so the first incremental run replaces them
+    return {document["_id"] for document in get_collection().find({"metadata.filename": filename}, {"_id": 1})}
+
+def upload_chunks(s3_url, chunks):
+    get_collection().insert_many([{**element, "_id": chunk_id} for chunk_id, element in chunks])
+
+def delete_chunks(s3_url, chunk_ids):
+    get_collection().delete_many({"_id": {"$in": chunk_ids}})
+
+def ingest_object(s3_url):
+    # INGEST_MODE=incremental re-embeds only the chunks that changed since the file was last ingested.
+    # Returns whether the file is new to the destination.
+    if os.getenv("INGEST_MODE") == "incremental":
+        return ingest_incrementally(s3_url, build_pipeline_configs(s3_url), list_chunk_ids, upload_chunks, delete_chunks)
+    build_pipeline(build_pipeline_configs(s3_url)).run()
+    # The add Lambda, or the backfill, already cleared any earlier version of the file
+    return True
+
+if __name__ == "__main__":
+    # INGEST_MODE=migrate only builds the destination indexes
+    if os.getenv("INGEST_MODE") == "migrate":
+        ensure_indexes()
+        sys.exit(0)
+
+    worker_queue_url = os.getenv("INGEST_WORKER_QUEUE_URL")
+    if worker_queue_url:
+        run_worker(worker_queue_url, ingest_object)
+
+    # The manifest lists every object for this Batch job
+    if ingest_manifest(load_manifest(lambda: json.loads(os.getenv("AWS_S3_URLS"))), ingest_object):
+        sys.exit(1)
@@ -6,7 +6,10 @@ import botocore
 import uuid
 import urllib.parse
 import time
-from pinecone import Pinecone
+from pinecone_utils import delete_from_pinecone
+from backfill_utils import start_backfill, load_checkpoint, run_backfill
+from manifest_utils import submit_manifests, is_worker_dispatch, enqueue_manifests
+from ingest_record_utils import filter_changed, record_ingests
 
 
 
@@ -40,28 +43,6 @@ def log_to_cloudwatch(message):
         ]
     )
 
-# Read the app.py script from the Lambda's local file system
-with open('s3_pinecone_ingest.py', 'r') as script_file:
-    app_script = script_file.read()
-
-def delete_from_pinecone(filename, api_key, index_name):
-    # Initialize Pinecone and connect to the index
-    pc = Pinecone(api_key=api_key)
-    index = pc.Index(index_name)
-
-    # Start timing the operation
-    start_time = time.time()
-
-    # Delete all vectors in the specified namespace
-    index.delete(delete_all=True, namespace=filename)
-
-    print(f"Deleted all vectors in the namespace '{filename}'.")
-
-    # End timing and calculate duration
-    end_time = time.time()
-    duration = end_time - start_time
-    print(f"Total delete process took {duration:.2f} seconds.")
-    
 def lambda_handler(event, context):
     # Check if this is a delete event (ie. CDK delete)
     if event.get('RequestType') == 'Delete':
@@ -85,52 +66,62 @@ def lambda_handler(event, context):
         decoded_document_key = urllib.parse.unquote(document_key)
         decoded_document_with_spaces = decoded_document_key.replace('+', ' ').replace('%20', ' ')
         s3_url = f"s3://{bucket_name}/{decoded_document_with_spaces}"
+        etag = event['Records'][0]['s3']['object'].get('eTag', '')
+
+        # Re-uploads and copies of identical content were already ingested with this config
+        if not filter_changed([(s3_url, etag)]):
+            message = f"Object {decoded_document_with_spaces} is unchanged since it was last ingested. Skipping."
+            print(message)
+            log_to_cloudwatch(message)
+            return {
+                'statusCode': 200,
+                'body': json.dumps(message)
+            }
 
-        if does_object_exist(bucket_name, decoded_document_with_spaces):
+        # Incremental jobs diff the object's chunks against the database themselves, so the
+        # existing vectors must survive until the job runs
+        if os.environ.get('INCREMENTAL_INGEST') != 'true' and does_object_exist(bucket_name, decoded_document_with_spaces):
             message = f"Object {document_key} already exists. Deleting vectors from database."
             print(message)
             log_to_cloudwatch(message)
-            # Retrieve the API key and index name from environment variables
-            api_key = os.environ['PINECONE_API_KEY']
-            index_name = os.environ['PINECONE_INDEX_NAME']
             try:
-                delete_from_pinecone(os.path.basename(decoded_document_with_spaces), api_key, index_name)
+                _, delete_messages = delete_from_pinecone([s3_url])
+                for delete_message in delete_messages:
+                    log_to_cloudwatch(delete_message)
             except Exception as e:
                 error_message = f"Error deleting from Pinecone: {e}"
                 print(error_message)
                 log_to_cloudwatch(error_message)
 
-        return add_files(s3_url)
+        return add_files([s3_url], [etag])
 
     else:
-        # Handle custom resource event (initial processing)
-        message = "Custom resource event received. Listing objects in S3 bucket."
-        print(message)
-        log_to_cloudwatch(message)
-
+        # Handle custom resource event (initial processing) or a resumed backfill
         bucket_name = os.environ['S3_BUCKET_NAME']
         prefix = os.environ.get('S3_NOTIFICATION_PREFIX', '')
-        
-        # List existing objects in the bucket
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        
-        if 'Contents' in response:
-            for item in response['Contents']:
-                document_key = item['Key']
-                s3_url = f"s3://{bucket_name}/{document_key}"
-
-                # Skip the object if its size is 0 (indicating it's a folder)
-                if item['Size'] == 0:
-                    message = f"Skipping folder: {document_key}"
-                    print(message)
-                    log_to_cloudwatch(message)
-                    continue
-                
-                add_files(s3_url)
+
+        if 'BackfillResume' in event:
+            message = f"Resuming backfill {event['BackfillResume']}."
+            print(message)
+            log_to_cloudwatch(message)
+            checkpoint = load_checkpoint(event['BackfillResume'])
         else:
-            message = "No objects found in the bucket."
+            message = "Custom resource event received. Listing objects in S3 bucket."
             print(message)
             log_to_cloudwatch(message)
+            checkpoint = start_backfill(bucket_name, prefix)
+
+        # Incremental jobs diff each object's chunks themselves; full-mode jobs need the earlier
+        # version of every object ingested before cleared first
+        clear = None if os.environ.get('INCREMENTAL_INGEST') == 'true' else clear_previous_versions
+        summary = run_backfill(checkpoint, add_manifests, context, clear)
+
+        if summary['complete'] and summary['submitted'] == 0 and summary['unchanged'] == 0:
+            message = "No objects found in the bucket."
+        else:
+            message = f"Backfill submitted {summary['submitted']} object(s) so far, skipping {summary['unchanged']} unchanged; complete: {summary['complete']}."
+        print(message)
+        log_to_cloudwatch(message)
 
         return {
             'statusCode': 200,
@@ -155,8 +146,8 @@ def does_object_exist(bucket_name, document_key):
         print(f"Unexpected error: {e}")
         raise
 
-def add_files(s3_url):  
-    # Environment variables 
+def get_job_environment():
+    # Environment variables
     aws_access_key = os.environ['MY_AWS_ACCESS_KEY_ID']
     aws_secret_key = os.environ['MY_AWS_SECRET_ACCESS_KEY']
     embedding_provider = os.environ['EMBEDDING_PROVIDER']
@@ -167,6 +158,36 @@ def add_files(s3_url):
     pinecone_api_key = os.environ['PINECONE_API_KEY']
     pinecone_index_name = os.environ['PINECONE_INDEX_NAME']
     local_file_download_dir = '/tmp/'  # Temporary directory for Lambda file storage
+    ingest_mode = 'incremental' if os.environ.get('INCREMENTAL_INGEST') == 'true' else 'full'
+
+    return [
+        {'name': 'AWS_ACCESS_KEY_ID', 'value': aws_access_key},
+        {'name': 'AWS_SECRET_ACCESS_KEY', 'value': aws_secret_key},
+        {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
+        {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
+        {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
+        {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
+        {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
+        {'name': 'PINECONE_API_KEY', 'value': pinecone_api_key},
+        {'name': 'PINECONE_INDEX_NAME', 'value': pinecone_index_name},
+        {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
+        {'name': 'INGEST_MODE', 'value': ingest_mode},
+    ] + [
+        {'name': name, 'value': os.environ[name]}
+        for name in ('PINECONE_LAYOUT', 'PINECONE_NAMESPACE', 'PINECONE_NAMESPACE_SHARDS')
+        if name in os.environ
+    ]
+
+def add_files(s3_urls, etags):
+    # s3_urls is a manifest of objects that a single Batch job ingests in one container;
+    # etags lines up with it and is recorded once the job has been submitted
+    if is_worker_dispatch():
+        job_id = enqueue_manifests([s3_urls])[0]
+        record_ingests(zip(s3_urls, etags), job_id)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f"Queued {len(s3_urls)} object(s) for the ingest workers as {job_id}")
+        }
 
     # Generate a valid job name
     job_name = f"BatchJob_{uuid.uuid4()}"
@@ -178,24 +199,25 @@ def add_files(s3_url):
         jobDefinition=os.environ['JOB_DEFINITION'],  # Job definition from environment variables
         containerOverrides={
             'environment': [
-                {'name': 'AWS_S3_URL', 'value': s3_url},
-                {'name': 'AWS_ACCESS_KEY_ID', 'value': aws_access_key},
-                {'name': 'AWS_SECRET_ACCESS_KEY', 'value': aws_secret_key},
-                {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
-                {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
-                {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
-                {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
-                {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
-                {'name': 'PINECONE_API_KEY', 'value': pinecone_api_key},
-                {'name': 'PINECONE_INDEX_NAME', 'value': pinecone_index_name},
-                {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
-                {'name': 'APP_SCRIPT', 'value': app_script},
-            ],
+                {'name': 'AWS_S3_URLS', 'value': json.dumps(s3_urls)},
+            ] + get_job_environment(),
         },
     )
+    record_ingests(zip(s3_urls, etags), response['jobId'])
 
     # Response with job information
     return {
         'statusCode': 200,
-        'body': json.dumps(f"Started Batch Job: {response['jobId']}")
-    }
\ No newline at end of file
+        'body': json.dumps(f"Started Batch Job: {response['jobId']} for {len(s3_urls)} object(s)")
+    }
+
+def add_manifests(manifests):
+    # Backfill path: write the manifests as shards and fan them out as array jobs
+    return submit_manifests(manifests, get_job_environment())
+
+def clear_previous_versions(s3_urls):
+    # Backfill path: drop what the destination holds for re-submitted objects, as the S3 event
+    # path does for an object that already exists
+    _, delete_messages = delete_from_pinecone(s3_urls)
+    for delete_message in delete_messages:
+        log_to_cloudwatch(delete_message)
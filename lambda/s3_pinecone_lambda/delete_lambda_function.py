@@ -4,12 +4,16 @@ import os
 import urllib.parse
 import boto3
 import time
-from pinecone import Pinecone
+from pinecone_utils import delete_from_pinecone
+from ingest_record_utils import forget_ingests
 
 logs_client = boto3.client('logs')
 log_group_name = os.environ['CENTRAL_LOG_GROUP_NAME']
 log_stream_name = 'deleteLambda-log-stream'
 
+# PutLogEvents accepts at most 10,000 events per call
+MAX_LOG_EVENTS = 10000
+
 try:
     logs_client.create_log_stream(
         logGroupName=log_group_name,
@@ -18,63 +22,53 @@ try:
 except logs_client.exceptions.ResourceAlreadyExistsException:
     pass
 
-def log_to_cloudwatch(message):
+def log_to_cloudwatch(messages):
     timestamp = int(round(time.time() * 1000))
 
-    logs_client.put_log_events(
-        logGroupName=log_group_name,
-        logStreamName=log_stream_name,
-        logEvents=[
-            {
-                'timestamp': timestamp,
-                'message': message
-            }
-        ]
-    )
-
-def delete_from_pinecone(filename, api_key, index_name):
-    # Initialize Pinecone and connect to the index
-    pc = Pinecone(api_key=api_key)
-    index = pc.Index(index_name)
-
-    # Start timing the operation
-    start_time = time.time()
-
-    # Delete all vectors in the specified namespace
-    index.delete(delete_all=True, namespace=filename)
-
-    print(f"Deleted all vectors in the namespace '{filename}'.")
-
-    # End timing and calculate duration
-    end_time = time.time()
-    duration = end_time - start_time
-    print(f"Total delete process took {duration:.2f} seconds.")
-
-def lambda_handler(event, context):
-    # Retrieve the API key and index name from environment variables
-    api_key = os.environ['PINECONE_API_KEY']
-    index_name = os.environ['PINECONE_INDEX_NAME']
+    for start in range(0, len(messages), MAX_LOG_EVENTS):
+        logs_client.put_log_events(
+            logGroupName=log_group_name,
+            logStreamName=log_stream_name,
+            logEvents=[
+                {
+                    'timestamp': timestamp,
+                    'message': message
+                }
+                for message in messages[start:start + MAX_LOG_EVENTS]
+            ]
+        )
 
+def get_deleted_files(event):
+    # The bucket and decoded filename of each deleted object, by its s3:// URL, once each
+    deleted_files = {}
     for record in event['Records']:
         s3_bucket = record['s3']['bucket']['name']
-        s3_key = record['s3']['object']['key']
+        decoded_key = urllib.parse.unquote(record['s3']['object']['key']).replace('+', ' ').replace('%20', ' ')
+        deleted_files[f"s3://{s3_bucket}/{decoded_key}"] = (s3_bucket, os.path.basename(decoded_key))
+    return deleted_files
+
+def lambda_handler(event, context):
+    start_time = time.time()
+    deleted_files = get_deleted_files(event)
+    messages = [f"Deleting File: {filename} from Bucket: {s3_bucket}" for s3_bucket, filename in deleted_files.values()]
+    for message in messages:
+        print(message)
 
-        filename = os.path.basename(s3_key)
-        message = f"Deleting File: {filename} from Bucket: {s3_bucket}"
+    s3_urls = sorted(deleted_files)
+    try:
+        deleted_urls, delete_messages = delete_from_pinecone(s3_urls)
+        messages.extend(delete_messages)
+        # Forget the ingest records so re-uploading the same content ingests it again
+        forget_ingests([url for url in s3_urls if url in deleted_urls])
+        print(f"Deleted {len(deleted_urls)} of {len(s3_urls)} file(s) in {time.time() - start_time:.2f} seconds.")
+    except Exception as e:
+        message = f"Error deleting from Pinecone: {e}"
         print(message)
-        log_to_cloudwatch(message)
+        messages.append(message)
 
-        try:
-            decoded_filename = urllib.parse.unquote(filename)
-            decoded_filename_with_spaces = decoded_filename.replace('+', ' ').replace('%20', ' ')
-            delete_from_pinecone(decoded_filename_with_spaces, api_key, index_name)
-            print(f"Deleted File: {decoded_filename_with_spaces} from Bucket: {s3_bucket}")
-        except Exception as e:
-            message = f"Error deleting from Pinecone: {e}"
-            print(message)
-            log_to_cloudwatch(message)
+    log_to_cloudwatch(messages)
 
     return {
         'statusCode': 200,
         'body': json.dumps('Processed deleted files and updated Pinecone index.')
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,44 @@
+import json
+import boto3
+import os
+from connection_utils import encode_frame
+from log_store_utils import LOG_PAGE_SIZE, query_log_page
+
+WEBSOCKET_API_URL = os.environ['WEBSOCKET_API_URL']
+
+http_endpoint_url = WEBSOCKET_API_URL.replace("wss://", "https://")
+apigateway_management_api = boto3.client('apigatewaymanagementapi', endpoint_url=http_endpoint_url)
+
+def lambda_handler(event, context):
+    # {"action": "fetchLogs", "before": <logsCursor>, "limit": <entries>} answers the asking
+    # connection with the next older page of log entries
+    connection_id = event['requestContext']['connectionId']
+    request = json.loads(event.get('body') or '{}')
+
+    try:
+        logs, logs_cursor = query_log_page(request.get('before'), request.get('limit') or LOG_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 400,
+            'body': 'Invalid log cursor'
+        }
+
+    response_message = {
+        "type": "logsPage",
+        "before": request.get('before'),
+        "logs": logs,
+        "logsCursor": logs_cursor,
+    }
+
+    try:
+        apigateway_management_api.post_to_connection(
+            ConnectionId=connection_id,
+            Data=encode_frame(response_message)
+        )
+    except apigateway_management_api.exceptions.GoneException:
+        print(f"Connection {connection_id} is no longer valid.")
+
+    return {
+        'statusCode': 200,
+        'body': f"Sent {len(logs)} log entries"
+    }
@@ -0,0 +1,91 @@
+# lambda/s3_pinecone_lambda/index_count_utils.py
+
+import os
+import time
+import boto3
+from decimal import Decimal
+
+dynamodb = boto3.resource('dynamodb')
+client_data_table = dynamodb.Table(os.environ['CLIENT_DATA_TABLE_NAME'])
+
+# Index-wide totals live in one item of the client data table. The telemetry consumer keeps them
+# current from the ingest and delete records it receives; a scheduled reconcile resets them from
+# describe_index_stats to correct any drift.
+INDEX_TOTALS_KEY = {'clientId': 'index_totals', 'timestamp': 0}
+
+
+def to_int(value):
+    return int(value) if isinstance(value, Decimal) else (value or 0)
+
+def apply_index_deltas(vector_delta, document_delta):
+    # ADD creates the attributes at zero if they are missing, so no read is needed first
+    response = client_data_table.update_item(
+        Key=INDEX_TOTALS_KEY,
+        UpdateExpression='ADD totalVectors :vectors, totalDocuments :documents',
+        ExpressionAttributeValues={':vectors': vector_delta, ':documents': document_delta},
+        ReturnValues='UPDATED_NEW',
+    )
+    attributes = response['Attributes']
+    return to_int(attributes.get('totalVectors')), to_int(attributes.get('totalDocuments'))
+
+def get_index_totals(index):
+    response = client_data_table.get_item(Key=INDEX_TOTALS_KEY)
+    item = response.get('Item')
+    if not item or 'ReconciledAt' not in item:
+        # Never reconciled, so the totals don't yet include what was in the index before counting began
+        return reconcile_index_totals(index)
+    return to_int(item.get('totalVectors')), to_int(item.get('totalDocuments'))
+
+def reconcile_index_totals(index):
+    # The only place that calls the Pinecone control plane for counts
+    stats = index.describe_index_stats()
+    total_vectors = stats.get('total_vector_count', 0)
+
+    if os.environ.get('PINECONE_LAYOUT') == 'prefix':
+        # Documents share namespaces, and counting them would mean listing every ID, so the
+        # document total is left to the telemetry deltas and only the vector total is reset
+        response = client_data_table.update_item(
+            Key=INDEX_TOTALS_KEY,
+            UpdateExpression='SET totalVectors = :vectors, ReconciledAt = :reconciled_at',
+            ExpressionAttributeValues={':vectors': total_vectors, ':reconciled_at': int(time.time() * 1000)},
+            ReturnValues='ALL_NEW',
+        )
+        total_documents = to_int(response['Attributes'].get('totalDocuments'))
+    else:
+        # Each namespace is a document
+        total_documents = len(stats.get('namespaces', {}))
+        client_data_table.put_item(Item={
+            **INDEX_TOTALS_KEY,
+            'totalVectors': total_vectors,
+            'totalDocuments': total_documents,
+            'ReconciledAt': int(time.time() * 1000),
+        })
+    print(f"Reconciled index totals: {total_vectors} vectors in {total_documents} documents")
+    return total_vectors, total_documents
+
+def update_ingestion_counts(client_id, vectors_written_delta, documents_ingested_delta):
+    # One atomic update for both of a client's counters; UPDATED_NEW hands back the new values so
+    # they aren't read again. Returns None if the update failed: the error is logged rather than
+    # raised, because the index totals have been applied by then and a retried batch would apply
+    # them twice.
+    try:
+        response = client_data_table.update_item(
+            Key={'clientId': client_id, 'timestamp': 0},
+            UpdateExpression=(
+                'SET vectorsWritten = if_not_exists(vectorsWritten, :start) + :vectors, '
+                'documentsIngested = if_not_exists(documentsIngested, :start) + :documents'
+            ),
+            ExpressionAttributeValues={
+                ':vectors': vectors_written_delta,
+                ':documents': documents_ingested_delta,
+                ':start': 0,
+            },
+            ReturnValues='UPDATED_NEW',
+        )
+    except Exception as e:
+        print(f"Error updating ingestion counts: {str(e)}")
+        return None
+
+    counts = response['Attributes']
+    print(f"Ingestion counts updated to {counts['vectorsWritten']} vectors and {counts['documentsIngested']} documents")
+    return to_int(counts.get('vectorsWritten')), to_int(counts.get('documentsIngested'))
@@ -3,16 +3,18 @@ import boto3
 import os
 from decimal import Decimal
 from pinecone import Pinecone
+from index_count_utils import get_index_totals
+from connection_utils import DASHBOARD_CLIENT_ID, encode_frame, get_sequence
+from job_status_utils import JOB_STATUSES, get_job_status_counts
+from log_store_utils import query_log_page
+from stage_metrics_utils import get_stage_percentiles_or_empty
 
-batch_client = boto3.client('batch')
 dynamodb = boto3.resource('dynamodb')
 
 source_destination_embedding = os.environ['SOURCE_DESTINATION_EMBEDDING']
 
-connection_table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
 client_data_table = dynamodb.Table(os.environ['CLIENT_DATA_TABLE_NAME'])
-
-JOB_QUEUE = os.environ['JOB_QUEUE'].split('/')[1]
+connection_table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
 
 pc = Pinecone(os.environ['PINECONE_API_KEY'])
 index = pc.Index(os.environ['PINECONE_INDEX_NAME'])
@@ -24,24 +26,20 @@ apigateway_management_api = boto3.client('apigatewaymanagementapi', endpoint_url
 
 def lambda_handler(event, context):
     print("Received initial check request.")
-    connection_id = get_connection_id_from_dynamodb()
+    # Answer the connection that asked; every other viewer already has its state
+    connection_id = event['requestContext']['connectionId']
+    client_id = DASHBOARD_CLIENT_ID
     print(f"Connection ID: {connection_id}")
 
-    if not connection_id:
-        print("No connection ID found for the client.")
-        return {
-            'statusCode': 404,
-            'body': 'Connection ID not found'
-        }
-
-    client_id = get_client_id_from_dynamodb()
-
-    total_vectors = get_vector_count_from_pinecone()
-    total_documents = get_document_count_from_pinecone()
+    # Read before the snapshot, so any broadcast it might miss is numbered after it. Frames the
+    # snapshot already reflects carry current values, so the viewer applying them again is harmless.
+    seq = get_sequence_or_none()
+    total_vectors, total_documents = get_index_totals_or_zero()
     vectors_written = get_ingestion_count_data(client_id, 'vectorsWritten')
     documents_ingested = get_ingestion_count_data(client_id, 'documentsIngested')
-    logs = get_all_logs()
-    job_status_counts = get_job_status_counts()
+    logs, logs_cursor = get_recent_logs()
+    job_status_counts = get_job_status_counts_or_none()
+    stage_percentiles = get_stage_percentiles_or_empty()
 
     response_message = {
         "type": "initialCheckResponse",
@@ -50,14 +48,18 @@ def lambda_handler(event, context):
         "totalDocuments": total_documents,
         "vectorsWritten": vectors_written,
         "documentsIngested": documents_ingested,
-        "jobStatusCounts": job_status_counts,
+        # Zeros until the scheduled reconcile has counted the jobs for the first time
+        "jobStatusCounts": job_status_counts or {status: 0 for status in JOB_STATUSES},
+        "jobStatusCountsReconciled": job_status_counts is not None,
+        "stagePercentiles": stage_percentiles,
         "logs": logs,
+        "logsCursor": logs_cursor,
     }
 
     try:
         apigateway_management_api.post_to_connection(
             ConnectionId=connection_id,
-            Data=json.dumps(response_message)
+            Data=encode_frame(response_message, seq)
         )
         print(f"Sent initial check response to connection {connection_id}")
     except apigateway_management_api.exceptions.GoneException:
@@ -68,111 +70,39 @@ def lambda_handler(event, context):
         'body': json.dumps('Initial check request processed successfully')
     }
 
-def get_client_id_from_dynamodb():
-    response = connection_table.scan()
-    if response.get('Items'):
-        most_recent_entry = max(response['Items'], key=lambda x: x['timestamp'])
-        return most_recent_entry['clientId']
-    return None
-
-def get_connection_id_from_dynamodb():
-    response = connection_table.scan()
-    if response.get('Items'):
-        most_recent_entry = max(response['Items'], key=lambda x: x['timestamp'])
-        return most_recent_entry['connectionId']
-    return None
-
-def get_all_logs():
+def get_sequence_or_none():
+    # Without a number the viewer takes up the sequence from the next frame it receives
     try:
-        response = client_data_table.scan(
-            FilterExpression='dataType = :dataType',
-            ExpressionAttributeValues={':dataType': 'logs'},
-        )
-        
-        logs = response.get('Items', [])
-        formatted_logs = []
-
-        print("Unformatted logs data from DynamoDB:", logs)
-
-        for log in logs:
-            log_data = log.get('logData', [])
-            for entry in log_data:
-                message = entry.get('message', '')
-                timestamp_str = entry.get('timestamp', None)
-
-                if not message:
-                    continue
+        return get_sequence(connection_table, DASHBOARD_CLIENT_ID)
 
-                if timestamp_str:
-                    timestamp = int(timestamp_str)
-                else:
-                    timestamp = None
+    except Exception as e:
+        print(f"Error fetching broadcast sequence: {str(e)}")
+        return None
 
-                formatted_logs.append({
-                    'message': message,
-                    'timestamp': timestamp
-                })
-        
-        formatted_logs = sorted(formatted_logs, key=lambda log: log['timestamp'] if log['timestamp'] is not None else 0, reverse=True)
+def get_recent_logs():
+    # Only the newest page; the dashboard asks for older ones through the fetchLogs route
+    try:
+        return query_log_page()
 
-        return formatted_logs
-    
     except Exception as e:
         print(f"Error fetching logs: {str(e)}")
-        return []
+        return [], None
 
-def get_job_status_counts():
-    statuses = ['SUBMITTED', 'STARTING', 'PENDING', 'RUNNING', 'SUCCEEDED', 'FAILED']
-    job_counts = {status: 0 for status in statuses}
-    
+def get_job_status_counts_or_none():
     try:
-        next_token = None
-        for status in statuses:
-            job_counts[status] = 0
-            
-            while True:
-                params = {
-                    'jobStatus': status,
-                    'jobQueue': JOB_QUEUE,
-                    'maxResults': 100
-                }
-                
-                if next_token:
-                    params['nextToken'] = next_token
-                
-                response = batch_client.list_jobs(**params)
-                
-                job_counts[status] += len(response.get('jobSummaryList', []))
-                
-                next_token = response.get('nextToken')
-                if not next_token:
-                    break
-
-        return job_counts
+        return get_job_status_counts()
 
     except Exception as e:
         print(f"Error fetching job statuses: {str(e)}")
-        return {status: 0 for status in statuses}
-    
-def get_vector_count_from_pinecone():
-    try:
-        stats = index.describe_index_stats()
-        vector_count = stats.get('total_vector_count', 0)
-        return vector_count
-    
-    except Exception as e:
-        print(f"Error fetching vector count from Pinecone: {str(e)}")
-        return 0
+        return None
 
-def get_document_count_from_pinecone():
+def get_index_totals_or_zero():
     try:
-        stats = index.describe_index_stats()
-        namespaces = stats.get('namespaces', {})
-        return len(namespaces)
+        return get_index_totals(index)
     
     except Exception as e:
-        print(f"Error fetching namespace count from Pinecone: {str(e)}")
-        return 0
+        print(f"Error fetching index totals: {str(e)}")
+        return 0, 0
 
 def get_ingestion_count_data(client_id, count_type):
     try:
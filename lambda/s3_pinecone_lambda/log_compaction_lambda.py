@@ -0,0 +1,11 @@
+from log_store_utils import compact_logs, delete_legacy_log_batches
+
+def lambda_handler(event, context):
+    # Scheduled: rolls log lines past the compaction horizon into hourly summaries
+    compacted = compact_logs()
+    deleted = delete_legacy_log_batches()
+
+    return {
+        'statusCode': 200,
+        'body': f"Compacted {compacted} log lines, deleted {deleted} legacy log batches"
+    }
@@ -0,0 +1,209 @@
+# lambda/s3_pinecone_lambda/log_store_utils.py
+
+import json
+import os
+import time
+import zlib
+from collections import defaultdict
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from connection_utils import DASHBOARD_CLIENT_ID
+
+dynamodb = boto3.resource('dynamodb')
+client_data_table = dynamodb.Table(os.environ['CLIENT_DATA_TABLE_NAME'])
+
+# Dashboard log lines are kept one item each in a partition of their own, sorted by time, so the
+# newest page is a single Query. The sort key is the line's millisecond timestamp with three
+# digits from a hash of the message, which keeps lines logged in the same millisecond apart. Lines
+# never take the last of those values: it is kept for the hourly summaries, so no line can land on
+# a summary's key.
+LOG_PARTITION_KEY = f"logs#{DASHBOARD_CLIENT_ID}"
+LOG_SUMMARY_SLOT = 999
+LOG_PAGE_SIZE = int(os.environ.get('LOG_PAGE_SIZE', '20'))
+LOG_PAGE_MAX_SIZE = 100
+# A page goes out as one WebSocket frame, and API Gateway caps frames at 128 KB
+LOG_PAGE_MAX_BYTES = 96 * 1024
+
+# Retention: lines older than LOG_COMPACT_AFTER_HOURS are rolled up by the hourly compaction into one
+# summary item per hour, stored in the same partition so paging carries on into them. Both kinds
+# also carry an ExpiresAt TTL (0 days keeps them forever); for lines it is only a backstop.
+LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', '7'))
+LOG_SUMMARY_RETENTION_DAYS = int(os.environ.get('LOG_SUMMARY_RETENTION_DAYS', '90'))
+LOG_COMPACT_AFTER_HOURS = int(os.environ.get('LOG_COMPACT_AFTER_HOURS', '24'))
+LOG_COMPACTION_KEY = {'clientId': 'log_compaction', 'timestamp': 0}
+HOUR_MS = 60 * 60 * 1000
+# Matched in order; a line counts towards the first category it matches
+LOG_SUMMARY_CATEGORIES = [
+    ('errors', ('MainProcess ERROR', 'Exception raised')),
+    ('ingested', ('ingest process finished in',)),
+    ('deleted', ('Deleting vectors from database', 'Deleting File:')),
+    ('partitioned', ('calling PartitionStep',)),
+    ('chunked', ('calling ChunkStep',)),
+    ('embedded', ('calling EmbedStep',)),
+    ('uploaded', ('writing a total of',)),
+]
+
+
+def get_log_sort_key(entry):
+    return int(entry['timestamp']) * 1000 + zlib.crc32(entry['message'].encode('utf-8')) % LOG_SUMMARY_SLOT
+
+def get_log_summary_key(hour_start):
+    # The reserved slot of the hour's last millisecond, so the summary sorts after every line of its hour
+    return (hour_start + HOUR_MS - 1) * 1000 + LOG_SUMMARY_SLOT
+
+def get_expires_at(timestamp_ms, retention_days):
+    return {'ExpiresAt': timestamp_ms // 1000 + retention_days * 24 * 60 * 60} if retention_days else {}
+
+def store_log_entries(entries):
+    with client_data_table.batch_writer(overwrite_by_pkeys=['clientId', 'timestamp']) as batch:
+        for entry in entries:
+            batch.put_item(Item={
+                'clientId': LOG_PARTITION_KEY,
+                'timestamp': get_log_sort_key(entry),
+                'dataType': 'log',
+                'logTimestamp': int(entry['timestamp']),
+                'message': entry['message'],
+                **get_expires_at(int(entry['timestamp']), LOG_RETENTION_DAYS),
+            })
+
+def query_log_page(before=None, limit=LOG_PAGE_SIZE):
+    # Newest first. Returns the entries and the cursor for the next older page, or None once
+    # there is nothing older.
+    limit = max(1, min(int(limit), LOG_PAGE_MAX_SIZE))
+    key_condition = Key('clientId').eq(LOG_PARTITION_KEY)
+    if before is not None:
+        key_condition = key_condition & Key('timestamp').lt(int(before))
+
+    response = client_data_table.query(
+        KeyConditionExpression=key_condition,
+        ScanIndexForward=False,
+        Limit=limit,
+    )
+    items = response.get('Items', [])
+
+    entries = []
+    page_bytes = 0
+    for item in items:
+        if item.get('dataType') == 'logSummary':
+            summary = {field: int(item.get(field, 0)) for field in get_summary_fields()}
+            entry = {
+                'timestamp': int(item['logTimestamp']),
+                'message': describe_summary(int(item['logTimestamp']), summary),
+                'summary': summary,
+            }
+        else:
+            entry = {'timestamp': int(item['logTimestamp']), 'message': item['message']}
+        page_bytes += len(json.dumps(entry))
+        if entries and page_bytes > LOG_PAGE_MAX_BYTES:
+            break
+        entries.append((int(item['timestamp']), entry))
+
+    has_older = len(entries) < len(items) or 'LastEvaluatedKey' in response
+    cursor = entries[-1][0] if entries and has_older else None
+    return [entry for _, entry in entries], cursor
+
+def get_summary_fields():
+    return ['lines'] + [category for category, _ in LOG_SUMMARY_CATEGORIES]
+
+def categorize_log_line(message):
+    for category, patterns in LOG_SUMMARY_CATEGORIES:
+        if any(pattern in message for pattern in patterns):
+            return category
+    return None
+
+def describe_summary(hour_start, counts):
+    hour = time.strftime('%Y-%m-%d %H:00', time.gmtime(hour_start / 1000))
+    parts = [f"{counts[category]} {category}" for category, _ in LOG_SUMMARY_CATEGORIES if counts.get(category)]
+    return f"Hourly summary for {hour} UTC: {counts['lines']} log lines" + (f" ({', '.join(parts)})" if parts else "")
+
+def compact_logs(now_ms=None):
+    # Rolls every line older than the compaction horizon into its hour's summary and deletes it.
+    # A watermark bounds the Query to the lines not yet compacted, so each run reads about one
+    # hour's worth. Returns how many lines were compacted.
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    compact_before = (now_ms - LOG_COMPACT_AFTER_HOURS * HOUR_MS) // HOUR_MS * HOUR_MS
+    watermark = client_data_table.get_item(Key=LOG_COMPACTION_KEY).get('Item', {}).get('compactedBefore', 0)
+    if compact_before <= watermark:
+        return 0
+
+    hours = defaultdict(lambda: defaultdict(int))
+    line_keys = []
+    query = {
+        'KeyConditionExpression': Key('clientId').eq(LOG_PARTITION_KEY)
+            & Key('timestamp').between(int(watermark) * 1000, compact_before * 1000 - 1),
+        'FilterExpression': Attr('dataType').eq('log'),
+        'ProjectionExpression': '#timestamp, logTimestamp, message',
+        'ExpressionAttributeNames': {'#timestamp': 'timestamp'},
+    }
+    while True:
+        response = client_data_table.query(**query)
+        for item in response.get('Items', []):
+            hour_start = int(item['logTimestamp']) // HOUR_MS * HOUR_MS
+            counts = hours[hour_start]
+            counts['lines'] += 1
+            category = categorize_log_line(item['message'])
+            if category:
+                counts[category] += 1
+            # A line stored before the summary slot was reserved may sit on its hour's summary key;
+            # writing the summary turns it into the summary, so it must not be deleted afterwards
+            if int(item['timestamp']) != get_log_summary_key(hour_start):
+                line_keys.append(item['timestamp'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    for hour_start, counts in hours.items():
+        write_log_summary(hour_start, counts)
+    # Summaries first, so a run that dies part way leaves lines counted twice at worst, not lost
+    with client_data_table.batch_writer() as batch:
+        for line_key in line_keys:
+            batch.delete_item(Key={'clientId': LOG_PARTITION_KEY, 'timestamp': line_key})
+
+    client_data_table.put_item(Item={**LOG_COMPACTION_KEY, 'compactedBefore': compact_before})
+    print(f"Compacted {len(line_keys)} log lines into {len(hours)} hourly summaries")
+    return len(line_keys)
+
+def write_log_summary(hour_start, counts):
+    # Lines delivered after their hour was compacted sit below the watermark and are left to their TTL
+    fields = get_summary_fields()
+    client_data_table.update_item(
+        Key={'clientId': LOG_PARTITION_KEY, 'timestamp': get_log_summary_key(hour_start)},
+        UpdateExpression=(
+            'SET dataType = :data_type, logTimestamp = :hour_start'
+            + (', ExpiresAt = :expires_at' if LOG_SUMMARY_RETENTION_DAYS else '')
+            # Drops what a line that sat on the summary's key left behind
+            + ' REMOVE message' + ('' if LOG_SUMMARY_RETENTION_DAYS else ', ExpiresAt')
+            + ' ADD ' + ', '.join(f'#{field} :{field}' for field in fields)
+        ),
+        ExpressionAttributeNames={f'#{field}': field for field in fields},
+        ExpressionAttributeValues={
+            ':data_type': 'logSummary',
+            ':hour_start': hour_start,
+            **{f':{field}': counts.get(field, 0) for field in fields},
+            **({':expires_at': get_expires_at(hour_start, LOG_SUMMARY_RETENTION_DAYS)['ExpiresAt']}
+               if LOG_SUMMARY_RETENTION_DAYS else {}),
+        },
+    )
+
+def delete_legacy_log_batches():
+    # Log batches from before lines had their own partition sit under the dashboard client itself,
+    # after its counters item at timestamp 0
+    query = {
+        'KeyConditionExpression': Key('clientId').eq(DASHBOARD_CLIENT_ID) & Key('timestamp').gt(0),
+        'FilterExpression': Attr('dataType').eq('logs'),
+        'ProjectionExpression': '#timestamp',
+        'ExpressionAttributeNames': {'#timestamp': 'timestamp'},
+    }
+    deleted = 0
+    with client_data_table.batch_writer() as batch:
+        while True:
+            response = client_data_table.query(**query)
+            for item in response.get('Items', []):
+                batch.delete_item(Key={'clientId': DASHBOARD_CLIENT_ID, 'timestamp': item['timestamp']})
+                deleted += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    if deleted:
+        print(f"Deleted {deleted} legacy log batches")
+    return deleted
@@ -1,22 +1,100 @@
 # lambda/s3_pinecone_lambda/pinecone_utils.py
 
+import hashlib
+import json
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pinecone import Pinecone
 
-def delete_from_pinecone(filename, api_key, index_name):
-    # Initialize Pinecone and connect to the index
-    pc = Pinecone(api_key=api_key)
-    index = pc.Index(index_name)
+# The client and index handle are created on first use and kept at module scope, so warm
+# invocations reuse the index's pooled HTTPS connections rather than resolving the index host and
+# opening new ones. urllib3 retries a pooled connection the server has since closed on its own.
+# Deletes run concurrently, one pool connection per thread.
+PINECONE_POOL_THREADS = int(os.environ.get('PINECONE_POOL_THREADS', '16'))
 
-    # Start timing the operation
-    start_time = time.time()
+# Layouts, which the ingest script mirrors. "namespace": each file is a namespace named after its
+# basename, so files with the same name under different prefixes share one. "prefix": every file
+# lives in PINECONE_NAMESPACE, or is spread over PINECONE_NAMESPACE_SHARDS of them, under IDs that
+# start with a key hashed from its S3 URL. Listing IDs by prefix needs a serverless index.
+PINECONE_LAYOUT = os.environ.get('PINECONE_LAYOUT', 'namespace')
+PINECONE_NAMESPACE = os.environ.get('PINECONE_NAMESPACE', 'documents')
+PINECONE_NAMESPACE_SHARDS = int(os.environ.get('PINECONE_NAMESPACE_SHARDS', '1'))
+# Pinecone caps deletes at 1,000 IDs per request
+PINECONE_DELETE_BATCH_SIZE = 1000
 
-    # Delete all vectors in the specified namespace
-    index.delete(delete_all=True, namespace=filename)
+_index = None
 
-    print(f"Deleted all vectors in the namespace '{filename}'.")
 
-    # End timing and calculate duration
-    end_time = time.time()
-    duration = end_time - start_time
-    print(f"Total delete process took {duration:.2f} seconds.")
\ No newline at end of file
+def get_index():
+    global _index
+    if _index is None:
+        pc = Pinecone(api_key=os.environ['PINECONE_API_KEY'])
+        _index = pc.Index(os.environ['PINECONE_INDEX_NAME'], pool_threads=PINECONE_POOL_THREADS)
+    return _index
+
+def get_document_key(s3_url):
+    return hashlib.sha256(s3_url.encode('utf-8')).hexdigest()[:32]
+
+def get_document_namespace(document_key):
+    if PINECONE_NAMESPACE_SHARDS <= 1:
+        return PINECONE_NAMESPACE
+    return f"{PINECONE_NAMESPACE}-{int(document_key, 16) % PINECONE_NAMESPACE_SHARDS}"
+
+def delete_document_vectors(index, s3_url):
+    # Prefix layout: list the document's IDs page by page and delete them in batches.
+    # Returns how many vectors went.
+    document_key = get_document_key(s3_url)
+    namespace = get_document_namespace(document_key)
+    vector_ids = [vector_id for page in index.list(prefix=f"{document_key}#", namespace=namespace) for vector_id in page]
+    for start in range(0, len(vector_ids), PINECONE_DELETE_BATCH_SIZE):
+        index.delete(ids=vector_ids[start:start + PINECONE_DELETE_BATCH_SIZE], namespace=namespace)
+    return len(vector_ids)
+
+def delete_from_pinecone(s3_urls):
+    # Returns the URLs whose vectors were deleted and the lines to log for the batch: a telemetry
+    # record per deleted document and an error line per failed one
+    index = get_index()
+
+    # A document is the file's namespace or its URL, depending on the layout
+    documents = {}
+    for s3_url in s3_urls:
+        document = s3_url if PINECONE_LAYOUT == 'prefix' else s3_url.split('/')[-1]
+        documents.setdefault(document, []).append(s3_url)
+
+    if PINECONE_LAYOUT != 'prefix':
+        # Count what is about to go so the telemetry consumer can adjust the index totals without polling
+        namespaces = index.describe_index_stats()['namespaces']
+
+    def delete_document(document):
+        start_time = time.time()
+        filename = document.split('/')[-1]
+        try:
+            if PINECONE_LAYOUT == 'prefix':
+                vector_count = delete_document_vectors(index, document)
+                print(f"Deleted {vector_count} vectors of '{document}'.")
+            else:
+                vector_count = namespaces[document]['vector_count'] if document in namespaces else 0
+                # Delete all vectors in the specified namespace
+                index.delete(delete_all=True, namespace=document)
+                print(f"Deleted all vectors in the namespace '{document}'.")
+        except Exception as e:
+            message = f"Error deleting {document} from Pinecone: {e}"
+            print(message)
+            return None, message
+
+        # Same record shape as the ingest scripts' telemetry
+        return document, json.dumps({
+            'telemetry': 1,
+            'stage': 'delete',
+            'document': filename,
+            'duration_ms': int((time.time() - start_time) * 1000),
+            'elements': vector_count,
+            'whole_document': vector_count > 0,
+        }, separators=(',', ':'))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(PINECONE_POOL_THREADS, len(documents)))) as executor:
+        results = list(executor.map(delete_document, documents))
+
+    deleted_urls = {s3_url for document, _ in results if document for s3_url in documents[document]}
+    return deleted_urls, [message for _, message in results]
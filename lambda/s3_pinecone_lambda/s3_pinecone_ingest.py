@@ -1,21 +1,29 @@
 # Start S3 and populate Pinecone
 
+import hashlib
+import json
 import os
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
+import sys
+from pinecone import Pinecone
 from unstructured_ingest.v2.interfaces import ProcessorConfig
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (S3IndexerConfig, S3DownloaderConfig, S3ConnectionConfig, S3AccessConfig)
-from unstructured_ingest.v2.processes.connectors.pinecone import (PineconeConnectionConfig, PineconeAccessConfig, PineconeUploaderConfig, PineconeUploadStagerConfig)
+from unstructured_ingest.v2.processes.connectors.pinecone import (PineconeConnectionConfig, PineconeAccessConfig, PineconeUploaderConfig, PineconeUploadStagerConfig, PineconeUploader)
 from unstructured_ingest.v2.processes.chunker import ChunkerConfig
-from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+from ingest_support import (
+    CachingEmbedderConfig, build_pipeline, ingest_incrementally, ingest_manifest, instrument_pipeline, load_manifest,
+    run_worker,
+)
 
-if __name__ == "__main__":
-    namespace = os.getenv("AWS_S3_URL").split("/")[-1]
+instrument_pipeline(PineconeUploader)
+
+def build_pipeline_configs(s3_url):
+    namespace = s3_url.split("/")[-1]
 
     # Prepare the configuration dictionary
     pipeline_configs = {
         "context": ProcessorConfig(),
-        "indexer_config": S3IndexerConfig(remote_url=os.getenv("AWS_S3_URL")),
+        "indexer_config": S3IndexerConfig(remote_url=s3_url),
         "downloader_config": S3DownloaderConfig(download_dir=os.getenv("LOCAL_FILE_DOWNLOAD_DIR")),
         "source_connection_config": S3ConnectionConfig(
             access_config=S3AccessConfig(
@@ -26,7 +34,7 @@ if __name__ == "__main__":
         "partitioner_config": PartitionerConfig(
             partition_by_api=False,
         ),
-        "embedder_config": EmbedderConfig(
+        "embedder_config": CachingEmbedderConfig(
             embedding_provider=os.getenv("EMBEDDING_PROVIDER"),
             embedding_model_name=os.getenv("EMBEDDING_MODEL_NAME"),
             embedding_api_key=os.getenv("EMBEDDING_PROVIDER_API_KEY"),
@@ -51,5 +59,83 @@ if __name__ == "__main__":
             chunk_overlap=20
         )
 
+    return pipeline_configs
+
+# Pinecone caps upserts at 1,000 vectors and deletes at 1,000 IDs per request
+PINECONE_UPSERT_BATCH_SIZE = 100
+PINECONE_DELETE_BATCH_SIZE = 1000
+
+# Same layouts as the Lambdas' pinecone_utils. "namespace" gives each file a namespace named after
+# its basename; "prefix" keeps every file in PINECONE_NAMESPACE (or PINECONE_NAMESPACE_SHARDS of
+# them) under IDs prefixed with a key hashed from its S3 URL, so same-named files don't collide.
+PINECONE_LAYOUT = os.getenv("PINECONE_LAYOUT", "namespace")
+PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE", "documents")
+PINECONE_NAMESPACE_SHARDS = int(os.getenv("PINECONE_NAMESPACE_SHARDS", "1"))
+
+def get_pinecone_index():
+    return Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(os.getenv("PINECONE_INDEX_NAME"))
+
+def get_vector_location(s3_url):
+    # The namespace the object's vectors live in and the prefix their IDs start with
+    if PINECONE_LAYOUT != "prefix":
+        return s3_url.split("/")[-1], ""
+    document_key = hashlib.sha256(s3_url.encode("utf-8")).hexdigest()[:32]
+    if PINECONE_NAMESPACE_SHARDS <= 1:
+        return PINECONE_NAMESPACE, f"{document_key}#"
+    return f"{PINECONE_NAMESPACE}-{int(document_key, 16) % PINECONE_NAMESPACE_SHARDS}", f"{document_key}#"
+
+def list_chunk_ids(s3_url):
+    # Every vector in the namespace under the object's ID prefix belongs to the object
+    namespace, id_prefix = get_vector_location(s3_url)
+    index = get_pinecone_index()
+    return {chunk_id for page in index.list(prefix=id_prefix or None, namespace=namespace) for chunk_id in page}
+
+def upload_chunks(s3_url, chunks):
+    vectors = []
+    for chunk_id, element in chunks:
+        metadata = {
+            "text": element["text"],
+            "element_id": element.get("element_id"),
+            "type": element.get("type"),
+            "filename": element["metadata"].get("filename"),
+            "page_number": element["metadata"].get("page_number"),
+        }
+        # Pinecone rejects null metadata values
+        vectors.append({
+            "id": chunk_id,
+            "values": element["embeddings"],
+            "metadata": {key: value for key, value in metadata.items() if value is not None},
+        })
+
+    namespace, _ = get_vector_location(s3_url)
+    index = get_pinecone_index()
+    for start in range(0, len(vectors), PINECONE_UPSERT_BATCH_SIZE):
+        index.upsert(vectors=vectors[start:start + PINECONE_UPSERT_BATCH_SIZE], namespace=namespace)
+
+def delete_chunks(s3_url, chunk_ids):
+    namespace, _ = get_vector_location(s3_url)
+    index = get_pinecone_index()
+    for start in range(0, len(chunk_ids), PINECONE_DELETE_BATCH_SIZE):
+        index.delete(ids=chunk_ids[start:start + PINECONE_DELETE_BATCH_SIZE], namespace=namespace)
+
+def ingest_object(s3_url):
+    # INGEST_MODE=incremental re-embeds only the chunks that changed since the file was last ingested.
+    # The pipeline's uploader picks its own vector IDs, so the prefix layout always takes this path.
+    # Returns whether the file is new to the index.
+    if os.getenv("INGEST_MODE") == "incremental" or PINECONE_LAYOUT == "prefix":
+        return ingest_incrementally(
+            s3_url, build_pipeline_configs(s3_url), list_chunk_ids, upload_chunks, delete_chunks,
+            id_prefix=get_vector_location(s3_url)[1],
+        )
+    build_pipeline(build_pipeline_configs(s3_url)).run()
+    # The add Lambda, or the backfill, already cleared any earlier version of the file
+    return True
+
+if __name__ == "__main__":
+    worker_queue_url = os.getenv("INGEST_WORKER_QUEUE_URL")
+    if worker_queue_url:
+        run_worker(worker_queue_url, ingest_object)
 
-    Pipeline.from_configs(**pipeline_configs).run()
\ No newline at end of file
+    # The manifest lists every object for this Batch job
+    if ingest_manifest(load_manifest(lambda: json.loads(os.getenv("AWS_S3_URLS"))), ingest_object):
+        sys.exit(1)
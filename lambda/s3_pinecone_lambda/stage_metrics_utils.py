@@ -0,0 +1,108 @@
+# lambda/s3_pinecone_lambda/stage_metrics_utils.py
+
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+import boto3
+
+cloudwatch = boto3.client('cloudwatch')
+
+# The ingest jobs log through the awslogs driver, which CloudWatch doesn't extract Embedded Metric
+# Format from, so the telemetry consumer republishes each batch of stage records from its own
+# Lambda logs, where it does. The Stage dimension keeps the stages' metrics apart.
+STAGE_METRICS_NAMESPACE = os.environ['STAGE_METRICS_NAMESPACE']
+STAGE_METRICS = [
+    # (telemetry record field, metric name, unit)
+    ('duration_ms', 'WallTime', 'Milliseconds'),
+    ('cpu_ms', 'CpuTime', 'Milliseconds'),
+    ('peak_rss_mb', 'PeakRss', 'Megabytes'),
+    ('elements', 'Elements', 'Count'),
+    ('bytes', 'Bytes', 'Bytes'),
+]
+# EMF accepts at most 100 values per metric in one document
+EMF_MAX_VALUES = 100
+
+DASHBOARD_STAGES = ['partition', 'chunk', 'embed', 'upload', 'delete', 'ingest']
+STAGE_PERCENTILE_WINDOW_HOURS = int(os.environ.get('STAGE_PERCENTILE_WINDOW_HOURS', '24'))
+
+
+def build_emf_documents(records):
+    # One document per stage, each metric carrying every value the batch had for it
+    values_by_stage = {}
+    for record in records:
+        if not record.get('stage'):
+            continue
+        stage_values = values_by_stage.setdefault(record['stage'], {name: [] for _, name, _ in STAGE_METRICS})
+        for field, name, _ in STAGE_METRICS:
+            if record.get(field) is not None:
+                stage_values[name].append(record[field])
+
+    timestamp = int(time.time() * 1000)
+    documents = []
+    for stage, stage_values in values_by_stage.items():
+        longest = max(len(values) for values in stage_values.values())
+        for start in range(0, longest, EMF_MAX_VALUES):
+            metrics = {
+                name: values[start:start + EMF_MAX_VALUES]
+                for name, values in stage_values.items()
+                if values[start:start + EMF_MAX_VALUES]
+            }
+            documents.append({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': STAGE_METRICS_NAMESPACE,
+                        'Dimensions': [['Stage']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for _, name, unit in STAGE_METRICS if name in metrics],
+                    }],
+                },
+                'Stage': stage,
+                **metrics,
+            })
+    return documents
+
+def publish_stage_metrics(records):
+    for document in build_emf_documents(records):
+        print(json.dumps(document, separators=(',', ':')))
+
+def get_stage_percentiles():
+    # p50 and p95 wall time per document for each stage, as one period over the window. Hour
+    # aligned bounds keep CloudWatch from splitting the window across two periods.
+    end_time = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    queries = [
+        {
+            'Id': f'{statistic}_{index}',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': STAGE_METRICS_NAMESPACE,
+                    'MetricName': 'WallTime',
+                    'Dimensions': [{'Name': 'Stage', 'Value': stage}],
+                },
+                'Period': STAGE_PERCENTILE_WINDOW_HOURS * 60 * 60,
+                'Stat': statistic,
+            },
+        }
+        for index, stage in enumerate(DASHBOARD_STAGES)
+        for statistic in ('p50', 'p95')
+    ]
+    response = cloudwatch.get_metric_data(
+        MetricDataQueries=queries,
+        StartTime=end_time - timedelta(hours=STAGE_PERCENTILE_WINDOW_HOURS),
+        EndTime=end_time,
+    )
+
+    percentiles = {}
+    for result in response['MetricDataResults']:
+        if not result['Values']:
+            continue
+        statistic, index = result['Id'].split('_')
+        percentiles.setdefault(DASHBOARD_STAGES[int(index)], {})[statistic] = int(result['Values'][0])
+    return percentiles
+
+def get_stage_percentiles_or_empty():
+    try:
+        return get_stage_percentiles()
+    except Exception as e:
+        print(f"Error fetching stage percentiles: {str(e)}")
+        return {}
@@ -0,0 +1,94 @@
+# lambda/s3_pinecone_lambda/telemetry_consumer_lambda.py
+#
+# Subscribed to the central log group for the ingest telemetry records alone (JSON lines with
+# "telemetry": 1). One pass over the batch adds up the counter deltas, which are then written with
+# one update per counter item and pushed to the dashboard. The records are also republished as
+# CloudWatch metrics; the dashboard's per-stage percentiles are read from those by the initial
+# check, not here, so a busy ingest doesn't cost a GetMetricData call per log batch.
+
+import base64
+import gzip
+import json
+import os
+import boto3
+from index_count_utils import apply_index_deltas, update_ingestion_counts
+from connection_utils import DASHBOARD_CLIENT_ID, MANAGEMENT_API_CONFIG, broadcast
+from stage_metrics_utils import publish_stage_metrics
+
+dynamodb = boto3.resource('dynamodb')
+connection_table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
+
+WEBSOCKET_API_URL = os.environ['WEBSOCKET_API_URL']
+http_endpoint_url = WEBSOCKET_API_URL.replace("wss://", "https://")
+apigateway_management_api = boto3.client(
+    'apigatewaymanagementapi', endpoint_url=http_endpoint_url, config=MANAGEMENT_API_CONFIG
+)
+
+
+def lambda_handler(event, context):
+    records = decode_records(event)
+    totals = aggregate_records(records)
+    publish_stage_metrics(records)
+
+    message = {}
+
+    if totals['vector_delta'] or totals['document_delta']:
+        message['totalVectors'], message['totalDocuments'] = apply_index_deltas(
+            totals['vector_delta'], totals['document_delta']
+        )
+    if totals['vectors_written'] or totals['documents_ingested']:
+        counts = update_ingestion_counts(
+            DASHBOARD_CLIENT_ID, totals['vectors_written'], totals['documents_ingested']
+        )
+        # A failed update leaves the counters out, so viewers keep the values they have
+        if counts is not None:
+            message['vectorsWritten'], message['documentsIngested'] = counts
+
+    # A batch of stage timings alone moves none of the counters the dashboard shows
+    delivered = broadcast(connection_table, apigateway_management_api, message) if message else 0
+
+    return {
+        'statusCode': 200,
+        'body': f"Aggregated {len(records)} telemetry record(s) for {delivered} connection(s)"
+    }
+
+def decode_records(event):
+    compressed_data = base64.b64decode(event['awslogs']['data'])
+    log_events = json.loads(gzip.decompress(compressed_data)).get('logEvents', [])
+
+    records = []
+    for log_event in log_events:
+        try:
+            records.append(json.loads(log_event['message']))
+        except ValueError:
+            # The subscription filter only passes JSON, but a truncated line shouldn't sink the batch
+            print(f"Skipping malformed telemetry record: {log_event['message'][:200]}")
+    return records
+
+def aggregate_records(records):
+    # Uploaded elements become vectors, counted once the upload has written them; an ingest of a
+    # new document adds one document; deletes remove their vectors, and the document too when the
+    # whole of it went
+    totals = {
+        'vector_delta': 0,
+        'document_delta': 0,
+        'vectors_written': 0,
+        'documents_ingested': 0,
+    }
+
+    for record in records:
+        stage = record.get('stage')
+        elements = record.get('elements', 0)
+        succeeded = record.get('status', 'succeeded') == 'succeeded'
+
+        if stage == 'upload' and succeeded:
+            totals['vectors_written'] += elements
+            totals['vector_delta'] += elements
+        elif stage == 'delete' and succeeded:
+            totals['vector_delta'] -= elements
+            totals['document_delta'] -= 1 if record.get('whole_document') else 0
+        elif stage == 'ingest' and succeeded:
+            totals['documents_ingested'] += 1
+            totals['document_delta'] += 1 if record.get('new_document') else 0
+
+    return totals
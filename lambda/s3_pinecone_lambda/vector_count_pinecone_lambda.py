@@ -4,10 +4,10 @@ import json
 import base64
 import gzip
 from io import BytesIO
-import re
-import time
-from decimal import Decimal
 from pinecone import Pinecone
+from index_count_utils import reconcile_index_totals
+from connection_utils import MANAGEMENT_API_CONFIG, broadcast
+from log_store_utils import store_log_entries
 
 logs_client = boto3.client('logs')
 dynamodb = boto3.resource('dynamodb')
@@ -16,11 +16,12 @@ pc = Pinecone(os.environ['PINECONE_API_KEY'])
 index = pc.Index(os.environ['PINECONE_INDEX_NAME'])
 
 connection_table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
-client_data_table = dynamodb.Table(os.environ['CLIENT_DATA_TABLE_NAME'])
 
 WEBSOCKET_API_URL = os.environ['WEBSOCKET_API_URL']
 http_endpoint_url = WEBSOCKET_API_URL.replace("wss://", "https://")
-apigateway_management_api = boto3.client('apigatewaymanagementapi', endpoint_url=http_endpoint_url)
+apigateway_management_api = boto3.client(
+    'apigatewaymanagementapi', endpoint_url=http_endpoint_url, config=MANAGEMENT_API_CONFIG
+)
 
 LOG_PATTERNS = [
     'ingest process finished in',
@@ -30,35 +31,34 @@ LOG_PATTERNS = [
     'calling ChunkStep',
     'calling EmbedStep',
     'writing a total of',
+    'MainProcess ERROR',
+    'Exception raised',
 ]
 
-def lambda_handler(event, context):
-    client_id = get_client_id_from_dynamodb()
-    
-    log_data, total_vectors, total_documents, vectors_written, documents_ingested = process_new_logs(event, client_id)
-
-    store_data_in_dynamodb(client_id, log_data)
+def reconcile_handler(event, context):
+    # Scheduled: reset the incrementally maintained totals from the index itself
+    total_vectors, total_documents = reconcile_index_totals(index)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'totalVectors': total_vectors, 'totalDocuments': total_documents})
+    }
 
-    connection_id = get_connection_id_from_dynamodb()
+def lambda_handler(event, context):
+    # Forwards the readable log lines to the dashboard. The counts come from the telemetry
+    # consumer, which reads the ingest jobs' structured records instead of this text.
+    log_data = process_new_logs(event)
 
-    if not connection_id:
-        print("No connection ID found in DynamoDB.")
-        return {
-            'statusCode': 404,
-            'body': 'Connection ID not found'
-        }
+    store_data_in_dynamodb(log_data)
 
-    send_to_websocket(connection_id, log_data, total_vectors, total_documents, vectors_written, documents_ingested)
+    delivered = broadcast(connection_table, apigateway_management_api, {'logs': log_data})
 
     return {
         'statusCode': 200,
-        'body': 'Log data sent to WebSocket and stored in DynamoDB'
+        'body': f"Log data stored in DynamoDB and sent to {delivered} connection(s)"
     }
 
-def process_new_logs(event, client_id):
+def process_new_logs(event):
     logs = []
-    total_vectors = 0
-    total_documents = 0
 
     compressed_data = base64.b64decode(event['awslogs']['data'])
     with gzip.GzipFile(fileobj=BytesIO(compressed_data), mode='rb') as f:
@@ -76,179 +76,14 @@ def process_new_logs(event, client_id):
                     'timestamp': timestamp,
                     'message': message,
                 })
-
-                if "writing a total of" in message:
-                    match = re.search(r'writing a total of (\d+) elements', message)
-                    if match:
-                        increment_vector_count(client_id, int(match.group(1)))
-
-                if "ingest process finished" in message:
-                    increment_document_count(client_id)
-
                 break
 
-    total_vectors, total_documents = get_counts_from_pinecone()
-    vectors_written = get_ingestion_count_data(client_id, 'vectorsWritten')
-    documents_ingested = get_ingestion_count_data(client_id, 'documentsIngested')
-
-    return logs, total_vectors, total_documents, vectors_written, documents_ingested
+    return logs
 
-def get_counts_from_pinecone(retries=3, delay=3):
+def store_data_in_dynamodb(log_data):
     try:
-        true_vector_count = None
-        true_document_count = None
-
-        vector_changed = False
-        document_changed = False
-
-        for attempt in range(retries):
-            print(f"Attempt {attempt + 1} to fetch vector and document counts from Pinecone...")
-            stats = index.describe_index_stats()
-
-            current_vector_count = stats.get('total_vector_count', 0)
-            current_document_count = len(stats.get('namespaces', {}))
-
-            if true_vector_count is None:
-                true_vector_count = current_vector_count
-                print(f"Setting initial vector count: {true_vector_count}")
-
-            if true_document_count is None:
-                true_document_count = current_document_count
-                print(f"Setting initial document count: {true_document_count}")
-
-            if current_vector_count != true_vector_count:
-                print(f"Vector count has changed: {true_vector_count} -> {current_vector_count}")
-                true_vector_count = current_vector_count
-                vector_changed = True
-
-            if current_document_count != true_document_count:
-                print(f"Document count has changed: {true_document_count} -> {current_document_count}")
-                true_document_count = current_document_count
-                document_changed = True
-
-            if vector_changed and document_changed:
-                print(f"Both counts have changed. Exiting retries early.")
-                return true_vector_count, true_document_count
-
-            if attempt < retries - 1:
-                print(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-
-        print(f"Final vector count: {true_vector_count}, document count: {true_document_count}")
-        return true_vector_count, true_document_count
-
-    except Exception as e:
-        print(f"Error fetching counts from Pinecone: {str(e)}")
-        return 0, 0
-    
-def increment_document_count(client_id):
-    try:
-        response = client_data_table.update_item(
-            Key={
-                'clientId': client_id,
-                'timestamp': 0
-            },
-            UpdateExpression='SET documentsIngested = if_not_exists(documentsIngested, :start) + :inc',
-            ExpressionAttributeValues={
-                ':inc': 1,
-                ':start': 0,
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-
-        updated_doc_count = response['Attributes']['documentsIngested']
-        print(f"Documents ingested count updated to {updated_doc_count}")
-        return updated_doc_count
-    
-    except Exception as e:
-        print(f"Error incrementing documentsIngested: {str(e)}")
-        return None
-    
-def increment_vector_count(client_id, vector_count):
-    try:
-        response = client_data_table.update_item(
-            Key={
-                'clientId': client_id,
-                'timestamp': 0
-            },
-            UpdateExpression='SET vectorsWritten = if_not_exists(vectorsWritten, :start) + :inc',
-            ExpressionAttributeValues={
-                ':inc': vector_count,
-                ':start': 0,
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-
-        updated_vector_count = response['Attributes']['vectorsWritten']
-        print(f"Vectors written count updated to {updated_vector_count}")
-        return updated_vector_count
-    
-    except Exception as e:
-        print(f"Error incrementing vectorsWritten: {str(e)}")
-        return None
-
-def get_ingestion_count_data(client_id, count_type):
-    try:
-        response = client_data_table.get_item(
-            Key={
-                'clientId': client_id,
-                'timestamp': 0
-            }
-        )
-        if 'Item' in response:
-            count_value = response['Item'].get(count_type, 0)
-            if isinstance(count_value, Decimal):
-                return int(count_value)
-            return count_value
-        else:
-            return 0
-        
-    except Exception as e:
-        print(f"Error retrieving ingestion count data: {str(e)}")
-        return 0
-
-def store_data_in_dynamodb(client_id, log_data):
-    try:
-        dynamodb_item = {
-            'clientId': client_id,
-            'dataType': 'logs',
-            'logData': log_data,
-            'timestamp': int(time.time() * 1000)
-        }
-
-        response = client_data_table.put_item(Item=dynamodb_item)
-        print(f"Data saved to DynamoDB: {response}")
+        store_log_entries(log_data)
+        print(f"Saved {len(log_data)} log entries to DynamoDB")
     
     except Exception as e:
         print(f"Error saving data to DynamoDB: {str(e)}")
-
-def send_to_websocket(connection_id, log_data, total_vectors, total_documents, vectors_written, documents_ingested):
-    message = {
-        'logs': log_data,
-        'totalVectors': total_vectors,
-        'totalDocuments': total_documents,
-        'vectorsWritten': vectors_written,
-        'documentsIngested': documents_ingested,
-    }
-
-    try:
-        apigateway_management_api.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps(message)
-        )
-    except apigateway_management_api.exceptions.GoneException:
-        print(f"WebSocket connection {connection_id} is no longer valid.")
-
-def get_client_id_from_dynamodb():
-    response = connection_table.scan()
-    if response.get('Items'):
-        most_recent_entry = max(response['Items'], key=lambda x: x['timestamp'])
-        return most_recent_entry['clientId']
-    return None
-
-def get_connection_id_from_dynamodb():
-    response = connection_table.scan()
-    if response.get('Items'):
-        most_recent_entry = max(response['Items'], key=lambda x: x['timestamp'])
-        return most_recent_entry['connectionId']
-    return None
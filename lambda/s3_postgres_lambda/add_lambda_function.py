@@ -4,54 +4,16 @@ import boto3
 import botocore
 import uuid
 import urllib
-import psycopg2
-import time
+from postgres_utils import delete_from_postgres
+from backfill_utils import start_backfill, load_checkpoint, run_backfill
+from manifest_utils import submit_manifests, is_worker_dispatch, enqueue_manifests
+from ingest_record_utils import filter_changed, record_ingests
 
 # Initialize the Batch client and S3 client
 batch_client = boto3.client('batch')
 s3_client = boto3.client('s3')
 
-# Read the app.py script from the Lambda's local file system
-with open('s3_postgres_ingest.py', 'r') as script_file:
-    app_script = script_file.read()
 
-
-def delete_from_postgres(db_name, user, password, host, port, table_name, filename):
-    start_time = time.time()
-    connection = None
-    try:
-        # Connect to the PostgreSQL database
-        connection = psycopg2.connect(
-            dbname=db_name,
-            user=user,
-            password=password,
-            host=host,
-            port=port,
-        )
-        cursor = connection.cursor()
-        
-        delete_query = f"DELETE FROM {table_name} WHERE filename = %s"
-        print(f"Executing query: {delete_query} with filename: {filename}")
-        
-        cursor.execute(delete_query, (filename,))
-        
-        connection.commit()
-        
-        print(f"{cursor.rowcount} record(s) deleted.")
-    
-    except (Exception, psycopg2.DatabaseError) as error:
-        print("Error while deleting records from Postgres: %s", error)
-    
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
-
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    print(f"Process took {elapsed_time:.2f} seconds.")
-    
 def lambda_handler(event, context):
     # Check if this is a delete event (ie. CDK delete)
     if event.get('RequestType') == 'Delete':
@@ -71,45 +33,50 @@ def lambda_handler(event, context):
         decoded_document_key = urllib.parse.unquote(document_key)
         decoded_document_with_spaces = decoded_document_key.replace('+', ' ').replace('%20', ' ')
         s3_url = f"s3://{bucket_name}/{decoded_document_with_spaces}"
-
-        if does_object_exist(bucket_name, decoded_document_with_spaces):
+        etag = event['Records'][0]['s3']['object'].get('eTag', '')
+
+        # Re-uploads and copies of identical content were already ingested with this config
+        if not filter_changed([(s3_url, etag)]):
+            message = f"Object {decoded_document_with_spaces} is unchanged since it was last ingested. Skipping."
+            print(message)
+            return {
+                'statusCode': 200,
+                'body': json.dumps(message)
+            }
+
+        # Incremental jobs diff the object's chunks against the database themselves, so the
+        # existing vectors must survive until the job runs
+        if os.environ.get('INCREMENTAL_INGEST') != 'true' and does_object_exist(bucket_name, decoded_document_with_spaces):
             print(f"Object {decoded_document_with_spaces} already exists. Deleting vectors from database.")
-            # Retrieve the Postgres info from environment variables
-            db_name = os.environ['POSTGRES_DB_NAME']
-            user = os.environ['POSTGRES_USER']
-            password = os.environ['POSTGRES_PASSWORD']
-            host = os.environ['POSTGRES_HOST']
-            port = os.environ['POSTGRES_PORT']
             table_name = os.environ['POSTGRES_TABLE_NAME']
             try:
-                delete_from_postgres(db_name, user, password, host, port, table_name, os.path.basename(decoded_document_with_spaces))
+                delete_from_postgres(table_name, [os.path.basename(decoded_document_with_spaces)])
             except Exception as e:
                 print(f"Error deleting from Postgres: {e}")
 
-        return add_files(s3_url)
+        return add_files([s3_url], [etag])
 
     else:
-        # Handle custom resource event (initial processing)
-        print("Custom resource event received. Listing objects in S3 bucket.")
+        # Handle custom resource event (initial processing) or a resumed backfill
         bucket_name = os.environ['S3_BUCKET_NAME']
         prefix = os.environ.get('S3_NOTIFICATION_PREFIX', '')
-        
-        # List existing objects in the bucket
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        
-        if 'Contents' in response:
-            for item in response['Contents']:
-                document_key = item['Key']
-                s3_url = f"s3://{bucket_name}/{document_key}"
-
-                # Skip the object if its size is 0 (indicating it's a folder)
-                if item['Size'] == 0:
-                    print(f"Skipping folder: {document_key}")
-                    continue
-                
-                add_files(s3_url)
+
+        if 'BackfillResume' in event:
+            print(f"Resuming backfill {event['BackfillResume']}.")
+            checkpoint = load_checkpoint(event['BackfillResume'])
         else:
+            print("Custom resource event received. Listing objects in S3 bucket.")
+            checkpoint = start_backfill(bucket_name, prefix)
+
+        # Incremental jobs diff each object's chunks themselves; full-mode jobs need the earlier
+        # version of every object ingested before cleared first
+        clear = None if os.environ.get('INCREMENTAL_INGEST') == 'true' else clear_previous_versions
+        summary = run_backfill(checkpoint, add_manifests, context, clear)
+
+        if summary['complete'] and summary['submitted'] == 0 and summary['unchanged'] == 0:
             print("No objects found in the bucket.")
+        else:
+            print(f"Backfill submitted {summary['submitted']} object(s) so far, skipping {summary['unchanged']} unchanged; complete: {summary['complete']}.")
 
         return {
             'statusCode': 200,
@@ -126,8 +93,8 @@ def does_object_exist(bucket_name, document_key):
         else:
             raise
 
-def add_files(s3_url):  
-    # Environment variables 
+def get_job_environment():
+    # Environment variables
     aws_access_key = os.environ['MY_AWS_ACCESS_KEY_ID']
     aws_secret_key = os.environ['MY_AWS_SECRET_ACCESS_KEY']
     db_name = os.environ['POSTGRES_DB_NAME']
@@ -142,6 +109,36 @@ def add_files(s3_url):
     chunking_strategy = os.environ['CHUNKING_STRATEGY']
     chunking_max_characters = os.environ['CHUNKING_MAX_CHARACTERS']
     local_file_download_dir = '/tmp/'  # Temporary directory for Lambda file storage
+    ingest_mode = 'incremental' if os.environ.get('INCREMENTAL_INGEST') == 'true' else 'full'
+
+    return [
+        {'name': 'AWS_ACCESS_KEY_ID', 'value': aws_access_key},
+        {'name': 'AWS_SECRET_ACCESS_KEY', 'value': aws_secret_key},
+        {'name': 'POSTGRES_DB_NAME', 'value': db_name},
+        {'name': 'POSTGRES_USER', 'value': user},
+        {'name': 'POSTGRES_PASSWORD', 'value': password},
+        {'name': 'POSTGRES_HOST', 'value': host},
+        {'name': 'POSTGRES_PORT', 'value': port},
+        {'name': 'POSTGRES_TABLE_NAME', 'value': table_name},
+        {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
+        {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
+        {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
+        {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
+        {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
+        {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
+        {'name': 'INGEST_MODE', 'value': ingest_mode},
+    ]
+
+def add_files(s3_urls, etags):
+    # s3_urls is a manifest of objects that a single Batch job ingests in one container;
+    # etags lines up with it and is recorded once the job has been submitted
+    if is_worker_dispatch():
+        job_id = enqueue_manifests([s3_urls])[0]
+        record_ingests(zip(s3_urls, etags), job_id)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f"Queued {len(s3_urls)} object(s) for the ingest workers as {job_id}")
+        }
 
     # Generate a valid job name
     job_name = f"BatchJob_{uuid.uuid4()}"
@@ -153,28 +150,23 @@ def add_files(s3_url):
         jobDefinition=os.environ['JOB_DEFINITION'],  # Job definition from environment variables
         containerOverrides={
             'environment': [
-                {'name': 'AWS_S3_URL', 'value': s3_url},
-                {'name': 'AWS_ACCESS_KEY_ID', 'value': aws_access_key},
-                {'name': 'AWS_SECRET_ACCESS_KEY', 'value': aws_secret_key},
-                {'name': 'POSTGRES_DB_NAME', 'value': db_name},
-                {'name': 'POSTGRES_USER', 'value': user},
-                {'name': 'POSTGRES_PASSWORD', 'value': password},
-                {'name': 'POSTGRES_HOST', 'value': host},
-                {'name': 'POSTGRES_PORT', 'value': port},
-                {'name': 'POSTGRES_TABLE_NAME', 'value': table_name},
-                {'name': 'EMBEDDING_PROVIDER', 'value': embedding_provider},
-                {'name': 'EMBEDDING_MODEL_NAME', 'value': embedding_model_name},
-                {'name': 'EMBEDDING_PROVIDER_API_KEY', 'value': embedding_provider_api_key},
-                {'name': 'CHUNKING_STRATEGY', 'value': chunking_strategy},
-                {'name': 'CHUNKING_MAX_CHARACTERS', 'value': chunking_max_characters},
-                {'name': 'LOCAL_FILE_DOWNLOAD_DIR', 'value': local_file_download_dir},
-                {'name': 'APP_SCRIPT', 'value': app_script},
-            ],
+                {'name': 'AWS_S3_URLS', 'value': json.dumps(s3_urls)},
+            ] + get_job_environment(),
         },
     )
+    record_ingests(zip(s3_urls, etags), response['jobId'])
 
     # Response with job information
     return {
         'statusCode': 200,
-        'body': json.dumps(f"Started Batch Job: {response['jobId']}")
-    }
\ No newline at end of file
+        'body': json.dumps(f"Started Batch Job: {response['jobId']} for {len(s3_urls)} object(s)")
+    }
+
+def add_manifests(manifests):
+    # Backfill path: write the manifests as shards and fan them out as array jobs
+    return submit_manifests(manifests, get_job_environment())
+
+def clear_previous_versions(s3_urls):
+    # Backfill path: drop what the destination holds for re-submitted objects, as the S3 event
+    # path does for an object that already exists
+    delete_from_postgres(os.environ['POSTGRES_TABLE_NAME'], [s3_url.split('/')[-1] for s3_url in s3_urls])
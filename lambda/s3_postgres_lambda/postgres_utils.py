@@ -1,40 +1,150 @@
 # lambda/s3_postgres_lambda/postgres_utils.py
 
-import psycopg2
+import os
 import time
+import psycopg2
+
+# Shared by the Lambdas and, published next to ingest_support, by the Postgres Batch ingest scripts
+
+# One connection per container, opened on first use and kept at module scope, so warm invocations
+# skip the TCP, TLS and authentication round trips. A connection that went stale while the
+# container was frozen (the server restarted or timed it out) fails its next statement; it is then
+# reopened and the statement run once more, which is safe for the idempotent deletes run through it.
+POSTGRES_CONNECT_TIMEOUT = int(os.environ.get('POSTGRES_CONNECT_TIMEOUT', '10'))
+# Deletes go in batches of this many rows, each its own transaction, so removing a large file
+# neither holds its row locks until the end nor writes all of its WAL at once. 0 deletes in one go.
+POSTGRES_DELETE_BATCH_SIZE = int(os.environ.get('POSTGRES_DELETE_BATCH_SIZE', '5000'))
+
+# Indexes the destination table needs: a B-tree on filename for the per-file deletes and lookups,
+# and an approximate nearest neighbour index on embeddings (POSTGRES_VECTOR_INDEX: hnsw, which
+# needs pgvector 0.5+, ivfflat or none). They are built by a one-off INGEST_MODE=migrate job that
+# the stack submits on deploy, never by an ingest run, and CONCURRENTLY so ingest writes carry on.
+POSTGRES_VECTOR_INDEX = os.environ.get('POSTGRES_VECTOR_INDEX', 'hnsw')
+POSTGRES_VECTOR_OPS = os.environ.get('POSTGRES_VECTOR_OPS', 'vector_cosine_ops')
+POSTGRES_IVFFLAT_LISTS = int(os.environ.get('POSTGRES_IVFFLAT_LISTS', '100'))
+
+_connection = None
+
+
+def connect():
+    # A new connection of its own, for callers that manage it themselves
+    return psycopg2.connect(
+        dbname=os.environ['POSTGRES_DB_NAME'],
+        user=os.environ['POSTGRES_USER'],
+        password=os.environ['POSTGRES_PASSWORD'],
+        host=os.environ['POSTGRES_HOST'],
+        port=os.environ['POSTGRES_PORT'],
+        connect_timeout=POSTGRES_CONNECT_TIMEOUT,
+    )
+
+def get_connection():
+    global _connection
+    if _connection is None or _connection.closed:
+        _connection = connect()
+    return _connection
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except psycopg2.Error:
+            pass
+    _connection = None
 
-def delete_from_postgres(db_name, user, password, host, port, table_name, filename):
+def run_statement(statement, params):
+    # Runs and commits one statement. Returns its row count.
+    for attempt in range(2):
+        connection = get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(statement, params)
+                row_count = cursor.rowcount
+            connection.commit()
+            return row_count
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            close_connection()
+            if attempt:
+                raise
+            print("Postgres connection was stale; reconnecting.")
+        except psycopg2.Error:
+            # Keep the connection usable for the next invocation
+            connection.rollback()
+            raise
+
+def delete_from_postgres(table_name, filenames):
+    # Deletes the rows of every file, POSTGRES_DELETE_BATCH_SIZE rows (picked by ctid) per statement
+    # and transaction, until a batch comes back short; 0 deletes them all in one statement.
+    # Returns how many were deleted.
     start_time = time.time()
-    connection = None
-    try:
-        # Connect to the PostgreSQL database
-        connection = psycopg2.connect(
-            dbname=db_name,
-            user=user,
-            password=password,
-            host=host,
-            port=port,
+
+    if POSTGRES_DELETE_BATCH_SIZE:
+        delete_query = (
+            f"DELETE FROM {table_name} WHERE ctid = ANY(ARRAY("
+            f"SELECT ctid FROM {table_name} WHERE filename = ANY(%s) LIMIT {POSTGRES_DELETE_BATCH_SIZE}))"
         )
-        cursor = connection.cursor()
-        
-        delete_query = f"DELETE FROM {table_name} WHERE filename = %s"
-        print(f"Executing query: {delete_query} with filename: {filename}")
-        
-        cursor.execute(delete_query, (filename,))
-        
-        connection.commit()
-        
-        print(f"{cursor.rowcount} record(s) deleted.")
-    
-    except (Exception, psycopg2.DatabaseError) as error:
-        print("Error while deleting records from Postgres: %s", error)
-    
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+    else:
+        delete_query = f"DELETE FROM {table_name} WHERE filename = ANY(%s)"
+    print(f"Executing query: {delete_query} with {len(filenames)} filename(s)")
+
+    deleted = 0
+    while True:
+        batch_deleted = run_statement(delete_query, (list(filenames),))
+        deleted += batch_deleted
+        if not POSTGRES_DELETE_BATCH_SIZE or batch_deleted < POSTGRES_DELETE_BATCH_SIZE:
+            break
+    print(f"{deleted} record(s) deleted.")
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Process took {elapsed_time:.2f} seconds.")
+    return deleted
+
+def get_schema_indexes(table_name):
+    # (name, definition, what an existing equivalent index's definition contains)
+    indexes = [(f"{table_name}_filename_idx", "(filename)", "USING btree (filename")]
+    if POSTGRES_VECTOR_INDEX == 'hnsw':
+        indexes.append((f"{table_name}_embeddings_idx", f"USING hnsw (embeddings {POSTGRES_VECTOR_OPS})", "(embeddings"))
+    elif POSTGRES_VECTOR_INDEX == 'ivfflat':
+        indexes.append((
+            f"{table_name}_embeddings_idx",
+            f"USING ivfflat (embeddings {POSTGRES_VECTOR_OPS}) WITH (lists = {POSTGRES_IVFFLAT_LISTS})",
+            "(embeddings",
+        ))
+    return indexes
+
+def ensure_schema(table_name):
+    # One migration job at a time builds the missing indexes. An index of ours left invalid by an
+    # interrupted build is dropped and built again; an index that has our name but a different
+    # definition belongs to someone else, so it is left alone with a warning.
+    connection = connect()
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"schema:{table_name}",))
+            if not cursor.fetchone()[0]:
+                print("Another migration job is building the destination indexes.")
+                return
+            cursor.execute(
+                "SELECT c.relname, i.indisvalid, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = %s::regclass",
+                (table_name,),
+            )
+            existing = cursor.fetchall()
+            for index_name, definition, signature in get_schema_indexes(table_name):
+                if any(valid and signature in index_definition for _, valid, index_definition in existing):
+                    continue
+                same_name = [index_definition for name, _, index_definition in existing if name == index_name]
+                if same_name and signature not in same_name[0]:
+                    print(f"Warning: index {index_name} exists with a different definition ({same_name[0]}); not replacing it.")
+                    continue
+                if same_name:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+                print(f"Creating index {index_name} on {table_name}")
+                started = time.time()
+                cursor.execute(f"CREATE INDEX CONCURRENTLY {index_name} ON {table_name} {definition}")
+                print(f"Created index {index_name} in {time.time() - started:.2f} seconds.")
+    finally:
+        # Closing the session releases the advisory lock
+        connection.close()
@@ -1,6 +1,8 @@
+import json
 import os
+import sys
+from psycopg2.extras import execute_values
 
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
 from unstructured_ingest.v2.interfaces import ProcessorConfig
 from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
     S3IndexerConfig, S3DownloaderConfig, S3ConnectionConfig, S3AccessConfig
@@ -9,28 +11,24 @@ from unstructured_ingest.v2.processes.connectors.sql.postgres import (
     PostgresConnectionConfig,
     PostgresAccessConfig,
     PostgresUploaderConfig,
-    PostgresUploadStagerConfig
+    PostgresUploadStagerConfig,
+    PostgresUploader
 )
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 from unstructured_ingest.v2.processes.chunker import ChunkerConfig
-from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+from ingest_support import (
+    CachingEmbedderConfig, build_pipeline, ingest_incrementally, ingest_manifest, instrument_pipeline, load_manifest,
+    run_worker,
+)
+from postgres_utils import connect, ensure_schema
 
-if __name__ == "__main__":
-    metadata_includes = [
-        "id", "element_id", "text", "embeddings", "type", "system", "layout_width",
-        "layout_height", "points", "url", "version", "date_created", "date_modified",
-        "date_processed", "permissions_data", "record_locator", "category_depth",
-        "parent_id", "attached_filename", "filetype", "last_modified", "file_directory",
-        "filename", "languages", "page_number", "links", "page_name", "link_urls",
-        "link_texts", "sent_from", "sent_to", "subject", "section", "header_footer_type",
-        "emphasized_text_contents", "emphasized_text_tags", "text_as_html", "regex_metadata",
-        "detection_class_prob"
-    ]
+instrument_pipeline(PostgresUploader)
 
+def build_pipeline_configs(s3_url):
     # Prepare the configuration dictionary
     pipeline_configs = {
         "context": ProcessorConfig(),
-        "indexer_config": S3IndexerConfig(remote_url=os.getenv("AWS_S3_URL")),
+        "indexer_config": S3IndexerConfig(remote_url=s3_url),
         "downloader_config": S3DownloaderConfig(download_dir=os.getenv("LOCAL_FILE_DOWNLOAD_DIR")),
         "source_connection_config": S3ConnectionConfig(
             access_config=S3AccessConfig(
@@ -42,7 +40,7 @@ if __name__ == "__main__":
             partition_by_api=False,
             strategy="auto",
         ),
-        "embedder_config": EmbedderConfig(
+        "embedder_config": CachingEmbedderConfig(
             embedding_provider=os.getenv("EMBEDDING_PROVIDER"),
             embedding_model_name=os.getenv("EMBEDDING_MODEL_NAME"),
             embedding_api_key=os.getenv("EMBEDDING_PROVIDER_API_KEY"),
@@ -66,5 +64,79 @@ if __name__ == "__main__":
             chunk_overlap=20
         )
 
+    return pipeline_configs
+
+def list_chunk_ids(s3_url):
+    filename = s3_url.split("/")[-1]
+    connection = connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM {os.getenv('POSTGRES_TABLE_NAME')} WHERE filename = %s", (filename,))
+            return {str(row[0]) for row in cursor.fetchall()}
+    finally:
+        connection.close()
+
+def upload_chunks(s3_url, chunks):
+    filename = s3_url.split("/")[-1]
+    rows = [
+        (
+            chunk_id,
+            element.get("element_id"),
+            element["text"],
+            json.dumps(element["embeddings"]),
+            element.get("type"),
+            filename,
+            element["metadata"].get("filetype"),
+            element["metadata"].get("page_number"),
+        )
+        for chunk_id, element in chunks
+    ]
+
+    connection = connect()
+    try:
+        with connection.cursor() as cursor:
+            execute_values(
+                cursor,
+                f"INSERT INTO {os.getenv('POSTGRES_TABLE_NAME')} "
+                "(id, element_id, text, embeddings, type, filename, filetype, page_number) VALUES %s",
+                rows,
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+def delete_chunks(s3_url, chunk_ids):
+    filename = s3_url.split("/")[-1]
+    connection = connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {os.getenv('POSTGRES_TABLE_NAME')} WHERE filename = %s AND id = ANY(%s::uuid[])",
+                (filename, chunk_ids),
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+def ingest_object(s3_url):
+    # INGEST_MODE=incremental re-embeds only the chunks that changed since the file was last ingested.
+    # Returns whether the file is new to the destination.
+    if os.getenv("INGEST_MODE") == "incremental":
+        return ingest_incrementally(s3_url, build_pipeline_configs(s3_url), list_chunk_ids, upload_chunks, delete_chunks)
+    build_pipeline(build_pipeline_configs(s3_url)).run()
+    # The add Lambda, or the backfill, already cleared any earlier version of the file
+    return True
+
+if __name__ == "__main__":
+    # INGEST_MODE=migrate only builds the destination indexes
+    if os.getenv("INGEST_MODE") == "migrate":
+        ensure_schema(os.getenv("POSTGRES_TABLE_NAME"))
+        sys.exit(0)
+
+    worker_queue_url = os.getenv("INGEST_WORKER_QUEUE_URL")
+    if worker_queue_url:
+        run_worker(worker_queue_url, ingest_object)
 
-    Pipeline.from_configs(**pipeline_configs).run()
+    # The manifest lists every object for this Batch job
+    if ingest_manifest(load_manifest(lambda: json.loads(os.getenv("AWS_S3_URLS"))), ingest_object):
+        sys.exit(1)
@@ -1,5 +1,6 @@
 import boto3
 import os
+from connection_utils import DASHBOARD_CLIENT_ID
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
@@ -10,7 +11,7 @@ def lambda_handler(event, context):
     table.put_item(
         Item={
             'connectionId': connection_id,
-            'clientId': 'user',
+            'clientId': DASHBOARD_CLIENT_ID,
             'timestamp': int(event['requestContext']['connectedAt'])
         }
     )
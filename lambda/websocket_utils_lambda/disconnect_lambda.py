@@ -7,9 +7,11 @@ table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
 def lambda_handler(event, context):
     connection_id = event['requestContext']['connectionId']
     
+    # The table's key includes the sort key, which is the time the connection was made
     table.delete_item(
         Key={
-            'connectionId': connection_id
+            'connectionId': connection_id,
+            'timestamp': int(event['requestContext']['connectedAt'])
         }
     )
     return {
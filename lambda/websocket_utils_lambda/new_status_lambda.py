@@ -1,92 +1,57 @@
 import boto3
 import os
-import json
-import time
+from connection_utils import MANAGEMENT_API_CONFIG, broadcast
+from job_status_utils import (
+    get_job_status_counts, is_counted_event, reconcile_job_status_counts, record_job_transition
+)
 
-batch_client = boto3.client('batch')
 dynamodb = boto3.resource('dynamodb')
 
 connection_table = dynamodb.Table(os.environ['CONNECTION_TABLE_NAME'])
-client_data_table = dynamodb.Table(os.environ['CLIENT_DATA_TABLE_NAME'])
 
 WEBSOCKET_API_URL = os.environ['WEBSOCKET_API_URL']
-JOB_QUEUE = os.environ['JOB_QUEUE'].split('/')[1]
 
 http_endpoint_url = WEBSOCKET_API_URL.replace("wss://", "https://")
-apigateway_management_api = boto3.client('apigatewaymanagementapi', endpoint_url=http_endpoint_url)
+apigateway_management_api = boto3.client(
+    'apigatewaymanagementapi', endpoint_url=http_endpoint_url, config=MANAGEMENT_API_CONFIG
+)
 
 def lambda_handler(event, context):
-    connection_id = get_connection_id_from_dynamodb()
+    # Each Batch Job State Change event moves its job between two counters
+    detail = event['detail']
+    if not is_counted_event(detail):
+        return {
+            'statusCode': 200,
+            'body': f"Job {detail.get('jobId')} is not counted"
+        }
 
-    if not connection_id:
-        print("No connection ID found for the client.")
+    if not record_job_transition(detail['jobId'], detail['status'], event['time']):
         return {
-            'statusCode': 404,
-            'body': 'Connection ID not found'
+            'statusCode': 200,
+            'body': 'Job status counts unchanged'
         }
 
     job_status_counts = get_job_status_counts()
-
-    try:
-        message = {
-            'jobStatusCounts': job_status_counts
+    if job_status_counts is None:
+        return {
+            'statusCode': 200,
+            'body': 'Job status counts not reconciled yet'
         }
 
-        apigateway_management_api.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps(message)
-        )
-    except apigateway_management_api.exceptions.GoneException:
-        print(f"Connection {connection_id} is no longer valid.")
+    return send_job_status_counts(job_status_counts)
+
+def reconcile_handler(event, context):
+    # Scheduled: reset the incrementally maintained counts from list_jobs
+    return send_job_status_counts(reconcile_job_status_counts())
+
+def send_job_status_counts(job_status_counts):
+    # Only reconciled counts are ever sent
+    delivered = broadcast(connection_table, apigateway_management_api, {
+        'jobStatusCounts': job_status_counts,
+        'jobStatusCountsReconciled': True,
+    })
 
     return {
         'statusCode': 200,
-        'body': 'Job status counts sent to WebSocket'
+        'body': f"Job status counts sent to {delivered} connection(s)"
     }
-
-def get_client_id_from_dynamodb():
-    response = connection_table.scan()
-    if response.get('Items'):
-        most_recent_entry = max(response['Items'], key=lambda x: x['timestamp'])
-        return most_recent_entry['clientId']
-    return None
-
-def get_connection_id_from_dynamodb():
-    response = connection_table.scan()
-    if response.get('Items'):
-        most_recent_entry = max(response['Items'], key=lambda x: x['timestamp'])
-        return most_recent_entry['connectionId']
-    return None
-
-def get_job_status_counts():
-    statuses = ['SUBMITTED', 'STARTING', 'PENDING', 'RUNNING', 'SUCCEEDED', 'FAILED']
-    job_counts = {status: 0 for status in statuses}
-    
-    try:
-        next_token = None
-        for status in statuses:
-            job_counts[status] = 0
-            
-            while True:
-                params = {
-                    'jobStatus': status,
-                    'jobQueue': JOB_QUEUE,
-                    'maxResults': 100
-                }
-                
-                if next_token:
-                    params['nextToken'] = next_token
-                
-                response = batch_client.list_jobs(**params)
-                
-                job_counts[status] += len(response.get('jobSummaryList', []))
-                
-                next_token = response.get('nextToken')
-                if not next_token:
-                    break
-
-        return job_counts
-
-    except Exception as e:
-        print(f"Error fetching job statuses: {str(e)}")
-        return {status: 0 for status in statuses}
@@ -3,13 +3,19 @@
 import * as cdk from "aws-cdk-lib";
 import { Construct } from "constructs";
 import * as lambda from "aws-cdk-lib/aws-lambda";
+import * as lambda_event_sources from "aws-cdk-lib/aws-lambda-event-sources";
 import * as apigateway from "aws-cdk-lib/aws-apigateway";
 import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
+import * as s3 from "aws-cdk-lib/aws-s3";
+import * as s3deploy from "aws-cdk-lib/aws-s3-deployment";
+import * as sqs from "aws-cdk-lib/aws-sqs";
 import * as batch from "aws-cdk-lib/aws-batch";
 import * as ec2 from "aws-cdk-lib/aws-ec2";
 import * as custom_resources from "aws-cdk-lib/custom-resources";
 import * as iam from "aws-cdk-lib/aws-iam";
 import * as dotenv from "dotenv";
+import * as fs from "fs";
+import * as crypto from "crypto";
 import * as logs from "aws-cdk-lib/aws-logs";
 
 dotenv.config();
@@ -93,18 +99,123 @@ export class Dropbox_MongoDB_CDK_Stack extends cdk.Stack {
       ],
     });
 
+    // Role assumed by the ingest containers themselves
+    const batchJobRole = new iam.Role(this, "BatchJobRole", {
+      assumedBy: new iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+    });
+
+    // Bucket holding the sharded manifests that array job children read and the
+    // content-addressed ingest scripts the job definition points at
+    const manifestBucket = new s3.Bucket(this, "ManifestBucket", {
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      autoDeleteObjects: true,
+      lifecycleRules: [
+        { prefix: "manifests/", expiration: cdk.Duration.days(7) },
+      ],
+    });
+
+    manifestBucket.grantRead(batchJobRole);
+
+    // Embeddings shared across jobs, keyed by provider, model and chunk text hash
+    const embeddingCacheTable = new dynamodb.Table(this, "EmbeddingCacheTable", {
+      partitionKey: { name: "CacheKey", type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: "ExpiresAt",
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    embeddingCacheTable.grantReadWriteData(batchJobRole);
+
+    // Publish the ingest script under its SHA-256 so jobs fetch (and cache) it by digest
+    // instead of every submit_job carrying the source as APP_SCRIPT
+    const ingestScript = fs.readFileSync(
+      "lambda/dropbox_mongodb_lambda/dropbox_mongodb_ingest.py",
+      "utf8"
+    );
+    const ingestScriptDigest = crypto
+      .createHash("sha256")
+      .update(ingestScript)
+      .digest("hex");
+    const ingestScriptKey = `scripts/dropbox_mongodb_ingest-${ingestScriptDigest}.py`;
+
+    // Shared helpers every ingest script imports, published the same way. The bootstrap puts
+    // them on the script's import path.
+    const ingestSupport = fs.readFileSync(
+      "lambda/batch_bootstrap/ingest_support.py",
+      "utf8"
+    );
+    const ingestSupportDigest = crypto
+      .createHash("sha256")
+      .update(ingestSupport)
+      .digest("hex");
+    const ingestSupportKey = `scripts/ingest_support-${ingestSupportDigest}.py`;
+
+    // The MongoDB helpers the Lambdas use, shared with the ingest script for its deletes and the
+    // index migration
+    const destinationUtils = fs.readFileSync(
+      "lambda/s3_mongodb_lambda/mongodb_utils.py",
+      "utf8"
+    );
+    const destinationUtilsDigest = crypto
+      .createHash("sha256")
+      .update(destinationUtils)
+      .digest("hex");
+    const destinationUtilsKey = `scripts/mongodb_utils-${destinationUtilsDigest}.py`;
+
+    const ingestScriptDeployment = new s3deploy.BucketDeployment(
+      this,
+      "IngestScriptDeployment",
+      {
+        sources: [
+          s3deploy.Source.data(ingestScriptKey, ingestScript),
+          s3deploy.Source.data(ingestSupportKey, ingestSupport),
+          s3deploy.Source.data(destinationUtilsKey, destinationUtils),
+        ],
+        destinationBucket: manifestBucket,
+        // Keep earlier script versions around for jobs that are still queued
+        prune: false,
+      }
+    );
+
     // Batch Job Definition with ARM64 architecture
     const jobDefinition = new batch.CfnJobDefinition(this, "MyBatchJobDef", {
       type: "container",
       containerProperties: {
         image: "public.ecr.aws/q1n8b2k4/hcamacho/unstructured-demo:latest",
+        environment: [
+          {
+            name: "APP_SCRIPT",
+            value: fs.readFileSync(
+              "lambda/batch_bootstrap/script_bootstrap.py",
+              "utf8"
+            ),
+          },
+          {
+            name: "INGEST_SCRIPT_S3_URI",
+            value: manifestBucket.s3UrlForObject(ingestScriptKey),
+          },
+          { name: "INGEST_SCRIPT_SHA256", value: ingestScriptDigest },
+          {
+            name: "INGEST_SUPPORT_S3_URI",
+            value: manifestBucket.s3UrlForObject(ingestSupportKey),
+          },
+          { name: "INGEST_SUPPORT_SHA256", value: ingestSupportDigest },
+          { name: "DESTINATION_UTILS_MODULE", value: "mongodb_utils" },
+          {
+            name: "DESTINATION_UTILS_S3_URI",
+            value: manifestBucket.s3UrlForObject(destinationUtilsKey),
+          },
+          { name: "DESTINATION_UTILS_SHA256", value: destinationUtilsDigest },
+          {
+            name: "EMBEDDING_CACHE_TABLE_NAME",
+            value: embeddingCacheTable.tableName,
+          },
+        ],
         resourceRequirements: [
           { type: "VCPU", value: process.env.CONTAINER_VCPU },
           { type: "MEMORY", value: process.env.CONTAINER_MEMORY },
         ],
-        jobRoleArn: new iam.Role(this, "BatchJobRole", {
-          assumedBy: new iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
-        }).roleArn,
+        jobRoleArn: batchJobRole.roleArn,
         executionRoleArn: batchExecutionRole.roleArn,
         runtimePlatform: {
           cpuArchitecture: "ARM64",
@@ -114,6 +225,44 @@ export class Dropbox_MongoDB_CDK_Stack extends cdk.Stack {
       platformCapabilities: ["FARGATE"],
     });
 
+    jobDefinition.node.addDependency(ingestScriptDeployment);
+
+    // One-off job that builds the destination collection's indexes, kept out of the ingest runs so
+    // none of them waits on an index build. It is submitted on deploy and again whenever the job
+    // definition or the indexed fields change; the deploy doesn't wait for it to finish.
+    const indexMigrationJob: custom_resources.AwsSdkCall = {
+      service: "Batch",
+      action: "submitJob",
+      parameters: {
+        jobName: "MongoDBIndexMigration",
+        jobQueue: jobQueue.ref,
+        jobDefinition: jobDefinition.ref,
+        containerOverrides: {
+          environment: [
+            { name: "INGEST_MODE", value: "migrate" },
+            { name: "MONGODB_URI", value: process.env.MONGODB_URI! },
+            { name: "MONGODB_DATABASE", value: process.env.MONGODB_DATABASE! },
+            { name: "MONGODB_COLLECTION", value: process.env.MONGODB_COLLECTION! },
+            {
+              name: "MONGODB_INDEX_FIELDS",
+              value:
+                process.env.MONGODB_INDEX_FIELDS ||
+                "metadata.filename,metadata.data_source.record_locator.remote_file_path",
+            },
+          ],
+        },
+      },
+      physicalResourceId: custom_resources.PhysicalResourceId.fromResponse("jobId"),
+    };
+
+    new custom_resources.AwsCustomResource(this, "MongoDBIndexMigration", {
+      onCreate: indexMigrationJob,
+      onUpdate: indexMigrationJob,
+      policy: custom_resources.AwsCustomResourcePolicy.fromSdkCalls({
+        resources: [jobQueue.ref, jobDefinition.ref],
+      }),
+    });
+
     // Setting up DynamoDB
     const tokenTable = new dynamodb.Table(this, "TokenTable", {
       partitionKey: { name: "TokenID", type: dynamodb.AttributeType.STRING },
@@ -129,6 +278,12 @@ export class Dropbox_MongoDB_CDK_Stack extends cdk.Stack {
       compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
     });
 
+    // manifest_utils, backfill_utils and ingest_record_utils, shared by every pipeline's Lambdas
+    const ingestUtilsLayer = new lambda.LayerVersion(this, "IngestUtilsLayer", {
+      code: lambda.Code.fromAsset("lambda/ingest_utils_layer"),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
+    });
+
     // Create a role for the Lambda functions
     const lambdaExecutionRole = new iam.Role(this, "LambdaExecutionRole", {
       assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
@@ -140,12 +295,24 @@ export class Dropbox_MongoDB_CDK_Stack extends cdk.Stack {
       )
     );
 
-    // Lambda function to handle webhook requests
-    const webhookLambda = new lambda.Function(this, "WebhookHandlerLambda", {
+    // Webhook notifications arriving within this many seconds are collapsed into one sync run
+    const syncCoalesceSeconds = process.env.SYNC_COALESCE_SECONDS || "30";
+
+    // FIFO queue the webhook drops notifications into. Notifications in the same window share a
+    // deduplication ID, and the delivery delay holds the survivor until the window has closed.
+    const syncQueue = new sqs.Queue(this, "DropboxSyncQueue", {
+      fifo: true,
+      deliveryDelay: cdk.Duration.seconds(Number(syncCoalesceSeconds)),
+      visibilityTimeout: cdk.Duration.minutes(6),
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // Lambda function that drains the sync queue and submits the ingestion work
+    const syncLambda = new lambda.Function(this, "DropboxSyncLambda", {
       runtime: lambda.Runtime.PYTHON_3_9,
       code: lambda.Code.fromAsset("lambda/dropbox_mongodb_lambda"),
-      handler: "webhook_handler.handler",
-      layers: [requestsLayer],
+      handler: "webhook_handler.sync_handler",
+      layers: [requestsLayer, ingestUtilsLayer],
       environment: {
         JOB_QUEUE: jobQueue.ref,
         JOB_DEFINITION: jobDefinition.ref,
@@ -163,23 +330,49 @@ export class Dropbox_MongoDB_CDK_Stack extends cdk.Stack {
         MONGODB_DATABASE: process.env.MONGODB_DATABASE!,
         MONGODB_COLLECTION: process.env.MONGODB_COLLECTION!,
         DYNAMODB_TABLE_NAME: tokenTable.tableName,
+        MANIFEST_BUCKET_NAME: manifestBucket.bucketName,
+        BUNDLE_MAX_FILES: process.env.BUNDLE_MAX_FILES || "25",
+        BUNDLE_MAX_BYTES: process.env.BUNDLE_MAX_BYTES || "268435456",
+        // Longer than the function timeout so a live sync never loses its lease
+        SYNC_LEASE_SECONDS: "360",
+        // A sync that finds the previous sync's jobs still running queues itself again
+        SYNC_QUEUE_URL: syncQueue.queueUrl,
       },
-      timeout: cdk.Duration.seconds(30),
+      timeout: cdk.Duration.minutes(5),
     });
 
-    // Grant permissions for the add Lambda to submit jobs to AWS Batch
-    webhookLambda.addToRolePolicy(
+    // Messages in a FIFO group are delivered one batch at a time, so each folder syncs serially
+    syncLambda.addEventSource(
+      new lambda_event_sources.SqsEventSource(syncQueue, { batchSize: 10 })
+    );
+
+    // Grant permissions for the sync Lambda to submit jobs to AWS Batch
+    syncLambda.addToRolePolicy(
       new iam.PolicyStatement({
         actions: ["batch:SubmitJob"],
         resources: [jobQueue.ref, jobDefinition.ref],
       })
     );
 
+    // DescribeJobs has no resource-level permissions; the sync Lambda uses it to wait for the
+    // previous sync's jobs before submitting new ones for the same folder
+    syncLambda.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: ["batch:DescribeJobs"],
+        resources: ["*"],
+      })
+    );
+
+    syncQueue.grantSendMessages(syncLambda);
+
     // grant lambda function permission to read and write to the database.
-    tokenTable.grantReadWriteData(webhookLambda);
+    tokenTable.grantReadWriteData(syncLambda);
+
+    // Allow the sync Lambda to write array job manifests
+    manifestBucket.grantWrite(syncLambda);
 
     // Add specific permissions for DynamoDB access
-    webhookLambda.addToRolePolicy(
+    syncLambda.addToRolePolicy(
       new iam.PolicyStatement({
         actions: [
           "dynamodb:GetItem",
@@ -190,6 +383,34 @@ export class Dropbox_MongoDB_CDK_Stack extends cdk.Stack {
       })
     );
 
+    // Grant CloudWatch logging permissions to the Lambda function
+    syncLambda.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents",
+        ],
+        resources: ["*"],
+      })
+    );
+
+    // Lambda function to handle webhook requests; it only queues a sync
+    const webhookLambda = new lambda.Function(this, "WebhookHandlerLambda", {
+      runtime: lambda.Runtime.PYTHON_3_9,
+      code: lambda.Code.fromAsset("lambda/dropbox_mongodb_lambda"),
+      handler: "webhook_handler.handler",
+      layers: [requestsLayer, ingestUtilsLayer],
+      environment: {
+        DROPBOX_REMOTE_URL: process.env.DROPBOX_REMOTE_URL!,
+        SYNC_QUEUE_URL: syncQueue.queueUrl,
+        SYNC_COALESCE_SECONDS: syncCoalesceSeconds,
+      },
+      timeout: cdk.Duration.seconds(30),
+    });
+
+    syncQueue.grantSendMessages(webhookLambda);
+
     // Grant CloudWatch logging permissions to the Lambda function
     webhookLambda.addToRolePolicy(
       new iam.PolicyStatement({
@@ -1,6 +1,7 @@
 import * as cdk from "aws-cdk-lib";
 import { Stack, StackProps } from "aws-cdk-lib";
 import * as s3 from "aws-cdk-lib/aws-s3";
+import * as s3deploy from "aws-cdk-lib/aws-s3-deployment";
 import * as lambda from "aws-cdk-lib/aws-lambda";
 import * as s3_notifications from "aws-cdk-lib/aws-s3-notifications";
 import * as batch from "aws-cdk-lib/aws-batch";
@@ -8,7 +9,14 @@ import * as ec2 from "aws-cdk-lib/aws-ec2";
 import * as iam from "aws-cdk-lib/aws-iam";
 import * as logs from "aws-cdk-lib/aws-logs";
 import * as custom_resources from "aws-cdk-lib/custom-resources";
+import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
+import * as ecs from "aws-cdk-lib/aws-ecs";
+import * as sqs from "aws-cdk-lib/aws-sqs";
+import * as appscaling from "aws-cdk-lib/aws-applicationautoscaling";
+import * as cloudwatch from "aws-cdk-lib/aws-cloudwatch";
 import * as dotenv from "dotenv";
+import * as fs from "fs";
+import * as crypto from "crypto";
 import { Construct } from "constructs";
 
 dotenv.config();
@@ -90,18 +98,123 @@ export class S3_MongoDB_CDK_Stack extends Stack {
       ],
     });
 
+    // Role assumed by the ingest containers themselves
+    const batchJobRole = new iam.Role(this, "BatchJobRole", {
+      assumedBy: new iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+    });
+
+    // Bucket holding the sharded manifests that array job children read and the
+    // content-addressed ingest scripts the job definition points at
+    const manifestBucket = new s3.Bucket(this, "ManifestBucket", {
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      autoDeleteObjects: true,
+      lifecycleRules: [
+        { prefix: "manifests/", expiration: cdk.Duration.days(7) },
+      ],
+    });
+
+    manifestBucket.grantRead(batchJobRole);
+
+    // Embeddings shared across jobs, keyed by provider, model and chunk text hash
+    const embeddingCacheTable = new dynamodb.Table(this, "EmbeddingCacheTable", {
+      partitionKey: { name: "CacheKey", type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: "ExpiresAt",
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    embeddingCacheTable.grantReadWriteData(batchJobRole);
+
+    // Publish the ingest script under its SHA-256 so jobs fetch (and cache) it by digest
+    // instead of every submit_job carrying the source as APP_SCRIPT
+    const ingestScript = fs.readFileSync(
+      "lambda/s3_mongodb_lambda/s3_mongodb_ingest.py",
+      "utf8"
+    );
+    const ingestScriptDigest = crypto
+      .createHash("sha256")
+      .update(ingestScript)
+      .digest("hex");
+    const ingestScriptKey = `scripts/s3_mongodb_ingest-${ingestScriptDigest}.py`;
+
+    // Shared helpers every ingest script imports, published the same way. The bootstrap puts
+    // them on the script's import path.
+    const ingestSupport = fs.readFileSync(
+      "lambda/batch_bootstrap/ingest_support.py",
+      "utf8"
+    );
+    const ingestSupportDigest = crypto
+      .createHash("sha256")
+      .update(ingestSupport)
+      .digest("hex");
+    const ingestSupportKey = `scripts/ingest_support-${ingestSupportDigest}.py`;
+
+    // The MongoDB helpers the Lambdas use, shared with the ingest script for its deletes and the
+    // index migration
+    const destinationUtils = fs.readFileSync(
+      "lambda/s3_mongodb_lambda/mongodb_utils.py",
+      "utf8"
+    );
+    const destinationUtilsDigest = crypto
+      .createHash("sha256")
+      .update(destinationUtils)
+      .digest("hex");
+    const destinationUtilsKey = `scripts/mongodb_utils-${destinationUtilsDigest}.py`;
+
+    const ingestScriptDeployment = new s3deploy.BucketDeployment(
+      this,
+      "IngestScriptDeployment",
+      {
+        sources: [
+          s3deploy.Source.data(ingestScriptKey, ingestScript),
+          s3deploy.Source.data(ingestSupportKey, ingestSupport),
+          s3deploy.Source.data(destinationUtilsKey, destinationUtils),
+        ],
+        destinationBucket: manifestBucket,
+        // Keep earlier script versions around for jobs that are still queued
+        prune: false,
+      }
+    );
+
     // Batch Job Definition with ARM64 architecture
     const jobDefinition = new batch.CfnJobDefinition(this, "MyBatchJobDef", {
       type: "container",
       containerProperties: {
         image: "public.ecr.aws/q1n8b2k4/hcamacho/unstructured-demo:v2.0",
+        environment: [
+          {
+            name: "APP_SCRIPT",
+            value: fs.readFileSync(
+              "lambda/batch_bootstrap/script_bootstrap.py",
+              "utf8"
+            ),
+          },
+          {
+            name: "INGEST_SCRIPT_S3_URI",
+            value: manifestBucket.s3UrlForObject(ingestScriptKey),
+          },
+          { name: "INGEST_SCRIPT_SHA256", value: ingestScriptDigest },
+          {
+            name: "INGEST_SUPPORT_S3_URI",
+            value: manifestBucket.s3UrlForObject(ingestSupportKey),
+          },
+          { name: "INGEST_SUPPORT_SHA256", value: ingestSupportDigest },
+          { name: "DESTINATION_UTILS_MODULE", value: "mongodb_utils" },
+          {
+            name: "DESTINATION_UTILS_S3_URI",
+            value: manifestBucket.s3UrlForObject(destinationUtilsKey),
+          },
+          { name: "DESTINATION_UTILS_SHA256", value: destinationUtilsDigest },
+          {
+            name: "EMBEDDING_CACHE_TABLE_NAME",
+            value: embeddingCacheTable.tableName,
+          },
+        ],
         resourceRequirements: [
           { type: "VCPU", value: process.env.CONTAINER_VCPU },
           { type: "MEMORY", value: process.env.CONTAINER_MEMORY },
         ],
-        jobRoleArn: new iam.Role(this, "BatchJobRole", {
-          assumedBy: new iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
-        }).roleArn,
+        jobRoleArn: batchJobRole.roleArn,
         executionRoleArn: batchExecutionRole.roleArn,
         runtimePlatform: {
           cpuArchitecture: "ARM64",
@@ -111,6 +224,44 @@ export class S3_MongoDB_CDK_Stack extends Stack {
       platformCapabilities: ["FARGATE"],
     });
 
+    jobDefinition.node.addDependency(ingestScriptDeployment);
+
+    // One-off job that builds the destination collection's indexes, kept out of the ingest runs so
+    // none of them waits on an index build. It is submitted on deploy and again whenever the job
+    // definition or the indexed fields change; the deploy doesn't wait for it to finish.
+    const indexMigrationJob: custom_resources.AwsSdkCall = {
+      service: "Batch",
+      action: "submitJob",
+      parameters: {
+        jobName: "MongoDBIndexMigration",
+        jobQueue: jobQueue.ref,
+        jobDefinition: jobDefinition.ref,
+        containerOverrides: {
+          environment: [
+            { name: "INGEST_MODE", value: "migrate" },
+            { name: "MONGODB_URI", value: process.env.MONGODB_URI! },
+            { name: "MONGODB_DATABASE", value: process.env.MONGODB_DATABASE! },
+            { name: "MONGODB_COLLECTION", value: process.env.MONGODB_COLLECTION! },
+            {
+              name: "MONGODB_INDEX_FIELDS",
+              value:
+                process.env.MONGODB_INDEX_FIELDS ||
+                "metadata.filename,metadata.data_source.record_locator.remote_file_path",
+            },
+          ],
+        },
+      },
+      physicalResourceId: custom_resources.PhysicalResourceId.fromResponse("jobId"),
+    };
+
+    new custom_resources.AwsCustomResource(this, "MongoDBIndexMigration", {
+      onCreate: indexMigrationJob,
+      onUpdate: indexMigrationJob,
+      policy: custom_resources.AwsCustomResourcePolicy.fromSdkCalls({
+        resources: [jobQueue.ref, jobDefinition.ref],
+      }),
+    });
+
     // Create a role for the Lambda functions
     const lambdaExecutionRole = new iam.Role(this, "LambdaExecutionRole", {
       assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
@@ -133,12 +284,40 @@ export class S3_MongoDB_CDK_Stack extends Stack {
       }
     );
 
+    // manifest_utils, backfill_utils and ingest_record_utils, shared by every pipeline's Lambdas
+    const ingestUtilsLayer = new lambda.LayerVersion(this, "IngestUtilsLayer", {
+      code: lambda.Code.fromAsset("lambda/ingest_utils_layer"),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
+    });
+
+    // Checkpoints for the initial S3 backfill so a timed-out invocation can resume
+    const backfillCheckpointTable = new dynamodb.Table(
+      this,
+      "BackfillCheckpointTable",
+      {
+        partitionKey: {
+          name: "BackfillID",
+          type: dynamodb.AttributeType.STRING,
+        },
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      }
+    );
+
+    // What each source object was last ingested as (ETag, embedding config hash, Batch job),
+    // so identical re-uploads skip the delete and re-embed
+    const ingestRecordTable = new dynamodb.Table(this, "IngestRecordTable", {
+      partitionKey: { name: "SourcePath", type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     // Define the Lambda function for adding
     const addLambda = new lambda.Function(this, "AddLambdaFunction", {
       runtime: lambda.Runtime.PYTHON_3_9,
       code: lambda.Code.fromAsset("lambda/s3_mongodb_lambda"),
       handler: "add_lambda_function.lambda_handler",
-      layers: [sharedLambdaLayer],
+      layers: [sharedLambdaLayer, ingestUtilsLayer],
       environment: {
         JOB_QUEUE: jobQueue.ref,
         JOB_DEFINITION: jobDefinition.ref,
@@ -155,6 +334,14 @@ export class S3_MongoDB_CDK_Stack extends Stack {
         MONGODB_COLLECTION: process.env.MONGODB_COLLECTION!,
         S3_BUCKET_NAME: process.env.S3_BUCKET_NAME!,
         S3_NOTIFICATION_PREFIX: process.env.S3_NOTIFICATION_PREFIX || "",
+        BACKFILL_TABLE_NAME: backfillCheckpointTable.tableName,
+        INGEST_RECORD_TABLE_NAME: ingestRecordTable.tableName,
+        // Destination settings that force a re-ingest when changed
+        DESTINATION_CONFIG_KEYS: "MONGODB_DATABASE,MONGODB_COLLECTION",
+        INCREMENTAL_INGEST: process.env.INCREMENTAL_INGEST || "false",
+        BUNDLE_MAX_FILES: process.env.BUNDLE_MAX_FILES || "25",
+        BUNDLE_MAX_BYTES: process.env.BUNDLE_MAX_BYTES || "268435456",
+        MANIFEST_BUCKET_NAME: manifestBucket.bucketName,
       },
       timeout: cdk.Duration.seconds(30),
     });
@@ -170,6 +357,172 @@ export class S3_MongoDB_CDK_Stack extends Stack {
     // Grant necessary permissions to access S3
     bucket.grantRead(addLambda);
 
+    // Allow the add Lambda to write array job manifests
+    manifestBucket.grantWrite(addLambda);
+
+    // Allow the add Lambda to checkpoint the backfill and re-invoke itself, and only itself, to
+    // resume it. The grant is a policy of its own because the function's default policy can't
+    // name the function's ARN without a circular dependency.
+    backfillCheckpointTable.grantReadWriteData(addLambda);
+    new iam.Policy(this, "AddLambdaSelfInvokePolicy", {
+      roles: [addLambda.role!],
+      statements: [
+        new iam.PolicyStatement({
+          actions: ["lambda:InvokeFunction"],
+          resources: [addLambda.functionArn],
+        }),
+      ],
+    });
+
+    // Allow the add Lambda to read and write ingest records and check the jobs they point at
+    ingestRecordTable.grantReadWriteData(addLambda);
+    addLambda.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: ["batch:DescribeJobs"],
+        resources: ["*"],
+      })
+    );
+
+    // Warm ingest workers: long-lived Fargate tasks that take manifests off a queue and keep the
+    // partitioner and embedder loaded between documents. The add Lambda sends work here instead
+    // of to Batch when INGEST_DISPATCH=worker.
+    const ingestWorkerDeadLetterQueue = new sqs.Queue(
+      this,
+      "IngestWorkerDeadLetterQueue",
+      { retentionPeriod: cdk.Duration.days(14) }
+    );
+
+    const ingestWorkerQueue = new sqs.Queue(this, "IngestWorkerQueue", {
+      // Covers a worker until its first visibility heartbeat; after that it keeps extending the
+      // timeout while it works, so only a stopped worker's manifest is redelivered
+      visibilityTimeout: cdk.Duration.minutes(30),
+      deadLetterQueue: {
+        queue: ingestWorkerDeadLetterQueue,
+        maxReceiveCount: 3,
+      },
+    });
+
+    const ingestWorkerTaskDefinition = new ecs.FargateTaskDefinition(
+      this,
+      "IngestWorkerTaskDef",
+      {
+        cpu: Number(process.env.CONTAINER_VCPU) * 1024,
+        memoryLimitMiB: Number(process.env.CONTAINER_MEMORY),
+        taskRole: batchJobRole,
+        executionRole: batchExecutionRole,
+        runtimePlatform: {
+          cpuArchitecture: ecs.CpuArchitecture.ARM64,
+          operatingSystemFamily: ecs.OperatingSystemFamily.LINUX,
+        },
+      }
+    );
+
+    ingestWorkerTaskDefinition.addContainer("IngestWorker", {
+      image: ecs.ContainerImage.fromRegistry(
+        "public.ecr.aws/q1n8b2k4/hcamacho/unstructured-demo:v2.0"
+      ),
+      environment: {
+        APP_SCRIPT: fs.readFileSync(
+          "lambda/batch_bootstrap/script_bootstrap.py",
+          "utf8"
+        ),
+        INGEST_SCRIPT_S3_URI: manifestBucket.s3UrlForObject(ingestScriptKey),
+        INGEST_SCRIPT_SHA256: ingestScriptDigest,
+        INGEST_SUPPORT_S3_URI: manifestBucket.s3UrlForObject(ingestSupportKey),
+        INGEST_SUPPORT_SHA256: ingestSupportDigest,
+        DESTINATION_UTILS_MODULE: "mongodb_utils",
+        DESTINATION_UTILS_S3_URI:
+          manifestBucket.s3UrlForObject(destinationUtilsKey),
+        DESTINATION_UTILS_SHA256: destinationUtilsDigest,
+        INGEST_WORKER_QUEUE_URL: ingestWorkerQueue.queueUrl,
+        // Run the pipeline steps in the worker process so loaded models survive between documents
+        INGEST_DISABLE_PARALLELISM: "true",
+        INGEST_MODE:
+          process.env.INCREMENTAL_INGEST === "true" ? "incremental" : "full",
+        INGEST_RECORD_TABLE_NAME: ingestRecordTable.tableName,
+        EMBEDDING_CACHE_TABLE_NAME: embeddingCacheTable.tableName,
+        EMBEDDING_PROVIDER: process.env.EMBEDDING_PROVIDER!,
+        EMBEDDING_MODEL_NAME: process.env.EMBEDDING_MODEL_NAME!,
+        EMBEDDING_PROVIDER_API_KEY:
+          process.env.EMBEDDING_PROVIDER_API_KEY || "",
+        CHUNKING_STRATEGY: process.env.CHUNKING_STRATEGY || "",
+        CHUNKING_MAX_CHARACTERS: process.env.CHUNKING_MAX_CHARACTERS || "",
+        MONGODB_URI: process.env.MONGODB_URI!,
+        MONGODB_DATABASE: process.env.MONGODB_DATABASE!,
+        MONGODB_COLLECTION: process.env.MONGODB_COLLECTION!,
+        LOCAL_FILE_DOWNLOAD_DIR: "/tmp/",
+      },
+      logging: ecs.LogDrivers.awsLogs({ streamPrefix: "ingest-worker" }),
+    });
+
+    const ingestWorkerCluster = new ecs.Cluster(this, "IngestWorkerCluster", {
+      vpc,
+    });
+
+    const minIngestWorkers = Number(
+      process.env.INGEST_WORKER_MIN_TASKS || "0"
+    );
+    const maxIngestWorkers = Number(
+      process.env.INGEST_WORKER_MAX_TASKS || "10"
+    );
+
+    const ingestWorkerService = new ecs.FargateService(
+      this,
+      "IngestWorkerService",
+      {
+        cluster: ingestWorkerCluster,
+        taskDefinition: ingestWorkerTaskDefinition,
+        desiredCount: minIngestWorkers,
+      }
+    );
+
+    ingestWorkerService.node.addDependency(ingestScriptDeployment);
+
+    // Size the fleet from the backlog. In-flight messages count too, so workers that are busy
+    // with the last manifests aren't stopped just because nothing is waiting.
+    const ingestWorkerBacklog = new cloudwatch.MathExpression({
+      expression: "visible + inFlight",
+      usingMetrics: {
+        visible: ingestWorkerQueue.metricApproximateNumberOfMessagesVisible(),
+        inFlight: ingestWorkerQueue.metricApproximateNumberOfMessagesNotVisible(),
+      },
+      period: cdk.Duration.minutes(1),
+    });
+
+    ingestWorkerService
+      .autoScaleTaskCount({
+        minCapacity: minIngestWorkers,
+        maxCapacity: maxIngestWorkers,
+      })
+      .scaleOnMetric("IngestWorkerBacklogScaling", {
+        metric: ingestWorkerBacklog,
+        adjustmentType: appscaling.AdjustmentType.EXACT_CAPACITY,
+        scalingSteps: [
+          { upper: 0, change: minIngestWorkers },
+          { lower: 1, change: Math.max(1, minIngestWorkers) },
+          { lower: 10, change: Math.max(1, Math.ceil(maxIngestWorkers / 2)) },
+          { lower: 50, change: maxIngestWorkers },
+        ],
+        cooldown: cdk.Duration.minutes(1),
+      });
+
+    // The workers read the source objects with the task role, take and retry manifests, and
+    // drop the ingest records of objects they give up on
+    bucket.grantRead(batchJobRole);
+    ingestWorkerQueue.grantConsumeMessages(batchJobRole);
+    ingestWorkerQueue.grantSendMessages(batchJobRole);
+    ingestRecordTable.grantWriteData(batchJobRole);
+
+    ingestWorkerQueue.grantSendMessages(addLambda);
+    addLambda.addEnvironment(
+      "INGEST_WORKER_QUEUE_URL",
+      ingestWorkerQueue.queueUrl
+    );
+    addLambda.addEnvironment(
+      "INGEST_DISPATCH",
+      process.env.INGEST_DISPATCH || "batch"
+    );
+
     // Add permissions for S3 to invoke addLambda
     addLambda.addPermission("S3InvokeAddLambda", {
       principal: new iam.ServicePrincipal("s3.amazonaws.com"),
@@ -182,11 +535,12 @@ export class S3_MongoDB_CDK_Stack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "delete_lambda_function.lambda_handler",
       code: lambda.Code.fromAsset("lambda/s3_mongodb_lambda"),
-      layers: [sharedLambdaLayer],
+      layers: [sharedLambdaLayer, ingestUtilsLayer],
       environment: {
         MONGODB_URI: process.env.MONGODB_URI!,
         MONGODB_DATABASE: process.env.MONGODB_DATABASE!,
         MONGODB_COLLECTION: process.env.MONGODB_COLLECTION!,
+        INGEST_RECORD_TABLE_NAME: ingestRecordTable.tableName,
       },
       timeout: cdk.Duration.seconds(30),
     });
@@ -198,6 +552,9 @@ export class S3_MongoDB_CDK_Stack extends Stack {
       })
     );
 
+    // Allow the delete Lambda to drop the ingest record of a removed object
+    ingestRecordTable.grantWriteData(deleteLambda);
+
     // Grant necessary permissions to access S3 for the delete Lambda
     bucket.grantRead(deleteLambda);
 
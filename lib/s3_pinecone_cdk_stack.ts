@@ -1,6 +1,7 @@
 import * as cdk from "aws-cdk-lib";
 import { Stack, StackProps } from "aws-cdk-lib";
 import * as s3 from "aws-cdk-lib/aws-s3";
+import * as s3deploy from "aws-cdk-lib/aws-s3-deployment";
 import * as lambda from "aws-cdk-lib/aws-lambda";
 import * as s3_notifications from "aws-cdk-lib/aws-s3-notifications";
 import * as batch from "aws-cdk-lib/aws-batch";
@@ -11,9 +12,15 @@ import * as custom_resources from "aws-cdk-lib/custom-resources";
 
 import * as apigateway from "aws-cdk-lib/aws-apigateway";
 import * as dotenv from "dotenv";
+import * as fs from "fs";
+import * as crypto from "crypto";
 import * as apigatewayv2 from "aws-cdk-lib/aws-apigatewayv2";
 import * as apigatewayv2integrations from "aws-cdk-lib/aws-apigatewayv2-integrations";
 import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
+import * as ecs from "aws-cdk-lib/aws-ecs";
+import * as sqs from "aws-cdk-lib/aws-sqs";
+import * as appscaling from "aws-cdk-lib/aws-applicationautoscaling";
+import * as cloudwatch from "aws-cdk-lib/aws-cloudwatch";
 import * as destinations from "aws-cdk-lib/aws-logs-destinations";
 import * as events from "aws-cdk-lib/aws-events";
 import * as targets from "aws-cdk-lib/aws-events-targets";
@@ -55,6 +62,7 @@ export class S3_Pinecone_CDK_Stack extends Stack {
           "execute-api:ManageConnections",
           "apigatewaymanagementapi:PostToConnection",
           "batch:ListJobs",
+          "cloudwatch:GetMetricData",
         ],
         resources: ["*"],
       })
@@ -69,16 +77,62 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
+    // Broadcasts find every live connection of the dashboard client through this index
+    connectionTable.addGlobalSecondaryIndex({
+      indexName: "ClientConnectionsIndex",
+      partitionKey: { name: "clientId", type: dynamodb.AttributeType.STRING },
+      sortKey: { name: "timestamp", type: dynamodb.AttributeType.NUMBER },
+      projectionType: dynamodb.ProjectionType.KEYS_ONLY,
+    });
+
     const clientDataTable = new dynamodb.Table(this, "ClientDataTable", {
       partitionKey: { name: "clientId", type: dynamodb.AttributeType.STRING }, // Partition key by clientId
       sortKey: { name: "timestamp", type: dynamodb.AttributeType.NUMBER }, // Sort by timestamp
+      timeToLiveAttribute: "ExpiresAt", // Log lines and hourly log summaries
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    const logRetentionEnvironment = {
+      LOG_RETENTION_DAYS: process.env.LOG_RETENTION_DAYS || "7",
+      LOG_SUMMARY_RETENTION_DAYS: process.env.LOG_SUMMARY_RETENTION_DAYS || "90",
+      LOG_COMPACT_AFTER_HOURS: process.env.LOG_COMPACT_AFTER_HOURS || "24",
+    };
+
+    // How vectors are laid out in the index: "namespace" gives each file a namespace named after
+    // it, "prefix" keeps every file in PINECONE_NAMESPACE (or that many sharded namespaces) under
+    // IDs prefixed with a key for the object. Everything that reads or writes the index needs it.
+    const pineconeLayoutEnvironment = {
+      PINECONE_LAYOUT: process.env.PINECONE_LAYOUT || "namespace",
+      PINECONE_NAMESPACE: process.env.PINECONE_NAMESPACE || "documents",
+      PINECONE_NAMESPACE_SHARDS: process.env.PINECONE_NAMESPACE_SHARDS || "1",
+    };
+
+    // Each Batch job's last counted status, so a state change knows which counter to decrement
+    const jobStatusTable = new dynamodb.Table(this, "JobStatusTable", {
+      partitionKey: { name: "jobId", type: dynamodb.AttributeType.STRING },
+      timeToLiveAttribute: "ExpiresAt",
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
+    jobStatusTable.grantReadWriteData(lambdaExecutionRole);
+
+    // connection_utils and job_status_utils, shared by the websocket Lambdas and the dashboard
+    // Lambdas in s3_pinecone_lambda from this one source directory
+    const dashboardUtilsLayer = new lambda.LayerVersion(
+      this,
+      "DashboardUtilsLayer",
+      {
+        code: lambda.Code.fromAsset("lambda/dashboard_utils_layer"),
+        compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
+      }
+    );
+
     const connectLambda = new lambda.Function(this, "ConnectLambda", {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "connect_lambda.lambda_handler",
       code: lambda.Code.fromAsset("lambda/websocket_utils_lambda"),
+      layers: [dashboardUtilsLayer],
       environment: {
         CONNECTION_TABLE_NAME: connectionTable.tableName,
       },
@@ -91,6 +145,7 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "disconnect_lambda.lambda_handler",
       code: lambda.Code.fromAsset("lambda/websocket_utils_lambda"),
+      layers: [dashboardUtilsLayer],
       environment: {
         CONNECTION_TABLE_NAME: connectionTable.tableName,
       },
@@ -110,17 +165,43 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       }
     );
 
+    // manifest_utils, backfill_utils and ingest_record_utils, shared by every pipeline's Lambdas
+    const ingestUtilsLayer = new lambda.LayerVersion(this, "IngestUtilsLayer", {
+      code: lambda.Code.fromAsset("lambda/ingest_utils_layer"),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
+    });
+
+    // Per-stage ingest metrics, republished as EMF by the telemetry consumer
+    const stageMetricsNamespace = `Splinter/${this.stackName}`;
+
     const initialCheckLambda = new lambda.Function(this, "InitialCheckLambda", {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "initial_check_lambda.lambda_handler", // Lambda handler function
       code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"), // Path to your Lambda code
-      layers: [sharedLambdaLayer],
+      layers: [sharedLambdaLayer, dashboardUtilsLayer],
       environment: {
         SOURCE_DESTINATION_EMBEDDING: process.env.SOURCE_DESTINATION_EMBEDDING!,
         CONNECTION_TABLE_NAME: connectionTable.tableName,
         CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
         PINECONE_API_KEY: process.env.PINECONE_API_KEY!,
         PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
+        ...pineconeLayoutEnvironment,
+        STAGE_METRICS_NAMESPACE: stageMetricsNamespace,
+        JOB_STATUS_TABLE_NAME: jobStatusTable.tableName,
+      },
+      // Several table reads, a Pinecone call and a GetMetricData query per snapshot
+      timeout: cdk.Duration.seconds(30),
+      role: lambdaExecutionRole,
+    });
+
+    // Answers the dashboard's requests for older pages of the event log
+    const fetchLogsLambda = new lambda.Function(this, "FetchLogsLambda", {
+      runtime: lambda.Runtime.PYTHON_3_9,
+      handler: "fetch_logs_lambda.lambda_handler",
+      code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
+      layers: [dashboardUtilsLayer],
+      environment: {
+        CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
       },
       role: lambdaExecutionRole,
     });
@@ -147,16 +228,24 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       ),
     });
 
+    websocketApi.addRoute("fetchLogs", {
+      integration: new apigatewayv2integrations.WebSocketLambdaIntegration(
+        "FetchLogsLambdaIntegration",
+        fetchLogsLambda
+      ),
+    });
+
     const vectorCountLambda = new lambda.Function(this, "VectorCountLambda", {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "vector_count_pinecone_lambda.lambda_handler",
       code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
-      layers: [sharedLambdaLayer],
+      layers: [sharedLambdaLayer, dashboardUtilsLayer],
       environment: {
         PINECONE_API_KEY: process.env.PINECONE_API_KEY!,
         PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
         CONNECTION_TABLE_NAME: connectionTable.tableName,
         CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
+        ...logRetentionEnvironment,
       },
       timeout: cdk.Duration.seconds(60),
       role: lambdaExecutionRole,
@@ -180,6 +269,86 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       filterPattern: logs.FilterPattern.anyTerm(...filterTerms),
     });
 
+    // Aggregates the ingest jobs' structured telemetry records into the dashboard counters
+    const telemetryConsumerLambda = new lambda.Function(
+      this,
+      "TelemetryConsumerLambda",
+      {
+        runtime: lambda.Runtime.PYTHON_3_9,
+        handler: "telemetry_consumer_lambda.lambda_handler",
+        code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
+        layers: [dashboardUtilsLayer],
+        environment: {
+          CONNECTION_TABLE_NAME: connectionTable.tableName,
+          CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
+          STAGE_METRICS_NAMESPACE: stageMetricsNamespace,
+        },
+        timeout: cdk.Duration.seconds(30),
+        role: lambdaExecutionRole,
+      }
+    );
+
+    new logs.SubscriptionFilter(this, "TelemetrySubscriptionFilter", {
+      logGroup: centralLogGroup,
+      destination: new destinations.LambdaDestination(telemetryConsumerLambda),
+      filterPattern: logs.FilterPattern.numberValue("$.telemetry", "=", 1),
+    });
+
+    // The telemetry consumer keeps the index totals current from ingest and delete records;
+    // this resets them from describe_index_stats on a slow schedule to correct any drift
+    const indexCountReconcileLambda = new lambda.Function(
+      this,
+      "IndexCountReconcileLambda",
+      {
+        runtime: lambda.Runtime.PYTHON_3_9,
+        handler: "vector_count_pinecone_lambda.reconcile_handler",
+        code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
+        layers: [sharedLambdaLayer, dashboardUtilsLayer],
+        environment: {
+          PINECONE_API_KEY: process.env.PINECONE_API_KEY!,
+          PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
+          ...pineconeLayoutEnvironment,
+          CONNECTION_TABLE_NAME: connectionTable.tableName,
+          CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
+        },
+        timeout: cdk.Duration.seconds(30),
+        role: lambdaExecutionRole,
+      }
+    );
+
+    new events.Rule(this, "IndexCountReconcileRule", {
+      schedule: events.Schedule.rate(
+        cdk.Duration.minutes(
+          Number(process.env.INDEX_COUNT_RECONCILE_MINUTES || "30")
+        )
+      ),
+      targets: [new targets.LambdaFunction(indexCountReconcileLambda)],
+    });
+
+    // Rolls event log lines older than LOG_COMPACT_AFTER_HOURS into hourly summaries, so the
+    // log partition stays about a day of lines plus one item per hour
+    const logCompactionLambda = new lambda.Function(
+      this,
+      "LogCompactionLambda",
+      {
+        runtime: lambda.Runtime.PYTHON_3_9,
+        handler: "log_compaction_lambda.lambda_handler",
+        code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
+        layers: [dashboardUtilsLayer],
+        environment: {
+          CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
+          ...logRetentionEnvironment,
+        },
+        timeout: cdk.Duration.seconds(300),
+        role: lambdaExecutionRole,
+      }
+    );
+
+    new events.Rule(this, "LogCompactionRule", {
+      schedule: events.Schedule.rate(cdk.Duration.hours(1)),
+      targets: [new targets.LambdaFunction(logCompactionLambda)],
+    });
+
     new apigatewayv2.WebSocketStage(this, "WebSocketStage", {
       webSocketApi: websocketApi,
       stageName: "dev",
@@ -190,14 +359,45 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "new_status_lambda.lambda_handler",
       code: lambda.Code.fromAsset("lambda/websocket_utils_lambda"),
+      layers: [dashboardUtilsLayer],
       environment: {
         CONNECTION_TABLE_NAME: connectionTable.tableName,
         CENTRAL_LOG_GROUP_NAME: centralLogGroup.logGroupName,
         CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
+        JOB_STATUS_TABLE_NAME: jobStatusTable.tableName,
       },
       role: lambdaExecutionRole,
     });
 
+    // The state change events keep the job status counts current; this resets them from
+    // list_jobs on a slow schedule to correct any drift
+    const jobStatusReconcileLambda = new lambda.Function(
+      this,
+      "JobStatusReconcileLambda",
+      {
+        runtime: lambda.Runtime.PYTHON_3_9,
+        handler: "new_status_lambda.reconcile_handler",
+        code: lambda.Code.fromAsset("lambda/websocket_utils_lambda"),
+        layers: [dashboardUtilsLayer],
+        environment: {
+          CONNECTION_TABLE_NAME: connectionTable.tableName,
+          CLIENT_DATA_TABLE_NAME: clientDataTable.tableName,
+          JOB_STATUS_TABLE_NAME: jobStatusTable.tableName,
+        },
+        timeout: cdk.Duration.seconds(60),
+        role: lambdaExecutionRole,
+      }
+    );
+
+    new events.Rule(this, "JobStatusReconcileRule", {
+      schedule: events.Schedule.rate(
+        cdk.Duration.minutes(
+          Number(process.env.JOB_STATUS_RECONCILE_MINUTES || "30")
+        )
+      ),
+      targets: [new targets.LambdaFunction(jobStatusReconcileLambda)],
+    });
+
     new cdk.CfnOutput(this, "WebSocketURL", {
       value: `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`,
       description: "WebSocket URL",
@@ -207,14 +407,30 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       "WEBSOCKET_API_URL",
       `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
     );
+    indexCountReconcileLambda.addEnvironment(
+      "WEBSOCKET_API_URL",
+      `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
+    );
+    telemetryConsumerLambda.addEnvironment(
+      "WEBSOCKET_API_URL",
+      `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
+    );
     batchEventLambda.addEnvironment(
       "WEBSOCKET_API_URL",
       `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
     );
+    jobStatusReconcileLambda.addEnvironment(
+      "WEBSOCKET_API_URL",
+      `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
+    );
     initialCheckLambda.addEnvironment(
       "WEBSOCKET_API_URL",
       `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
     );
+    fetchLogsLambda.addEnvironment(
+      "WEBSOCKET_API_URL",
+      `wss://${websocketApi.apiId}.execute-api.${this.region}.amazonaws.com/dev`
+    );
 
     const batchEventRule = new events.Rule(this, "BatchEventRule", {
       eventPattern: {
@@ -354,19 +570,126 @@ export class S3_Pinecone_CDK_Stack extends Stack {
 
     batchEventLambda.addEnvironment("JOB_QUEUE", jobQueue.attrJobQueueArn);
     initialCheckLambda.addEnvironment("JOB_QUEUE", jobQueue.attrJobQueueArn);
+    jobStatusReconcileLambda.addEnvironment("JOB_QUEUE", jobQueue.attrJobQueueArn);
+
+    // The dashboard shows no job counts until they have been reconciled once, so run the first
+    // reconcile on deploy instead of waiting for the schedule. It is invoked asynchronously; the
+    // deploy doesn't wait for it to page through list_jobs.
+    new custom_resources.AwsCustomResource(this, "InitialJobStatusReconcile", {
+      onCreate: {
+        service: "Lambda",
+        action: "invoke",
+        parameters: {
+          FunctionName: jobStatusReconcileLambda.functionName,
+          InvocationType: "Event",
+        },
+        physicalResourceId: custom_resources.PhysicalResourceId.of(
+          "InitialJobStatusReconcile"
+        ),
+      },
+      policy: custom_resources.AwsCustomResourcePolicy.fromSdkCalls({
+        resources: [jobStatusReconcileLambda.functionArn],
+      }),
+    });
+
+    // Role assumed by the ingest containers themselves
+    const batchJobRole = new iam.Role(this, "BatchJobRole", {
+      assumedBy: new iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+    });
+
+    // Bucket holding the sharded manifests that array job children read and the
+    // content-addressed ingest scripts the job definition points at
+    const manifestBucket = new s3.Bucket(this, "ManifestBucket", {
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      autoDeleteObjects: true,
+      lifecycleRules: [
+        { prefix: "manifests/", expiration: cdk.Duration.days(7) },
+      ],
+    });
+
+    manifestBucket.grantRead(batchJobRole);
+
+    // Embeddings shared across jobs, keyed by provider, model and chunk text hash
+    const embeddingCacheTable = new dynamodb.Table(this, "EmbeddingCacheTable", {
+      partitionKey: { name: "CacheKey", type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: "ExpiresAt",
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    embeddingCacheTable.grantReadWriteData(batchJobRole);
+
+    // Publish the ingest script under its SHA-256 so jobs fetch (and cache) it by digest
+    // instead of every submit_job carrying the source as APP_SCRIPT
+    const ingestScript = fs.readFileSync(
+      "lambda/s3_pinecone_lambda/s3_pinecone_ingest.py",
+      "utf8"
+    );
+    const ingestScriptDigest = crypto
+      .createHash("sha256")
+      .update(ingestScript)
+      .digest("hex");
+    const ingestScriptKey = `scripts/s3_pinecone_ingest-${ingestScriptDigest}.py`;
+
+    // Shared helpers every ingest script imports, published the same way. The bootstrap puts
+    // them on the script's import path.
+    const ingestSupport = fs.readFileSync(
+      "lambda/batch_bootstrap/ingest_support.py",
+      "utf8"
+    );
+    const ingestSupportDigest = crypto
+      .createHash("sha256")
+      .update(ingestSupport)
+      .digest("hex");
+    const ingestSupportKey = `scripts/ingest_support-${ingestSupportDigest}.py`;
+
+    const ingestScriptDeployment = new s3deploy.BucketDeployment(
+      this,
+      "IngestScriptDeployment",
+      {
+        sources: [
+          s3deploy.Source.data(ingestScriptKey, ingestScript),
+          s3deploy.Source.data(ingestSupportKey, ingestSupport),
+        ],
+        destinationBucket: manifestBucket,
+        // Keep earlier script versions around for jobs that are still queued
+        prune: false,
+      }
+    );
 
     // Batch Job Definition with ARM64 architecture
     const jobDefinition = new batch.CfnJobDefinition(this, "MyBatchJobDef", {
       type: "container",
       containerProperties: {
         image: "public.ecr.aws/q1n8b2k4/hcamacho/unstructured-demo:latest",
+        environment: [
+          {
+            name: "APP_SCRIPT",
+            value: fs.readFileSync(
+              "lambda/batch_bootstrap/script_bootstrap.py",
+              "utf8"
+            ),
+          },
+          {
+            name: "INGEST_SCRIPT_S3_URI",
+            value: manifestBucket.s3UrlForObject(ingestScriptKey),
+          },
+          { name: "INGEST_SCRIPT_SHA256", value: ingestScriptDigest },
+          {
+            name: "INGEST_SUPPORT_S3_URI",
+            value: manifestBucket.s3UrlForObject(ingestSupportKey),
+          },
+          { name: "INGEST_SUPPORT_SHA256", value: ingestSupportDigest },
+          {
+            name: "EMBEDDING_CACHE_TABLE_NAME",
+            value: embeddingCacheTable.tableName,
+          },
+        ],
         resourceRequirements: [
           { type: "VCPU", value: process.env.CONTAINER_VCPU },
           { type: "MEMORY", value: process.env.CONTAINER_MEMORY },
         ],
-        jobRoleArn: new iam.Role(this, "BatchJobRole", {
-          assumedBy: new iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
-        }).roleArn,
+        jobRoleArn: batchJobRole.roleArn,
         executionRoleArn: batchExecutionRole.roleArn,
         logConfiguration: {
           logDriver: "awslogs",
@@ -385,12 +708,36 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       platformCapabilities: ["FARGATE"],
     });
 
+    jobDefinition.node.addDependency(ingestScriptDeployment);
+
+    // Checkpoints for the initial S3 backfill so a timed-out invocation can resume
+    const backfillCheckpointTable = new dynamodb.Table(
+      this,
+      "BackfillCheckpointTable",
+      {
+        partitionKey: {
+          name: "BackfillID",
+          type: dynamodb.AttributeType.STRING,
+        },
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      }
+    );
+
+    // What each source object was last ingested as (ETag, embedding config hash, Batch job),
+    // so identical re-uploads skip the delete and re-embed
+    const ingestRecordTable = new dynamodb.Table(this, "IngestRecordTable", {
+      partitionKey: { name: "SourcePath", type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     // Define the Lambda function for adding
     const addLambda = new lambda.Function(this, "AddLambdaFunction", {
       runtime: lambda.Runtime.PYTHON_3_9,
       code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
       handler: "add_lambda_function.lambda_handler",
-      layers: [sharedLambdaLayer],
+      layers: [sharedLambdaLayer, ingestUtilsLayer],
       environment: {
         CENTRAL_LOG_GROUP_NAME: centralLogGroup.logGroupName,
         JOB_QUEUE: jobQueue.ref,
@@ -405,8 +752,17 @@ export class S3_Pinecone_CDK_Stack extends Stack {
         CHUNKING_STRATEGY: process.env.CHUNKING_STRATEGY || "",
         CHUNKING_MAX_CHARACTERS: process.env.CHUNKING_MAX_CHARACTERS || "",
         PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
+        ...pineconeLayoutEnvironment,
         S3_BUCKET_NAME: process.env.S3_BUCKET_NAME!,
         S3_NOTIFICATION_PREFIX: process.env.S3_NOTIFICATION_PREFIX || "",
+        BACKFILL_TABLE_NAME: backfillCheckpointTable.tableName,
+        INGEST_RECORD_TABLE_NAME: ingestRecordTable.tableName,
+        // Destination settings that force a re-ingest when changed
+        DESTINATION_CONFIG_KEYS: "PINECONE_INDEX_NAME",
+        INCREMENTAL_INGEST: process.env.INCREMENTAL_INGEST || "false",
+        BUNDLE_MAX_FILES: process.env.BUNDLE_MAX_FILES || "25",
+        BUNDLE_MAX_BYTES: process.env.BUNDLE_MAX_BYTES || "268435456",
+        MANIFEST_BUCKET_NAME: manifestBucket.bucketName,
       },
       timeout: cdk.Duration.seconds(30),
     });
@@ -422,6 +778,171 @@ export class S3_Pinecone_CDK_Stack extends Stack {
     // Grant necessary permissions to access S3
     bucket.grantRead(addLambda);
 
+    // Allow the add Lambda to write array job manifests
+    manifestBucket.grantWrite(addLambda);
+
+    // Allow the add Lambda to checkpoint the backfill and re-invoke itself, and only itself, to
+    // resume it. The grant is a policy of its own because the function's default policy can't
+    // name the function's ARN without a circular dependency.
+    backfillCheckpointTable.grantReadWriteData(addLambda);
+    new iam.Policy(this, "AddLambdaSelfInvokePolicy", {
+      roles: [addLambda.role!],
+      statements: [
+        new iam.PolicyStatement({
+          actions: ["lambda:InvokeFunction"],
+          resources: [addLambda.functionArn],
+        }),
+      ],
+    });
+
+    // Allow the add Lambda to read and write ingest records and check the jobs they point at
+    ingestRecordTable.grantReadWriteData(addLambda);
+    addLambda.addToRolePolicy(
+      new iam.PolicyStatement({
+        actions: ["batch:DescribeJobs"],
+        resources: ["*"],
+      })
+    );
+
+    // Warm ingest workers: long-lived Fargate tasks that take manifests off a queue and keep the
+    // partitioner and embedder loaded between documents. The add Lambda sends work here instead
+    // of to Batch when INGEST_DISPATCH=worker.
+    const ingestWorkerDeadLetterQueue = new sqs.Queue(
+      this,
+      "IngestWorkerDeadLetterQueue",
+      { retentionPeriod: cdk.Duration.days(14) }
+    );
+
+    const ingestWorkerQueue = new sqs.Queue(this, "IngestWorkerQueue", {
+      // Covers a worker until its first visibility heartbeat; after that it keeps extending the
+      // timeout while it works, so only a stopped worker's manifest is redelivered
+      visibilityTimeout: cdk.Duration.minutes(30),
+      deadLetterQueue: {
+        queue: ingestWorkerDeadLetterQueue,
+        maxReceiveCount: 3,
+      },
+    });
+
+    const ingestWorkerTaskDefinition = new ecs.FargateTaskDefinition(
+      this,
+      "IngestWorkerTaskDef",
+      {
+        cpu: Number(process.env.CONTAINER_VCPU) * 1024,
+        memoryLimitMiB: Number(process.env.CONTAINER_MEMORY),
+        taskRole: batchJobRole,
+        executionRole: batchExecutionRole,
+        runtimePlatform: {
+          cpuArchitecture: ecs.CpuArchitecture.ARM64,
+          operatingSystemFamily: ecs.OperatingSystemFamily.LINUX,
+        },
+      }
+    );
+
+    ingestWorkerTaskDefinition.addContainer("IngestWorker", {
+      image: ecs.ContainerImage.fromRegistry(
+        "public.ecr.aws/q1n8b2k4/hcamacho/unstructured-demo:latest"
+      ),
+      environment: {
+        APP_SCRIPT: fs.readFileSync(
+          "lambda/batch_bootstrap/script_bootstrap.py",
+          "utf8"
+        ),
+        INGEST_SCRIPT_S3_URI: manifestBucket.s3UrlForObject(ingestScriptKey),
+        INGEST_SCRIPT_SHA256: ingestScriptDigest,
+        INGEST_SUPPORT_S3_URI: manifestBucket.s3UrlForObject(ingestSupportKey),
+        INGEST_SUPPORT_SHA256: ingestSupportDigest,
+        INGEST_WORKER_QUEUE_URL: ingestWorkerQueue.queueUrl,
+        // Run the pipeline steps in the worker process so loaded models survive between documents
+        INGEST_DISABLE_PARALLELISM: "true",
+        INGEST_MODE:
+          process.env.INCREMENTAL_INGEST === "true" ? "incremental" : "full",
+        INGEST_RECORD_TABLE_NAME: ingestRecordTable.tableName,
+        EMBEDDING_CACHE_TABLE_NAME: embeddingCacheTable.tableName,
+        EMBEDDING_PROVIDER: process.env.EMBEDDING_PROVIDER!,
+        EMBEDDING_MODEL_NAME: process.env.EMBEDDING_MODEL_NAME!,
+        EMBEDDING_PROVIDER_API_KEY:
+          process.env.EMBEDDING_PROVIDER_API_KEY || "",
+        CHUNKING_STRATEGY: process.env.CHUNKING_STRATEGY || "",
+        CHUNKING_MAX_CHARACTERS: process.env.CHUNKING_MAX_CHARACTERS || "",
+        PINECONE_API_KEY: process.env.PINECONE_API_KEY!,
+        PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
+        ...pineconeLayoutEnvironment,
+        LOCAL_FILE_DOWNLOAD_DIR: "/tmp/",
+      },
+      logging: ecs.LogDrivers.awsLogs({
+        logGroup: centralLogGroup,
+        streamPrefix: "ingest-worker",
+      }),
+    });
+
+    const ingestWorkerCluster = new ecs.Cluster(this, "IngestWorkerCluster", {
+      vpc,
+    });
+
+    const minIngestWorkers = Number(
+      process.env.INGEST_WORKER_MIN_TASKS || "0"
+    );
+    const maxIngestWorkers = Number(
+      process.env.INGEST_WORKER_MAX_TASKS || "10"
+    );
+
+    const ingestWorkerService = new ecs.FargateService(
+      this,
+      "IngestWorkerService",
+      {
+        cluster: ingestWorkerCluster,
+        taskDefinition: ingestWorkerTaskDefinition,
+        desiredCount: minIngestWorkers,
+      }
+    );
+
+    ingestWorkerService.node.addDependency(ingestScriptDeployment);
+
+    // Size the fleet from the backlog. In-flight messages count too, so workers that are busy
+    // with the last manifests aren't stopped just because nothing is waiting.
+    const ingestWorkerBacklog = new cloudwatch.MathExpression({
+      expression: "visible + inFlight",
+      usingMetrics: {
+        visible: ingestWorkerQueue.metricApproximateNumberOfMessagesVisible(),
+        inFlight: ingestWorkerQueue.metricApproximateNumberOfMessagesNotVisible(),
+      },
+      period: cdk.Duration.minutes(1),
+    });
+
+    ingestWorkerService
+      .autoScaleTaskCount({
+        minCapacity: minIngestWorkers,
+        maxCapacity: maxIngestWorkers,
+      })
+      .scaleOnMetric("IngestWorkerBacklogScaling", {
+        metric: ingestWorkerBacklog,
+        adjustmentType: appscaling.AdjustmentType.EXACT_CAPACITY,
+        scalingSteps: [
+          { upper: 0, change: minIngestWorkers },
+          { lower: 1, change: Math.max(1, minIngestWorkers) },
+          { lower: 10, change: Math.max(1, Math.ceil(maxIngestWorkers / 2)) },
+          { lower: 50, change: maxIngestWorkers },
+        ],
+        cooldown: cdk.Duration.minutes(1),
+      });
+
+    // The workers read the source objects with the task role, take and retry manifests, and
+    // drop the ingest records of objects they give up on
+    bucket.grantRead(batchJobRole);
+    ingestWorkerQueue.grantConsumeMessages(batchJobRole);
+    ingestWorkerQueue.grantSendMessages(batchJobRole);
+    ingestRecordTable.grantWriteData(batchJobRole);
+
+    ingestWorkerQueue.grantSendMessages(addLambda);
+    addLambda.addEnvironment(
+      "INGEST_WORKER_QUEUE_URL",
+      ingestWorkerQueue.queueUrl
+    );
+    addLambda.addEnvironment(
+      "INGEST_DISPATCH",
+      process.env.INGEST_DISPATCH || "batch"
+    );
+
     // Add permissions for S3 to invoke addLambda
     addLambda.addPermission("S3InvokeAddLambda", {
       principal: new iam.ServicePrincipal("s3.amazonaws.com"),
@@ -434,11 +955,13 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: "delete_lambda_function.lambda_handler",
       code: lambda.Code.fromAsset("lambda/s3_pinecone_lambda"),
-      layers: [sharedLambdaLayer],
+      layers: [sharedLambdaLayer, ingestUtilsLayer],
       environment: {
         CENTRAL_LOG_GROUP_NAME: centralLogGroup.logGroupName,
         PINECONE_API_KEY: process.env.PINECONE_API_KEY!,
         PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
+        ...pineconeLayoutEnvironment,
+        INGEST_RECORD_TABLE_NAME: ingestRecordTable.tableName,
       },
       timeout: cdk.Duration.seconds(30),
     });
@@ -467,6 +990,7 @@ export class S3_Pinecone_CDK_Stack extends Stack {
         OPENAI_API_KEY: process.env.EMBEDDING_PROVIDER_API_KEY!,
         PINECONE_API_KEY: process.env.PINECONE_API_KEY!,
         PINECONE_INDEX_NAME: process.env.PINECONE_INDEX_NAME!,
+        ...pineconeLayoutEnvironment,
         EMBEDDING_MODEL_NAME: process.env.EMBEDDING_MODEL_NAME!,
       },
       timeout: cdk.Duration.seconds(30),
@@ -477,6 +1001,9 @@ export class S3_Pinecone_CDK_Stack extends Stack {
       principal: new iam.ServicePrincipal("apigateway.amazonaws.com"),
     });
 
+    // Allow the delete Lambda to drop the ingest record of a removed object
+    ingestRecordTable.grantWriteData(deleteLambda);
+
     // Grant necessary permissions to access S3 for the delete Lambda
     bucket.grantRead(deleteLambda);
 
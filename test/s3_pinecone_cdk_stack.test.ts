@@ -47,6 +47,7 @@ describe('S3_Pinecone_CDK_Stack Tests', () => {
       { routeKey: '$connect', lambdaSuffix: 'Connect' },
       { routeKey: '$disconnect', lambdaSuffix: 'Disconnect' },
       { routeKey: 'initialCheck', lambdaSuffix: 'InitialCheck' },
+      { routeKey: 'fetchLogs', lambdaSuffix: 'FetchLogs' },
     ];
   
     routes.forEach(({ routeKey, lambdaSuffix }) => {
@@ -81,9 +82,19 @@ describe('S3_Pinecone_CDK_Stack Tests', () => {
         { AttributeName: 'connectionId', KeyType: 'HASH' },
         { AttributeName: 'timestamp', KeyType: 'RANGE' },
       ],
-      AttributeDefinitions: [
+      AttributeDefinitions: assertions.Match.arrayWith([
         { AttributeName: 'connectionId', AttributeType: 'S' },
         { AttributeName: 'timestamp', AttributeType: 'N' },
+        { AttributeName: 'clientId', AttributeType: 'S' },
+      ]),
+      GlobalSecondaryIndexes: [
+        assertions.Match.objectLike({
+          IndexName: 'ClientConnectionsIndex',
+          KeySchema: [
+            { AttributeName: 'clientId', KeyType: 'HASH' },
+            { AttributeName: 'timestamp', KeyType: 'RANGE' },
+          ],
+        }),
       ],
     });
   });
@@ -138,9 +149,11 @@ describe('S3_Pinecone_CDK_Stack Tests', () => {
   // Test 6: Log Subscription Filter
   test('Log Subscription Filter is created with correct filter pattern and destination', () => {
     const subscriptionFilters = template.findResources('AWS::Logs::SubscriptionFilter');
-    expect(Object.keys(subscriptionFilters).length).toBe(1);
+    expect(Object.keys(subscriptionFilters).length).toBe(2);
 
-    const subscriptionFilter = subscriptionFilters[Object.keys(subscriptionFilters)[0]];
+    const subscriptionFilter = subscriptionFilters[
+      Object.keys(subscriptionFilters).find((id) => id.startsWith('LogSubscriptionFilter'))!
+    ];
     const expectedPattern = "\\?\"ingest process finished in\" \\?\"Deleting vectors from database\" \\?\"Deleting File:\" \\?\"calling PartitionStep\" \\?\"calling ChunkStep\" \\?\"calling EmbedStep\" \\?\"writing a total of\" \\?\"MainProcess ERROR\" \\?\"Exception raised\"";
 
     expect(subscriptionFilter.Properties.FilterPattern).toMatch(new RegExp(expectedPattern));
@@ -157,9 +170,42 @@ describe('S3_Pinecone_CDK_Stack Tests', () => {
     });
   });
 
+  // Test 6b: Telemetry Subscription Filter
+  test('Telemetry Subscription Filter passes only telemetry records to its consumer', () => {
+    template.hasResourceProperties('AWS::Logs::SubscriptionFilter', {
+      FilterPattern: '{ $.telemetry = 1 }',
+      DestinationArn: {
+        'Fn::GetAtt': [assertions.Match.stringLikeRegexp('^TelemetryConsumerLambda'), 'Arn'],
+      },
+    });
+  });
+
+  // Test 6c: Stage Metrics
+  test('Telemetry Consumer publishes stage metrics and the role can read them back', () => {
+    template.hasResourceProperties('AWS::Lambda::Function', {
+      Handler: 'telemetry_consumer_lambda.lambda_handler',
+      Environment: {
+        Variables: assertions.Match.objectLike({
+          STAGE_METRICS_NAMESPACE: assertions.Match.stringLikeRegexp('^Splinter/'),
+        }),
+      },
+    });
+    template.hasResourceProperties('AWS::IAM::Policy', {
+      PolicyDocument: {
+        Statement: assertions.Match.arrayWith([
+          assertions.Match.objectLike({
+            Action: assertions.Match.arrayWith(['cloudwatch:GetMetricData']),
+          }),
+        ]),
+      },
+    });
+  });
+
   // Test 7: EventBridge Rule Pattern
   test('EventBridge Rule has the correct eventPattern', () => {
-    const eventBridgeRule = template.findResources('AWS::Events::Rule');
+    const eventBridgeRule = template.findResources('AWS::Events::Rule', {
+      Properties: { EventPattern: assertions.Match.anyValue() },
+    });
     expect(Object.keys(eventBridgeRule).length).toBe(1);
 
     const rule = eventBridgeRule[Object.keys(eventBridgeRule)[0]];
@@ -172,6 +218,60 @@ describe('S3_Pinecone_CDK_Stack Tests', () => {
     });
   });
 
+  // Test 7b: Scheduled reconcile of the index totals
+  test('EventBridge Rule schedules the index count reconcile', () => {
+    template.hasResourceProperties('AWS::Events::Rule', {
+      ScheduleExpression: 'rate(30 minutes)',
+    });
+    template.hasResourceProperties('AWS::Lambda::Function', {
+      Handler: 'vector_count_pinecone_lambda.reconcile_handler',
+    });
+  });
+
+  // Test 7c: Incrementally maintained job status counts
+  test('Job status transitions are tracked per job and reconciled on a schedule', () => {
+    template.hasResourceProperties('AWS::DynamoDB::Table', {
+      KeySchema: [{ AttributeName: 'jobId', KeyType: 'HASH' }],
+      TimeToLiveSpecification: { AttributeName: 'ExpiresAt', Enabled: true },
+    });
+    template.hasResourceProperties('AWS::Lambda::Function', {
+      Handler: 'new_status_lambda.reconcile_handler',
+      Environment: {
+        Variables: assertions.Match.objectLike({
+          JOB_STATUS_TABLE_NAME: { Ref: assertions.Match.stringLikeRegexp('^JobStatusTable') },
+        }),
+      },
+    });
+    expect(
+      Object.keys(template.findResources('AWS::Events::Rule', {
+        Properties: { ScheduleExpression: 'rate(30 minutes)' },
+      })).length
+    ).toBe(2);
+  });
+
+  // Test 7d: Log retention and hourly compaction
+  test('Log lines expire and are compacted into hourly summaries', () => {
+    template.hasResourceProperties('AWS::DynamoDB::Table', {
+      KeySchema: [
+        { AttributeName: 'clientId', KeyType: 'HASH' },
+        { AttributeName: 'timestamp', KeyType: 'RANGE' },
+      ],
+      TimeToLiveSpecification: { AttributeName: 'ExpiresAt', Enabled: true },
+    });
+    template.hasResourceProperties('AWS::Lambda::Function', {
+      Handler: 'log_compaction_lambda.lambda_handler',
+      Environment: {
+        Variables: assertions.Match.objectLike({
+          CLIENT_DATA_TABLE_NAME: { Ref: assertions.Match.stringLikeRegexp('^ClientDataTable') },
+          LOG_COMPACT_AFTER_HOURS: '24',
+        }),
+      },
+    });
+    template.hasResourceProperties('AWS::Events::Rule', {
+      ScheduleExpression: 'rate(1 hour)',
+    });
+  });
+
   // Test 8: AWS Batch
   test('AWS Batch Job Definition is created', () => {
     template.hasResourceProperties('AWS::Batch::JobDefinition', {
@@ -211,4 +311,110 @@ describe('S3_Pinecone_CDK_Stack Tests', () => {
       ],
     });
   });  
-});
\ No newline at end of file
+
+  // Test 9: Ingest records for content-hash dedup
+  test('DynamoDB Table Created for Ingest Records', () => {
+    template.hasResourceProperties('AWS::DynamoDB::Table', {
+      KeySchema: [{ AttributeName: 'SourcePath', KeyType: 'HASH' }],
+      BillingMode: 'PAY_PER_REQUEST',
+    });
+    assertLambdaEnvironment(template, 'add_lambda_function.lambda_handler', {
+      INGEST_RECORD_TABLE_NAME: { Ref: expect.any(String) },
+    });
+  });
+
+  // Test 10: Embedding cache shared by the Batch jobs
+  test('DynamoDB Table Created for Embedding Cache', () => {
+    template.hasResourceProperties('AWS::DynamoDB::Table', {
+      KeySchema: [{ AttributeName: 'CacheKey', KeyType: 'HASH' }],
+      BillingMode: 'PAY_PER_REQUEST',
+      TimeToLiveSpecification: { AttributeName: 'ExpiresAt', Enabled: true },
+    });
+  });
+
+  // Test 11: Warm ingest workers scaled from the work queue
+  test('Ingest Worker Service scales on queue backlog', () => {
+    template.hasResourceProperties('AWS::SQS::Queue', {
+      VisibilityTimeout: 1800,
+      RedrivePolicy: { maxReceiveCount: 3 },
+    });
+    template.hasResourceProperties('AWS::ECS::Service', {
+      LaunchType: 'FARGATE',
+    });
+    template.hasResourceProperties('AWS::ApplicationAutoScaling::ScalingPolicy', {
+      PolicyType: 'StepScaling',
+      StepScalingPolicyConfiguration: { AdjustmentType: 'ExactCapacity' },
+    });
+    assertLambdaEnvironment(template, 'add_lambda_function.lambda_handler', {
+      INGEST_WORKER_QUEUE_URL: { Ref: expect.any(String) },
+    });
+  });
+
+  // Test 12: Every reader and writer of the index agrees on its layout
+  test('Pinecone layout is passed to the Lambdas that use the index', () => {
+    [
+      'add_lambda_function.lambda_handler',
+      'delete_lambda_function.lambda_handler',
+      'vector_count_pinecone_lambda.reconcile_handler',
+      'prompt_handler.lambda_handler',
+    ].forEach((handler) => {
+      assertLambdaEnvironment(template, handler, {
+        PINECONE_LAYOUT: 'namespace',
+        PINECONE_NAMESPACE: 'documents',
+        PINECONE_NAMESPACE_SHARDS: '1',
+      });
+    });
+  });
+
+  // Test 13: The backfill may only re-invoke the add Lambda itself
+  test('Add Lambda can invoke only itself', () => {
+    const addLambdaIds = Object.keys(template.findResources('AWS::Lambda::Function', {
+      Properties: { Handler: 'add_lambda_function.lambda_handler' },
+    }));
+    expect(addLambdaIds).toHaveLength(1);
+    const invokeStatements = Object.values(template.findResources('AWS::IAM::Policy'))
+      .flatMap((policy: any) => policy.Properties.PolicyDocument.Statement)
+      .filter((statement: any) => statement.Action === 'lambda:InvokeFunction');
+    expect(invokeStatements).toContainEqual(expect.objectContaining({
+      Resource: { 'Fn::GetAtt': [addLambdaIds[0], 'Arn'] },
+    }));
+    expect(JSON.stringify(invokeStatements)).not.toContain('function:*');
+  });
+
+  // Test 14: connection_utils and job_status_utils come from one shared layer
+  test('Dashboard Lambdas share the dashboard utils layer', () => {
+    const layerIds = Object.keys(template.findResources('AWS::Lambda::LayerVersion'));
+    [
+      'connect_lambda.lambda_handler',
+      'new_status_lambda.lambda_handler',
+      'initial_check_lambda.lambda_handler',
+      'telemetry_consumer_lambda.lambda_handler',
+    ].forEach((handler) => {
+      template.hasResourceProperties('AWS::Lambda::Function', {
+        Handler: handler,
+        Layers: assertions.Match.arrayWith([
+          { Ref: assertions.Match.stringLikeRegexp('^DashboardUtilsLayer') },
+        ]),
+      });
+    });
+    expect(layerIds.some((id) => id.startsWith('DashboardUtilsLayer'))).toBe(true);
+  });
+
+  // Test 15: manifest_utils, backfill_utils and ingest_record_utils come from one shared layer
+  test('Add and delete Lambdas share the ingest utils layer', () => {
+    ['add_lambda_function.lambda_handler', 'delete_lambda_function.lambda_handler'].forEach((handler) => {
+      template.hasResourceProperties('AWS::Lambda::Function', {
+        Handler: handler,
+        Layers: assertions.Match.arrayWith([
+          { Ref: assertions.Match.stringLikeRegexp('^IngestUtilsLayer') },
+        ]),
+      });
+    });
+    template.hasResourceProperties('AWS::Lambda::Function', {
+      Handler: 'add_lambda_function.lambda_handler',
+      Environment: {
+        Variables: assertions.Match.objectLike({ DESTINATION_CONFIG_KEYS: 'PINECONE_INDEX_NAME' }),
+      },
+    });
+  });
+});